@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+advice_engine.py
+- Bộ tư vấn cục bộ (không gọi LLM) cho /advice: áp đúng các ngưỡng số mà prompt Gemini đang dùng
+  lên metrics (_extract_metrics) và targets (_targets_for_profile), xuất cùng bố cục markdown
+- CircuitBreaker: chuyển sang bộ tư vấn cục bộ khi Gemini lỗi/chậm liên tục
+"""
+import threading
+import time
+
+LEVELS = ("Phù hợp", "Cần cân nhắc", "Hạn chế", "Tránh")
+FREQUENCY = {
+    "Phù hợp": "dùng thường xuyên",
+    "Cần cân nhắc": "≤ 3 lần/tuần",
+    "Hạn chế": "≤ 1–2 lần/tuần",
+    "Tránh": "không dùng",
+}
+
+
+def _fmt(x):
+    return f"{x:g}" if isinstance(x, (int, float)) else str(x)
+
+
+def _upper(name, value, unit, good, high):
+    """Chỉ tiêu 'càng thấp càng tốt' → (dòng mô tả, mức 0=tốt/1=vừa/2=cao) hoặc (dòng, None) nếu thiếu số."""
+    if value is None:
+        return f"- {name}: không có trong nhãn (ngưỡng tốt ≤ {_fmt(good)} {unit}, cao ≥ {_fmt(high)} {unit}).", None
+    if value <= good:
+        return f"- {name}: {_fmt(value)} {unit} — thấp (≤ {_fmt(good)} {unit}).", 0
+    if value < high:
+        return f"- {name}: {_fmt(value)} {unit} — vừa ({_fmt(good)}–{_fmt(high)} {unit}).", 1
+    return f"- {name}: {_fmt(value)} {unit} — cao (≥ {_fmt(high)} {unit}).", 2
+
+
+def _lower(name, value, unit, mid, good, relevant):
+    """Chỉ tiêu 'càng cao càng tốt' (protein, chất xơ)."""
+    if value is None:
+        return f"- {name}: không có trong nhãn.", None
+    note = "" if relevant else " (không phải ưu tiên theo mục tiêu hiện tại)"
+    if value >= good:
+        return f"- {name}: {_fmt(value)} {unit} — tốt (≥ {_fmt(good)} {unit}){note}.", 0
+    if value >= mid:
+        return f"- {name}: {_fmt(value)} {unit} — vừa ({_fmt(mid)}–{_fmt(good)} {unit}){note}.", 1
+    return f"- {name}: {_fmt(value)} {unit} — thấp (< {_fmt(mid)} {unit}){note}.", 2 if relevant else 1
+
+
+def local_advice(metrics: dict, targets: dict, allergy_hits=()):
+    """Trả về (markdown, level) theo 4 mức Phù hợp / Cần cân nhắc / Hạn chế / Tránh."""
+    t = targets
+    lines, levels = [], []
+    for name, key, unit, good, high in (
+        ("Đường", "sugars_g", "g", t["sugar_good_g"], t["sugar_high_g"]),
+        ("Natri", "sodium_mg", "mg", t["sodium_good_mg"], t["sodium_high_mg"]),
+        ("Chất béo bão hoà", "satfat_g", "g", t["satfat_good_g"], t["satfat_high_g"]),
+    ):
+        line, lv = _upper(name, metrics.get(key), unit, good, high)
+        lines.append(line)
+        levels.append(lv)
+
+    line, protein_lv = _lower("Protein", metrics.get("protein_g"), "g", 6.0, 10.0, t["protein_min_g"] >= 10.0)
+    lines.append(line)
+    line, fiber_lv = _lower("Chất xơ", metrics.get("fiber_g"), "g", 3.0, t["fiber_min_g"], t["fiber_min_g"] >= 5.0)
+    lines.append(line)
+
+    add_cnt, add_max = metrics.get("additives_count") or 0, t["additives_max"]
+    many_additives = add_cnt > add_max
+    lines.append(f"- Phụ gia: {add_cnt} — {'nhiều (> ' if many_additives else 'ít (≤ '}{add_max}).")
+    transfat = bool(metrics.get("transfat_flag"))
+    lines.append(f"- Trans fat: {'có dấu hiệu (dầu hydro hoá/shortening) → mức Tránh' if transfat else 'không thấy trong thành phần'}.")
+    if allergy_hits:
+        lines.append(f"- Dị ứng theo hồ sơ: phát hiện {', '.join(allergy_hits)} → mức Tránh.")
+
+    highs = sum(1 for lv in levels if lv == 2)
+    mids = sum(1 for lv in levels if lv == 1) + (1 if many_additives else 0) \
+        + (1 if protein_lv == 2 else 0) + (1 if fiber_lv == 2 else 0)
+    if transfat or allergy_hits or highs >= 2:
+        level = "Tránh"
+    elif highs == 1:
+        level = "Hạn chế"
+    elif mids:
+        level = "Cần cân nhắc"
+    else:
+        level = "Phù hợp"
+
+    reasons = []
+    if transfat: reasons.append("có trans fat")
+    if allergy_hits: reasons.append("chứa chất gây dị ứng trong hồ sơ")
+    if highs: reasons.append(f"{highs} chỉ tiêu vượt ngưỡng cao")
+    if mids and not reasons: reasons.append(f"{mids} chỉ tiêu ở mức vừa/chưa đạt")
+    why = "; ".join(reasons) or "các chỉ tiêu đều trong ngưỡng tốt"
+
+    serving = metrics.get("serving_size") or "1 khẩu phần"
+    md = [
+        f"**Trả lời nhanh**: Mức **{level}** — {why}. Tần suất: {FREQUENCY[level]}.",
+        "",
+        "**Phân tích chi tiết** (mỗi khẩu phần)",
+        *lines,
+        "",
+        "**Tiêu chí chọn tốt hơn**",
+        f"- Đường ≤ {_fmt(t['sugar_good_g'])} g; natri ≤ {_fmt(t['sodium_good_mg'])} mg; bão hoà ≤ {_fmt(t['satfat_good_g'])} g.",
+        f"- Không trans fat; phụ gia ≤ {add_max}.",
+        f"- Protein ≥ {_fmt(t['protein_min_g'])} g; chất xơ ≥ {_fmt(t['fiber_min_g'])} g.",
+        "",
+        "**Gợi ý khẩu phần/tần suất**",
+        f"- Khẩu phần tham chiếu: {serving}.",
+        f"- {level}: {FREQUENCY[level]}.",
+    ]
+    if level in ("Cần cân nhắc", "Hạn chế"):
+        md.append("- Ăn kèm rau/đạm nạc, tránh dùng cùng ngày với sản phẩm mặn/ngọt khác.")
+    return "\n".join(md), level
+
+
+class CircuitBreaker:
+    """closed → open sau failure_threshold lỗi liên tiếp; sau reset_timeout cho 1 lời gọi thử (half-open)."""
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            st = self.state
+            if st == "closed":
+                return True
+            if st == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures, self._opened_at, self._probing = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        """Lượt thử half-open bị bỏ dở (client ngắt stream) → không kết luận, request sau được thử lại."""
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "failures": self._failures, "trips": self.trips,
+                    "failure_threshold": self.failure_threshold, "reset_timeout_s": self.reset_timeout}
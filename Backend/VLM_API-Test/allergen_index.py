@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+allergen_index.py
+- Chuẩn hoá chất gây dị ứng về mã chuẩn (theo tag OFF: milk, gluten, peanuts, ...) qua bảng đồng nghĩa
+  Anh / Việt (có hoặc không dấu); nhận tag "en:milk", chuỗi "en:gluten,en:milk" (một số item OFF) và chữ tự do trong hồ sơ
+- Lúc nạp catalog: mỗi mã chuẩn giữ một bitset (np.packbits) các item chứa nó; catalog JSON dựng từ từng dòng
+  (from_values), snapshot lưu sẵn ma trận bitset (catalog_snapshot) → mở bằng mmap, không giải mã dòng nào
+- Lúc đề xuất: dị ứng của người dùng → vài mã → OR các bitset → loại khỏi tập ứng viên của bucket (ANDNOT)
+"""
+import unicodedata
+
+import numpy as np
+
+# mã chuẩn → các cách gọi (so khớp sau khi bỏ dấu, chữ thường)
+ALLERGEN_SYNONYMS = {
+    "milk": ["milk", "sữa", "sữa bò", "lactose", "dairy", "casein", "whey"],
+    "gluten": ["gluten", "wheat", "lúa mì", "bột mì", "barley", "lúa mạch", "rye", "yến mạch", "oats"],
+    "peanuts": ["peanut", "peanuts", "đậu phộng", "lạc"],
+    "nuts": ["nuts", "nut", "tree nuts", "hạt phỉ", "hazelnut", "almond", "hạnh nhân", "hạt điều", "cashew",
+             "walnut", "óc chó", "macadamia", "pistachio", "hạt dẻ cười"],
+    "crustaceans": ["crustaceans", "crustacean", "shellfish", "tôm", "cua", "tôm cua", "shrimp", "prawn", "crab",
+                    "lobster", "tôm hùm", "hải sản có vỏ"],
+    "molluscs": ["molluscs", "mollusks", "mực", "bạch tuộc", "ốc", "nghêu", "sò", "hến", "hàu", "oyster", "squid"],
+    "fish": ["fish", "cá", "nước mắm"],
+    "eggs": ["eggs", "egg", "trứng"],
+    "soybeans": ["soybeans", "soybean", "soy", "soya", "đậu nành", "đậu tương"],
+    "sesame-seeds": ["sesame-seeds", "sesame", "vừng", "mè"],
+    "mustard": ["mustard", "mù tạt"],
+    "celery": ["celery", "cần tây"],
+    "lupin": ["lupin"],
+    "sulphur-dioxide-and-sulphites": ["sulphur-dioxide-and-sulphites", "sulphites", "sulfites", "sulfite",
+                                      "sulphur dioxide", "so2", "sunfit"],
+    "gelatin": ["gelatin", "gelatine"],
+}
+NONE_WORDS = {"khong", "khong co", "none", "no", "no allergy", "no allergies", "n/a", "-"}
+_PHRASE_MIN_LEN = 4   # từ đồng nghĩa ngắn (cá, tôm, mè, ...) chỉ khớp nguyên cụm, tránh "cà phê" → cá
+_SUBSTR_MIN_LEN = 3   # so chuỗi con với tag gốc: bỏ đầu vào quá ngắn ("en" khớp mọi tag "en:...")
+
+
+def fold(text) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (đ → d), gộp khoảng trắng."""
+    s = unicodedata.normalize("NFD", str(text or "").lower().replace("đ", "d"))
+    s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    return " ".join(s.replace("_", " ").split())
+
+
+_SYN = {}
+for _cid, _words in ALLERGEN_SYNONYMS.items():
+    for _w in _words:
+        _SYN.setdefault(fold(_w), _cid)
+_PHRASES = sorted((w for w in _SYN if len(w) >= _PHRASE_MIN_LEN), key=len, reverse=True)
+
+
+def split_tags(value) -> list:
+    """allergens của item: list tag, hoặc chuỗi "en:a,en:b" → list tag."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(t).strip() for t in value if str(t).strip()]
+
+
+def canonical_tag(tag: str):
+    """Tag item ("en:milk", "vi:sữa", "milk") → mã chuẩn; tag lạ giữ nguyên phần sau ':'; "vi:không" → None."""
+    key = fold(str(tag).split(":", 1)[-1]).replace("-", " ")
+    if not key or key in NONE_WORDS:
+        return None
+    return _SYN.get(key) or _SYN.get(key.replace(" ", "-")) or key
+
+
+class AllergenIndex:
+    def __init__(self, bits: dict, raw_tags: dict, n: int):
+        """bits: mã chuẩn → bitset packbits (n bit); raw_tags: tag gốc (chữ thường) → mã chuẩn."""
+        self.n = n
+        self.bits = bits
+        self.raw_tags = raw_tags      # cho so khớp chuỗi con như bản cũ
+        self._counts = None
+
+    @classmethod
+    def from_values(cls, values, n: int = None):
+        """values: allergens của từng item theo thứ tự (list / chuỗi / None), duyệt một lượt;
+        n: số item (None = đếm theo values)."""
+        rows, raw_tags, memo = {}, {}, {}     # mã chuẩn → [vị trí]
+        count = 0
+        for i, v in enumerate(values):
+            count = i + 1
+            key = v if isinstance(v, str) else tuple(v or ())
+            ids = memo.get(key)
+            if ids is None:
+                ids = set()
+                for t in split_tags(v):
+                    cid = canonical_tag(t)
+                    if cid:
+                        ids.add(cid)
+                        raw_tags.setdefault(t.lower(), cid)
+                ids = memo[key] = tuple(ids)
+            for cid in ids:
+                rows.setdefault(cid, []).append(i)
+        n = count if n is None else n
+        bits = {}
+        for cid, ix in sorted(rows.items()):
+            m = np.zeros(n, dtype=bool)
+            m[ix] = True
+            bits[cid] = np.packbits(m)
+        return cls(bits, raw_tags, n)
+
+    def resolve(self, user_allergies) -> set:
+        """Dị ứng trong hồ sơ (chữ tự do) → tập mã chuẩn có trong catalog."""
+        ids = set()
+        for ua in user_allergies or ():
+            raw = str(ua).strip().lower()
+            f = fold(raw)
+            if not f or f in NONE_WORDS:
+                continue
+            cid = _SYN.get(f) or _SYN.get(f.replace(" ", "-"))
+            if cid:
+                ids.add(cid)
+            else:
+                ids.update(_SYN[p] for p in _PHRASES if f" {p} " in f" {f} ")
+                if f in self.bits:    # tag lạ trong catalog (vd. en:strawberry) gõ đúng tên
+                    ids.add(f)
+            if len(raw) >= _SUBSTR_MIN_LEN:   # như _has_allergen cũ: chuỗi con của tag gốc ("nut" → en:nuts, en:peanuts)
+                ids.update(c for t, c in self.raw_tags.items() if raw in t or t.endswith(raw))
+        return ids & self.bits.keys()
+
+    def blocked(self, ids):
+        """OR các bitset → mảng bool n phần tử (True = chứa ít nhất một mã), hoặc None nếu không có mã nào."""
+        acc = None
+        for cid in ids:
+            acc = np.array(self.bits[cid]) if acc is None else np.bitwise_or(acc, self.bits[cid], out=acc)
+        return None if acc is None else np.unpackbits(acc, count=self.n).view(bool)
+
+    def exclude(self, pos: np.ndarray, user_allergies) -> np.ndarray:
+        """Tập ứng viên pos trừ các item chứa dị ứng của người dùng."""
+        mask = self.blocked(self.resolve(user_allergies))
+        return pos if mask is None else pos[~mask[pos]]
+
+    def stats(self) -> dict:
+        if self._counts is None:
+            self._counts = {cid: int(np.unpackbits(b, count=self.n).sum()) for cid, b in sorted(self.bits.items())}
+        return dict(self._counts)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+asgi.py
+- Chế độ phục vụ ASGI/asyncio: chờ Gemini / ASR bằng await thay vì giữ một OS thread mỗi request,
+  nên một process giữ được hàng trăm cuộc chat đang chờ model
+- /chat, /chat/stream, /advice, /advice/stream, /asr chạy native async (generate_content_async + httpx);
+  các route còn lại (label, jobs, recommend, health, ...) đi qua chính app Flask trong server.py
+- Logic route (intent, đề xuất, renderer, cache, breaker, lưu lịch sử) dùng chung với chế độ sync
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8888
+
+Cần: pip install starlette uvicorn httpx a2wsgi python-multipart
+"""
+import asyncio
+import json
+import os
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import server
+from server import (ADVICE_BREAKER, ADVICE_FLIGHT, ADVICE_LATENCY_BUDGET_S, ALLOWED, ASR_TIMEOUT_S, ASR_UPSTREAM,
+                    CHAT_FLIGHT, GEMINI_SCHED, MAX_REQUEST_BYTES, _MdLineStream, _advice_fallback, _advice_open,
+                    _advice_prepare, _advice_success, _asr_file_from_json, _asr_payload, _cache_advice, _chat_begin,
+                    _chat_save, _chunk_text, _normalize_md, _prompt_key, _sse)
+
+ASR_MAX_CONCURRENCY = int(os.getenv("ASR_MAX_CONCURRENCY", "16"))
+WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))   # cho các route Flask (đọc nhãn, ...)
+
+_asr_sem = asyncio.Semaphore(ASR_MAX_CONCURRENCY)
+_http = None   # httpx.AsyncClient, tạo trong lifespan
+
+
+# ==== Gọi model bất đồng bộ (cùng bộ điều phối / single-flight với chế độ sync) ====
+async def agenerate_text_once(flight, model, parts) -> str:
+    async def run():
+        resp = await GEMINI_SCHED.acall(lambda: model.generate_content_async(parts), kind=flight.name)
+        return resp.text or ""
+    text, _ = await flight.ado(_prompt_key(parts), run)
+    return text
+
+
+async def astream_text(model, parts, kind):
+    async for chunk in GEMINI_SCHED.astream(lambda: model.generate_content_async(parts, stream=True), kind=kind):
+        text = _chunk_text(chunk)
+        if text:
+            yield text
+
+
+# ==== Helpers ====
+async def _read_body(request: Request):
+    """Đọc body, đếm byte khi đọc (chunked / Content-Length sai vẫn bị chặn) → bytes, hoặc None nếu quá MAX_REQUEST_BYTES."""
+    if int(request.headers.get("content-length") or 0) > MAX_REQUEST_BYTES:
+        return None
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_REQUEST_BYTES:
+            return None
+        chunks.append(chunk)
+    request._body = body = b"".join(chunks)   # request.form() / json() sau đó đọc lại từ bản này
+    return body
+
+
+async def _json_body(request: Request):
+    raw = await _read_body(request)
+    if raw is None:
+        return None
+    try:
+        body = json.loads(raw) if raw else {}
+    except ValueError:
+        body = {}
+    return body if isinstance(body, dict) else {}
+
+
+def _cache_advice_later(cache_key):
+    """done-callback: ghi cache (SQLite) trong thread pool, không chạy I/O trên event loop."""
+    def callback(task):
+        asyncio.get_running_loop().run_in_executor(None, _cache_advice, cache_key, task)
+    return callback
+
+
+def _too_large():
+    return JSONResponse({"ok": False, "error": f"request too large (> {MAX_REQUEST_BYTES} bytes)"}, 413)
+
+
+def _sse_stream(agen):
+    return StreamingResponse(agen, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def _normalized_deltas(norm: _MdLineStream, chunks):
+    async for text in chunks:
+        out = norm.feed(text)
+        if out:
+            yield _sse("delta", {"text": out})
+    out = norm.flush()
+    if out:
+        yield _sse("delta", {"text": out})
+
+
+# ==== /advice ====
+async def advice(request: Request):
+    body = await _json_body(request)
+    if body is None:
+        return _too_large()
+    payload, status, plan = await run_in_threadpool(_advice_prepare, body, request.query_params.get("mode"))
+    if plan is None:
+        return JSONResponse(payload, status)
+
+    task = asyncio.ensure_future(agenerate_text_once(ADVICE_FLIGHT, server.LLM_MODEL, plan["parts"]))
+    task.add_done_callback(_cache_advice_later(plan["cache_key"]))
+    try:
+        text = await asyncio.wait_for(asyncio.shield(task), ADVICE_LATENCY_BUDGET_S)
+    except asyncio.TimeoutError:
+        return JSONResponse(_advice_fallback(plan, "timeout"))
+    except Exception as e:
+        return JSONResponse(_advice_fallback(plan, f"gemini_error: {type(e).__name__}", e))
+    return JSONResponse(_advice_success(plan, _normalize_md(text.strip())))
+
+
+async def advice_stream(request: Request):
+    body = await _json_body(request)
+    if body is None:
+        return _too_large()
+    payload, status, plan = await run_in_threadpool(_advice_prepare, body, request.query_params.get("mode"), False)
+    if status != 200:
+        return JSONResponse(payload, status)
+
+    async def events():
+        src = payload or plan
+        yield _sse("meta", {"metrics": src["metrics"], "targets": src["targets"]})
+        local = payload if plan is None else _advice_open(plan)
+        if local is not None:
+            yield _sse("delta", {"text": local["advice_markdown"]})
+            yield _sse("done", local)
+            return
+        norm = _MdLineStream()
+        try:
+            async for ev in _normalized_deltas(norm, astream_text(server.LLM_MODEL, plan["parts"], "advice")):
+                yield ev
+        except (GeneratorExit, asyncio.CancelledError):
+            ADVICE_BREAKER.release()
+            raise
+        except Exception as e:
+            if norm.started:
+                ADVICE_BREAKER.record_failure()
+                yield _sse("error", {"ok": False, "error": f"Gemini error: {type(e).__name__}"})
+                return
+            fb = _advice_fallback(plan, f"gemini_error: {type(e).__name__}", e)
+            yield _sse("delta", {"text": fb["advice_markdown"]})
+            yield _sse("done", fb)
+            return
+        yield _sse("done", await run_in_threadpool(_advice_success, plan, norm.text().strip(), True))
+
+    return _sse_stream(events())
+
+
+# ==== /chat ====
+def _gemini_error(e):
+    return "Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))
+
+
+async def chat(request: Request):
+    body = await _json_body(request)
+    if body is None:
+        return _too_large()
+    chat_id, reply, context_blocks, err, extra = await run_in_threadpool(_chat_begin, body)
+    if err:
+        return JSONResponse({"ok": False, "error": err}, 400)
+    if reply is None:
+        try:
+            reply = _normalize_md((await agenerate_text_once(CHAT_FLIGHT, server.LLM_MODEL, context_blocks)).strip())
+        except Exception as e:
+            return JSONResponse({"ok": False, "error": _gemini_error(e)}, 502)
+    await run_in_threadpool(_chat_save, chat_id, reply, extra)
+    return JSONResponse(dict({"ok": True, "chat_id": chat_id, "reply_markdown": reply}, **extra))
+
+
+async def chat_stream(request: Request):
+    body = await _json_body(request)
+    if body is None:
+        return _too_large()
+    chat_id, reply, context_blocks, err, extra = await run_in_threadpool(_chat_begin, body)
+    if err:
+        return JSONResponse({"ok": False, "error": err}, 400)
+
+    async def events():
+        yield _sse("meta", {"chat_id": chat_id})
+        if reply is not None:
+            yield _sse("delta", {"text": reply})
+            await run_in_threadpool(_chat_save, chat_id, reply, extra)
+            yield _sse("done", dict({"ok": True, "chat_id": chat_id, "reply_markdown": reply}, **extra))
+            return
+        norm = _MdLineStream()
+        try:
+            async for ev in _normalized_deltas(norm, astream_text(server.LLM_MODEL, context_blocks, "chat")):
+                yield ev
+        except Exception as e:
+            yield _sse("error", {"ok": False, "chat_id": chat_id, "error": _gemini_error(e)})
+            return
+        final = norm.text().strip()
+        await run_in_threadpool(_chat_save, chat_id, final, extra)
+        yield _sse("done", dict({"ok": True, "chat_id": chat_id, "reply_markdown": final}, **extra))
+
+    return _sse_stream(events())
+
+
+# ==== /asr ====
+async def asr_proxy(request: Request):
+    if not ASR_UPSTREAM:
+        return JSONResponse({"ok": False, "error": "ASR_URL is not configured on server (.env)"}, 503)
+    if await _read_body(request) is None:
+        return _too_large()
+
+    if "multipart/form-data" in (request.headers.get("content-type") or ""):
+        form = await request.form()
+        f = form.get("file") or form.get("audio") or form.get("voice")
+        if f is None or not getattr(f, "filename", ""):
+            return JSONResponse({"ok": False, "error": "missing 'file' field"}, 400)
+        files = {"file": (f.filename, await f.read(), f.content_type or "audio/m4a")}
+    else:
+        upload, err = _asr_file_from_json(await _json_body(request))
+        if err:
+            return JSONResponse({"ok": False, "error": err}, 400)
+        files = {"file": upload}
+
+    try:
+        async with _asr_sem:   # giới hạn số request đồng thời tới upstream ASR
+            r = await _http.post(ASR_UPSTREAM, files=files, timeout=ASR_TIMEOUT_S)
+        payload, status = _asr_payload(r.status_code, r.headers.get("content-type", ""), r.content)
+        return JSONResponse(payload, status)
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": f"ASR proxy error: {e}"}, 502)
+
+
+# ==== App ====
+def _native(endpoint):
+    async def handler(request: Request):
+        if request.method == "OPTIONS":
+            return Response(status_code=204)
+        return await endpoint(request)
+    return handler
+
+
+NATIVE_ROUTES = {
+    "/advice": advice, "/advice/stream": advice_stream,
+    "/chat": chat, "/chat/stream": chat_stream,
+    "/asr": asr_proxy,
+}
+
+
+async def _lifespan(app):
+    global _http
+    _http = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASR_MAX_CONCURRENCY))
+    try:
+        yield
+    finally:
+        await _http.aclose()
+
+
+native_app = Starlette(
+    routes=[Route(path, _native(fn), methods=["POST", "OPTIONS"]) for path, fn in NATIVE_ROUTES.items()],
+    middleware=[Middleware(CORSMiddleware, allow_origins=ALLOWED, allow_origin_regex=r"http://192\.168\.\d+\.\d+:\d+",
+                           allow_methods=["GET", "POST", "OPTIONS"], allow_headers=["Content-Type"])],
+    lifespan=_lifespan,
+)
+flask_app = WSGIMiddleware(server.app, workers=WSGI_THREADS)
+
+
+async def app(scope, receive, send):
+    """Route native async nếu có, còn lại chuyển cho app Flask (CORS do flask_cors lo, tránh header trùng)."""
+    if scope["type"] == "lifespan" or scope.get("path") in NATIVE_ROUTES:
+        await native_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=server.PORT)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+bench_scoring.py
+- Đo thời gian một lần đề xuất (chấm điểm cả bucket + top-k) trên catalog giả lập 10k / 100k / 1M sản phẩm
+- Kiểm tra khớp bản scalar nằm trong tests/test_vector_scoring.py (synth_catalog dùng chung)
+
+    python bench_scoring.py --sizes 10000,100000,1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("OUT_DIR", tempfile.mkdtemp(prefix="bench_"))   # không ghi vào outputs/ thật
+
+import server
+import vector_scoring as vs
+from catalog_index import CatalogIndex
+
+CATEGORIES = ["tea", "coffee", "water", "yogurt", "snack", "biscuit", "cereal", "noodle", "milk", "oil",
+              "condiment", "misc", "candy"]
+# giá trị sát ngưỡng (cả hai phía) để bắt lỗi ≤ / <
+EDGES = {
+    "sugars_g": [0, 4.5, 5, 8, 9, 13.5, 45, 46],
+    "sodium_g": [0, 0.09, 0.12, 0.4, 0.9, 0.91],
+    "satfat_g": [0, 1, 3, 5, 10, 11],
+    "protein_g": [0, 1.6, 8.0, 10, 9.99],
+    "fiber_g": [0, 0.9, 4.7, 5, 4.99],
+    "energy_kcal": [0, 80.066, 480, 481, 800.76, 900],
+}
+
+
+def synth_catalog(n: int, seed: int = 0, missing: float = 0.15):
+    rnd = random.Random(seed)
+    hi = {"sugars_g": 60, "sodium_g": 2.0, "satfat_g": 15, "protein_g": 30, "fiber_g": 12, "energy_kcal": 900}
+    out = []
+    for i in range(n):
+        nut = {}
+        for c in vs.NUTRIENT_COLS:
+            r = rnd.random()
+            if r < missing:
+                nut[c] = None
+            elif r < missing + 0.1:
+                nut[c] = float(rnd.choice(EDGES[c]))
+            else:
+                nut[c] = round(rnd.uniform(0, hi[c]), 2)
+        out.append({"name": f"item {i}", "brand": "", "category": rnd.choice(CATEGORIES),
+                    "allergens": [], "nutrition_100g": nut})
+    return out
+
+
+def bench(n: int, requests: int = 20, scalar_max: int = 100_000):
+    catalog = synth_catalog(n)
+    t0 = time.perf_counter()
+    idx = CatalogIndex(catalog, server._bucket_of)
+    build = time.perf_counter() - t0
+    pos = idx.candidates("snack")
+
+    t0 = time.perf_counter()
+    for _ in range(requests):
+        idx.top(pos, 50, True, False)
+    vec_ms = (time.perf_counter() - t0) / requests * 1000
+
+    scalar_ms = None
+    if n <= scalar_max:
+        t0 = time.perf_counter()
+        for _ in range(max(1, requests // 10)):
+            scored = [(server._score_item(idx.item(i), {}, goals_text="tăng cơ"), i) for i in pos]
+            scored.sort(key=lambda x: x[0][0], reverse=True)
+        scalar_ms = (time.perf_counter() - t0) / max(1, requests // 10) * 1000
+
+    print(f"{n:>9,} items | bucket snack {len(pos):>8,} | build {build:6.2f} s | vector {vec_ms:8.2f} ms/req"
+          + (f" | scalar {scalar_ms:9.2f} ms/req (x{scalar_ms / vec_ms:.0f})" if scalar_ms else ""))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark chấm điểm đề xuất (NumPy vs scalar)")
+    ap.add_argument("--sizes", default="10000,100000,1000000")
+    ap.add_argument("--requests", type=int, default=20)
+    ap.add_argument("--scalar-max", type=int, default=100_000, help="không chạy bản scalar trên catalog lớn hơn")
+    args = ap.parse_args()
+    for n in (int(x) for x in args.sizes.split(",")):
+        bench(n, args.requests, args.scalar_max)
+
+
+if __name__ == "__main__":
+    main()
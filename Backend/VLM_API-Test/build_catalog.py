@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+build_catalog.py
+- Biên dịch catalog JSON (định dạng OFF hoặc health_catalog.json cũ) thành snapshot cột mmap (catalog_snapshot)
+- Nhận cả dump OFF đầy đủ (.jsonl / .csv, có thể .gz): nạp theo luồng bằng off_ingest (lọc quốc gia, nhiều process),
+  cùng lượt ghi catalog JSON đã chuẩn hoá (--json-out, mặc định cạnh snapshot) và dựng snapshot, không giữ cả dump
+  trong RAM; nguồn của snapshot là file JSON đó (+ bộ lọc) → đặt CATALOG_PATH trỏ tới nó
+- server.py tự dùng Data/catalog.snap (hoặc CATALOG_SNAPSHOT) khi snapshot dựng từ đúng CATALOG_PATH (đường dẫn, size, sha256)
+
+    python build_catalog.py "Data/off_vn_no_nulls (1).json"
+    python build_catalog.py Data/health_catalog.json --out /srv/healthscan/catalog.snap
+    python build_catalog.py openfoodfacts-products.jsonl.gz --country vietnam --workers 8
+    # → Data/catalog.snap + Data/catalog.json; chạy server với CATALOG_PATH=Data/catalog.json
+"""
+import argparse
+import time
+from pathlib import Path
+
+from catalog_loader import load_catalog
+from catalog_snapshot import CatalogSnapshot, build_snapshot
+from off_ingest import country_tag, ingest, is_dump, tee_json_array
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Biên dịch catalog JSON → snapshot cột mmap")
+    ap.add_argument("src", help="file catalog JSON (OFF hoặc định dạng cũ) hoặc dump OFF .jsonl/.csv(.gz)")
+    ap.add_argument("--out", default=str(BASE_DIR / "Data" / "catalog.snap"), help="thư mục snapshot")
+    ap.add_argument("--country", default=None, help="(dump) lọc theo countries_tags, vd. vietnam")
+    ap.add_argument("--workers", type=int, default=None, help="(dump) số process chuẩn hoá, mặc định = số CPU")
+    ap.add_argument("--json-out", default=None, help="(dump) catalog JSON đã chuẩn hoá, mặc định <out>.json")
+    ap.add_argument("--verify", action="store_true", help="đọc lại snapshot, so từng bản ghi với nguồn")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    if is_dump(args.src):
+        # dump → JSON chuẩn hoá + snapshot trong cùng một lượt đọc; server đọc lại được JSON này khi cần (fallback)
+        source = Path(args.json_out or Path(args.out).with_suffix(".json"))
+        source_filter = {"dump": str(Path(args.src).resolve()),
+                         "country": country_tag(args.country) if args.country else None}
+        meta = build_snapshot(tee_json_array(ingest(args.src, args.country, args.workers), source), args.out,
+                              source=source, source_filter=source_filter)
+        print(f"[INFO] Normalized catalog → {source} (set CATALOG_PATH={source})")
+    else:
+        source = args.src
+        meta = build_snapshot(load_catalog(source), args.out, source=source)
+    t1 = time.perf_counter()
+    snap = CatalogSnapshot(args.out)
+    size = sum(f.stat().st_size for f in Path(args.out).iterdir())
+    print(f"[INFO] {meta['n']} items, {len(meta['categories'])} categories → {args.out} ({size / 1e6:.1f} MB); "
+          f"build {t1 - t0:.2f} s, open {snap.open_s * 1000:.1f} ms")
+    if args.verify:
+        items = load_catalog(source)
+        mismatch = abs(len(items) - len(snap)) + sum(snap[i] != items[i] for i in range(min(len(items), len(snap))))
+        if mismatch:
+            raise SystemExit(f"[ERROR] {mismatch} items differ after round-trip")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+catalog_index.py
+- Chỉ mục catalog dựng một lần lúc nạp: nhóm sản phẩm theo bucket, tính sẵn bucket / Nutri-Score / natri (mg)
+- _recommend_core chỉ duyệt các mục cùng bucket, không gọi lại _bucket_of / _nutriscore cho từng sản phẩm mỗi request
+- nutrition_100g giữ dạng cột NumPy (vector_scoring) → chấm điểm cả bucket bằng vài phép toán mảng
+- Chất gây dị ứng: bitset theo mã chuẩn (allergen_index) → loại dị ứng bằng vài phép OR / ANDNOT
+- Cửa hàng (store_index, nếu truyền): danh sách cửa hàng của từng item nhớ theo vị trí → gắn cửa hàng O(1)
+- Nguồn là list dict (JSON) hoặc CatalogSnapshot (mmap): cột lấy thẳng từ snapshot, bản ghi __slots__
+  chỉ dựng cho các mục được trả về
+"""
+import time
+
+import numpy as np
+
+import vector_scoring as vs
+from allergen_index import AllergenIndex
+
+
+class CatalogEntry:
+    __slots__ = ("pos", "item", "bucket", "ns_grade", "ns_points", "sodium_mg")
+
+    def __init__(self, pos: int, item: dict, bucket: str, ns_grade: str, ns_points: int, sodium_mg):
+        self.pos = pos
+        self.item = item
+        self.bucket = bucket
+        self.ns_grade = ns_grade
+        self.ns_points = ns_points
+        self.sodium_mg = sodium_mg        # int | None
+
+    @property
+    def nutriscore(self) -> dict:
+        return {"grade": self.ns_grade, "points": self.ns_points}
+
+
+def _encode_categories(items):
+    vocab, codes = {}, np.empty(len(items), dtype=np.int32)
+    for i, it in enumerate(items):
+        codes[i] = vocab.setdefault(it.get("category") or "", len(vocab))
+    return list(vocab), codes
+
+
+class CatalogIndex:
+    def __init__(self, catalog, bucket_of, stores=None):
+        """catalog: list dict hoặc CatalogSnapshot; bucket_of(category) -> tên bucket; stores: StoreIndex (tuỳ chọn)."""
+        t0 = time.perf_counter()
+        self.catalog = catalog
+        self.stores = stores
+        self._stores_memo = {}     # (vị trí item, topn) → danh sách cửa hàng (StoreIndex.ranked)
+        if hasattr(catalog, "cols"):
+            self.cols, categories, codes = catalog.cols, catalog.categories, catalog.category_codes
+        else:
+            self.cols = vs.columns(catalog)
+            categories, codes = _encode_categories(catalog)
+
+        # bucket tính trên từ điển category (vài chục giá trị), rồi trải ra theo mã
+        self.bucket_names = sorted({bucket_of(c) for c in categories})
+        cat_bucket = np.array([self.bucket_names.index(bucket_of(c)) for c in categories] or [0], dtype=np.int16)
+        self.bucket_ids = cat_bucket[np.asarray(codes)] if len(codes) else np.empty(0, dtype=np.int16)
+        bid = {b: i for i, b in enumerate(self.bucket_names)}
+        self.is_snack = self.bucket_ids == bid.get("snack", -1)
+        self.ns_points, self.ns_grades = vs.nutriscore_columns(self.cols, self.bucket_ids == bid.get("beverage", -1))
+        self.by_bucket = {b: ix for b, ix in ((b, np.flatnonzero(self.bucket_ids == i))
+                                              for b, i in bid.items()) if len(ix)}
+        self._all = np.arange(len(catalog), dtype=np.int64)
+        # snapshot: bitset dị ứng đã lưu sẵn (mmap); JSON (hoặc snapshot cũ): dựng từ từng dòng
+        self.allergens = catalog.allergen_index() if hasattr(catalog, "allergen_index") else None
+        if self.allergens is None:
+            self.allergens = AllergenIndex.from_values((self.field(i, "allergens") for i in range(len(catalog))),
+                                                       len(catalog))
+        self.build_s = time.perf_counter() - t0
+        print(f"[INFO] Catalog index: {len(catalog)} items, {len(self.by_bucket)} buckets "
+              f"in {self.build_s * 1000:.1f} ms")
+
+    def __len__(self):
+        return len(self._all)
+
+    def item(self, i) -> dict:
+        return self.catalog[int(i)]
+
+    def field(self, i, name: str):
+        """Một trường của item i mà không dựng cả bản ghi (snapshot)."""
+        if hasattr(self.catalog, "field"):
+            return self.catalog.field(int(i), name)
+        return self.catalog[int(i)].get(name)
+
+    def entry(self, i) -> CatalogEntry:
+        i = int(i)
+        na = self.cols["sodium_g"][i]
+        return CatalogEntry(i, self.item(i), self.bucket_names[self.bucket_ids[i]], vs.GRADES[self.ns_grades[i]],
+                            int(self.ns_points[i]), None if np.isnan(na) else int(round(float(na) * 1000)))
+
+    def stores_for(self, i, topn: int = 3) -> list:
+        """Cửa hàng bán item i (tối đa topn); tính một lần cho mỗi item rồi nhớ lại."""
+        key = (int(i), topn)
+        hit = self._stores_memo.get(key)
+        if hit is None:
+            hit = self._stores_memo[key] = (self.stores.ranked(self.field(key[0], "brand"), self.field(key[0], "category"), topn)
+                                            if self.stores is not None else [])
+        return [dict(d) for d in hit]
+
+    def candidates(self, bucket: str) -> np.ndarray:
+        """Vị trí các mục cùng bucket (giữ thứ tự catalog); bucket rỗng → toàn bộ catalog như trước."""
+        pos = self.by_bucket.get(bucket)
+        return pos if pos is not None else self._all
+
+    def top(self, pos: np.ndarray, k: int, protein_goal: bool, fiber_goal: bool) -> list:
+        """k mục điểm cao nhất trong pos → [(điểm, CatalogEntry)], giảm dần."""
+        scores = vs.score_columns(self.cols, pos, protein_goal, fiber_goal, self.is_snack)
+        return [(float(scores[j]), self.entry(pos[j])) for j in vs.top_k(scores, k)]
+
+    def stats(self) -> dict:
+        return {"items": len(self), "build_ms": round(self.build_s * 1000, 1),
+                "source": "snapshot" if hasattr(self.catalog, "cols") else "json",
+                "buckets": {b: len(ix) for b, ix in sorted(self.by_bucket.items())},
+                "allergens": self.allergens.stats()}
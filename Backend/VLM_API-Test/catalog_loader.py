@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+catalog_loader.py
+- Chuẩn hoá catalog sản phẩm (định dạng OFF và health_catalog.json cũ) về một dạng bản ghi chung:
+  {barcode, name, brand, category, countries, allergens, additives, ingredients_text, nutrition_100g, image}
+- Tách khỏi server.py để dùng được ở công cụ offline (build_catalog.py) mà không import Flask/Gemini
+"""
+import json
+import re
+from pathlib import Path
+
+MIN_KNOWN_NUTRIENTS = 3   # bỏ sản phẩm có ít hơn 3 chỉ tiêu dinh dưỡng đã biết
+
+
+def to_float(x):
+    try:
+        if x is None: return None
+        return float(str(x).replace(",", ".").strip())
+    except Exception:
+        return None
+
+def off_extract_nutrition(n: dict):
+    def _num(x):
+        try:
+            return float(str(x).replace(",", "."))
+        except Exception:
+            return None
+    def get(key):
+        for k in (f"{key}_100g", key, f"{key}-100g", f"{key}_value"):
+            if k in n and n[k] is not None:
+                return _num(n[k])
+        return None
+
+    sugars = get("sugars")
+    salt   = get("salt")
+    sodium = get("sodium")
+    prot   = get("proteins")
+    satfat = get("saturated-fat")
+    kcal   = get("energy-kcal")
+    fiber  = get("fiber")
+    carbs  = get("carbohydrates")
+    fat    = get("fat")
+
+    if sodium is None and salt is not None:
+        sodium = salt * 0.393  # g Na ≈ g muối * 0.393
+
+    return {
+        "sugars_g": sugars,
+        "carbs_g": carbs,
+        "sodium_g": sodium,
+        "salt_g": salt,
+        "satfat_g": satfat,
+        "protein_g": prot,
+        "fat_g": fat,
+        "fiber_g": fiber,
+        "energy_kcal": kcal,
+    }
+
+def pick_image(it: dict):
+    img = it.get("image_url") or it.get("image_front_url") or it.get("image_nutrition_url")
+    if not img:
+        sel = it.get("selected_images") or {}
+        front = sel.get("front") or {}
+        img = front.get("display") or front.get("small") or front.get("thumb")
+    return img
+
+def pick_category_value(it: dict):
+    cat = (it.get("category") or "").strip()
+    if not cat:
+        tags = it.get("categories_tags") or []
+        if tags:
+            last = str(tags[-1])
+            cat = last.split(":", 1)[-1]
+    return (cat or "").lower().strip()
+
+def _enough_nutrients(norm: dict) -> bool:
+    return sum(v is not None for v in norm.values()) >= MIN_KNOWN_NUTRIENTS
+
+def normalize_off_item(it):
+    """Một bản ghi OFF → bản ghi catalog, hoặc None nếu bị loại."""
+    if not isinstance(it, dict):
+        return None
+    name  = (it.get("name")  or "").strip()
+    brand = (it.get("brand") or "").strip()
+    if not (name or brand):
+        return None
+    norm = off_extract_nutrition(it.get("nutrition") or {})
+    if not _enough_nutrients(norm):
+        return None
+    return {
+        "barcode": it.get("barcode"),        # giữ nội bộ
+        "name": name,
+        "brand": brand,
+        "category": pick_category_value(it),
+        "countries": [str(x).split(":")[-1] for x in (it.get("countries_tags") or [])],
+        "allergens": it.get("allergens") or [],
+        "additives": it.get("additives") or [],
+        "ingredients_text": it.get("ingredients_text"),
+        "nutrition_100g": norm,
+        "image": pick_image(it),
+    }
+
+def normalize_old_item(it):
+    """Một bản ghi health_catalog.json cũ → bản ghi catalog, hoặc None nếu bị loại."""
+    if not it or not isinstance(it, dict):
+        return None
+    if it.get("eligible") is False:
+        return None
+    name = (it.get("name") or "").strip()
+    brand = (it.get("brand") or "").strip()
+    if not (name or brand):
+        return None
+    nut = (it.get("nutrition_100g") or {})
+    norm = {
+        "sugars_g":  to_float(nut.get("sugars_g")),
+        "carbs_g":   to_float(nut.get("carbs_g")),
+        "sodium_g":  to_float(nut.get("sodium_g")),
+        "salt_g":    to_float(nut.get("salt_g")),
+        "satfat_g":  to_float(nut.get("satfat_g")),
+        "protein_g": to_float(nut.get("protein_g")),
+        "fat_g":     to_float(nut.get("fat_g")),
+        "fiber_g":   to_float(nut.get("fiber_g")),
+        "energy_kcal": to_float(nut.get("energy_kcal")),
+    }
+    if not _enough_nutrients(norm):
+        return None
+    return {
+        "barcode": it.get("barcode"),
+        "name": name,
+        "brand": brand,
+        "category": (it.get("category") or "").lower().strip(),
+        "countries": it.get("countries") or [],
+        "allergens": it.get("allergens") or [],
+        "additives": it.get("additives") or [],
+        "ingredients_text": it.get("ingredients_text"),
+        "nutrition_100g": norm,
+        "image": it.get("image"),
+    }
+
+def looks_old_format(it) -> bool:
+    return isinstance(it, dict) and ("nutrition_100g" in it or "eligible" in it)
+
+def load_catalog_off_format(raw_list):
+    out = [x for x in map(normalize_off_item, raw_list) if x is not None]
+    print(f"[INFO] Catalog(OFF) loaded: {len(out)} items")
+    return out
+
+def load_catalog_old_format(raw_list):
+    out = [x for x in map(normalize_old_item, raw_list) if x is not None]
+    print(f"[INFO] Catalog(old) loaded: {len(out)} items")
+    return out
+
+def load_catalog(path: str):
+    p = Path(path)
+    if not p.exists():
+        print(f"[WARN] Catalog not found at {p.resolve()}")
+        return []
+    from off_ingest import is_dump   # tránh import vòng (off_ingest dùng normalize_off_item)
+    if is_dump(p):
+        print(f"[WARN] {p} is a raw OFF dump; build it first (python build_catalog.py) and point CATALOG_PATH "
+              f"at the normalized JSON it writes. Empty catalog returned.")
+        return []
+    raw = json.loads(p.read_text("utf-8"))
+
+    if isinstance(raw, list) and raw:
+        if looks_old_format(raw[0]):
+            return load_catalog_old_format(raw)
+        return load_catalog_off_format(raw)
+
+    print("[WARN] Catalog file is not a list. Empty catalog returned.")
+    return []
+
+def norm_barcode(code) -> str:
+    """Chỉ giữ chữ số, bỏ số 0 đầu (UPC-A 12 số ≡ EAN-13 có '0' đầu)."""
+    return re.sub(r"\D", "", str(code or "")).lstrip("0")
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+catalog_snapshot.py
+- Snapshot catalog dạng cột, biên dịch offline (build_catalog.py) và mở bằng mmap chỉ đọc khi khởi động:
+  không json.loads / chuẩn hoá lại từng item, các worker cùng máy dùng chung trang bộ nhớ của page cache
+- Một thư mục <tên>.snap/:
+    meta.json             phiên bản định dạng, số item, nguồn (đường dẫn, mtime, size, sha256), từ điển category
+    num_<cột>.npy         nutrition_100g, float64, NaN = thiếu
+    category.npy          mã category (int32) → meta["categories"]
+    str_<trường>.bin/.npy bảng chuỗi: JSON của từng giá trị nối liền (utf-8) + offset int64 (n+1)
+    barcode_keys.npy      mã vạch đã chuẩn hoá (bytes, đã sắp xếp) + barcode_pos.npy → vị trí item
+    allergen_bits.npy     bitset dị ứng (uint8, một hàng packbits mỗi mã chuẩn) → meta["allergens"] (mã, tag gốc)
+- Ghi vào thư mục tạm rồi đổi tên → bên đọc không bao giờ thấy snapshot ghi dở
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import time
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from allergen_index import AllergenIndex
+from catalog_loader import norm_barcode
+
+FORMAT_VERSION = 1
+NUM_COLS = ("sugars_g", "carbs_g", "sodium_g", "salt_g", "satfat_g", "protein_g", "fat_g", "fiber_g", "energy_kcal")
+STR_FIELDS = ("barcode", "name", "brand", "countries", "allergens", "additives", "ingredients_text", "image")
+
+
+def is_snapshot(path) -> bool:
+    return (Path(path) / "meta.json").is_file()
+
+
+def _sha256_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _source_meta(source, with_hash: bool = True):
+    if not source or not Path(source).is_file():
+        return None
+    st = Path(source).stat()
+    out = {"path": str(Path(source).resolve()), "mtime": st.st_mtime, "size": st.st_size}
+    if with_hash:
+        out["sha256"] = _sha256_file(source)
+    return out
+
+
+def build_snapshot(items, out_dir, source=None, source_filter: dict = None) -> dict:
+    """items: iterable bản ghi catalog đã chuẩn hoá (catalog_loader / off_ingest), duyệt MỘT lượt → bộ nhớ chỉ
+    giữ các cột (không giữ list dict). source_filter: điều kiện lọc khi dựng (vd. quốc gia), ghi vào meta.
+    Trả về meta đã ghi."""
+    out_dir = Path(out_dir)
+    tmp = out_dir.with_name(f"{out_dir.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    nums = {c: array("d") for c in NUM_COLS}
+    codes, vocab, barcodes, allergen_vals, seen_allergens = array("i"), {}, [], [], {}
+    str_fh = {f: open(tmp / f"str_{f}.bin", "wb") for f in STR_FIELDS}
+    str_offs = {f: array("q", [0]) for f in STR_FIELDS}
+    n = 0
+    try:
+        for it in items:
+            nut = it.get("nutrition_100g") or {}
+            for c in NUM_COLS:
+                v = nut.get(c)
+                nums[c].append(np.nan if v is None else v)
+            codes.append(vocab.setdefault(it.get("category") or "", len(vocab)))
+            for f in STR_FIELDS:
+                b = json.dumps(it.get(f), ensure_ascii=False).encode("utf-8")
+                str_fh[f].write(b)
+                str_offs[f].append(str_offs[f][-1] + len(b))
+            barcodes.append(norm_barcode(it.get("barcode")).encode("ascii"))
+            al = it.get("allergens")
+            al = al if isinstance(al, str) or al is None else tuple(al)
+            allergen_vals.append(seen_allergens.setdefault(al, al))   # giá trị lặp lại → dùng chung một object
+            n += 1
+    finally:
+        for fh in str_fh.values():
+            fh.close()
+
+    for c in NUM_COLS:
+        np.save(tmp / f"num_{c}.npy", np.frombuffer(nums[c], dtype=np.float64) if n else np.empty(0))
+    np.save(tmp / "category.npy", np.frombuffer(codes, dtype=np.int32) if n else np.empty(0, dtype=np.int32))
+    for f in STR_FIELDS:
+        np.save(tmp / f"str_{f}.npy", np.frombuffer(str_offs[f], dtype=np.int64))
+
+    keys, first = np.unique(np.array(barcodes or [b""], dtype=bytes), return_index=True)
+    keep = keys != b""
+    np.save(tmp / "barcode_keys.npy", keys[keep])
+    np.save(tmp / "barcode_pos.npy", first[keep].astype(np.int64))
+
+    allergens = AllergenIndex.from_values(allergen_vals, n)
+    ids = sorted(allergens.bits)
+    np.save(tmp / "allergen_bits.npy", np.stack([allergens.bits[c] for c in ids]) if ids
+            else np.zeros((0, (n + 7) // 8), dtype=np.uint8))
+
+    meta = {"format": FORMAT_VERSION, "n": n, "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "source": _source_meta(source), "source_filter": source_filter or None, "categories": list(vocab),
+            "allergens": {"ids": ids, "raw_tags": allergens.raw_tags}}
+    (tmp / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), "utf-8")
+
+    old = out_dir.with_name(f"{out_dir.name}.old-{os.getpid()}")
+    if out_dir.exists():
+        out_dir.rename(old)
+    tmp.rename(out_dir)
+    shutil.rmtree(old, ignore_errors=True)
+    return meta
+
+
+class _StringTable:
+    def __init__(self, bin_path: Path, off_path: Path):
+        self.offs = np.load(off_path, mmap_mode="r")
+        with open(bin_path, "rb") as fh:
+            self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fh.fileno()).st_size else b""
+
+    def __getitem__(self, i):
+        a, b = int(self.offs[i]), int(self.offs[i + 1])
+        return json.loads(self._buf[a:b].decode("utf-8"))
+
+
+class CatalogSnapshot:
+    """Catalog chỉ đọc trên snapshot: len / [i] / iter trả về dict cùng dạng catalog_loader (dựng lười)."""
+
+    def __init__(self, path):
+        t0 = time.perf_counter()
+        self.path = Path(path)
+        self.meta = json.loads((self.path / "meta.json").read_text("utf-8"))
+        if self.meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"catalog snapshot format {self.meta.get('format')} != {FORMAT_VERSION}: {path}")
+        self.n = int(self.meta["n"])
+        self.cols = {c: np.load(self.path / f"num_{c}.npy", mmap_mode="r") for c in NUM_COLS}
+        self.category_codes = np.load(self.path / "category.npy", mmap_mode="r")
+        self.categories = self.meta["categories"]
+        self._str = {f: _StringTable(self.path / f"str_{f}.bin", self.path / f"str_{f}.npy") for f in STR_FIELDS}
+        self._bc_keys = np.load(self.path / "barcode_keys.npy", mmap_mode="r")
+        self._bc_pos = np.load(self.path / "barcode_pos.npy", mmap_mode="r")
+        self.open_s = time.perf_counter() - t0
+        print(f"[INFO] Catalog snapshot opened: {self.n} items in {self.open_s * 1000:.1f} ms ({self.path})")
+
+    def __len__(self):
+        return self.n
+
+    def field(self, i: int, name: str):
+        if name == "category":
+            return self.categories[self.category_codes[i]]
+        if name == "nutrition_100g":
+            return {c: (None if np.isnan(v) else float(v)) for c, v in ((c, self.cols[c][i]) for c in NUM_COLS)}
+        return self._str[name][i]
+
+    def __getitem__(self, i: int) -> dict:
+        if not -self.n <= i < self.n:
+            raise IndexError(i)
+        i %= self.n
+        return {f: self.field(i, f) for f in ("barcode", "name", "brand", "category", "countries", "allergens",
+                                              "additives", "ingredients_text", "nutrition_100g", "image")}
+
+    def __iter__(self):
+        return (self[i] for i in range(self.n))
+
+    def source_mismatch(self, source):
+        """Lý do snapshot không dựng từ đúng file `source` (đường dẫn / size / sha256 khác), hoặc None nếu khớp.
+        mtime đổi nhưng nội dung y hệt (copy, touch) vẫn coi là khớp."""
+        src = self.meta.get("source")
+        if not src:
+            return "snapshot has no recorded source"
+        cur = _source_meta(source, with_hash=False)
+        if cur is None:
+            return f"source not found: {source}"
+        if cur["path"] != src["path"]:
+            return f"built from {src['path']}, CATALOG_PATH is {cur['path']}"
+        if cur["size"] != src["size"]:
+            return "source size changed since build"
+        if cur["mtime"] != src["mtime"] and _sha256_file(source) != src.get("sha256"):
+            return "source content changed since build"
+        return None
+
+    def barcode_index(self):
+        return _SnapshotBarcodeIndex(self)
+
+    def allergen_index(self):
+        """AllergenIndex trên ma trận bitset mmap, hoặc None với snapshot dựng trước khi có allergen_bits.npy."""
+        al = self.meta.get("allergens")
+        if al is None or not (self.path / "allergen_bits.npy").is_file():
+            return None
+        mat = np.load(self.path / "allergen_bits.npy", mmap_mode="r")
+        return AllergenIndex({c: mat[j] for j, c in enumerate(al["ids"])}, al["raw_tags"], self.n)
+
+
+class _SnapshotBarcodeIndex:
+    """Cùng giao diện dict {mã vạch chuẩn hoá: item} của chế độ JSON (get / len), tra bằng searchsorted."""
+
+    def __init__(self, snap: CatalogSnapshot):
+        self._snap = snap
+
+    def __len__(self):
+        return len(self._snap._bc_keys)
+
+    def get(self, code: str, default=None):
+        keys = self._snap._bc_keys
+        key = str(code).encode("ascii", "ignore")
+        j = int(np.searchsorted(keys, key))
+        if j < len(keys) and keys[j] == key:
+            return self._snap[int(self._snap._bc_pos[j])]
+        return default
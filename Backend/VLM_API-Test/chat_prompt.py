@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+chat_prompt.py
+- Ghép prompt /chat theo ngân sách token thay vì gửi nguyên văn MAX_TURNS lượt gần nhất
+- Lịch sử được làm gọn: bỏ ảnh markdown ![](url), bảng, dòng trống thừa
+- Các lượt cũ hơn cửa sổ gần nhất được tóm tắt (trích xuất, không gọi LLM) thành "bộ nhớ" ngắn:
+  câu hỏi của người dùng, câu trả lời nhanh, tên sản phẩm đã gợi ý
+- Vượt ngân sách → bỏ bớt bộ nhớ cũ, rồi dồn lượt cũ nhất của cửa sổ vào bộ nhớ
+"""
+import math
+import re
+
+CHARS_PER_TOKEN = 3.0   # ước lượng thận trọng cho tiếng Việt có dấu (Gemini ~4 ký tự/token với tiếng Anh)
+
+_IMG_RE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+_TABLE_RE = re.compile(r"^\s*\|.*\|\s*$")
+_BLANKS_RE = re.compile(r"\n{3,}")
+_BOLD_NAME_RE = re.compile(r"^\s*\d+\.\s*\*\*(.+?)\*\*", re.M)
+_MD_RE = re.compile(r"[*_`>#]+")
+MEMORY_HEADER = "BỘ NHỚ HỘI THOẠI (tóm tắt các lượt trước):"
+RECENT_HEADER = "HỘI THOẠI GẦN NHẤT:"
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+def clean_turn_text(text: str) -> str:
+    """Bỏ ảnh markdown, dòng bảng và dòng trống thừa khỏi một lượt hội thoại."""
+    text = _IMG_RE.sub("", text or "")
+    lines = [l.rstrip() for l in text.splitlines() if not _TABLE_RE.match(l)]
+    return _BLANKS_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+def _clip(text: str, n: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= n else text[:n - 1].rstrip() + "…"
+
+
+def summarize_turn(turn: dict) -> str:
+    """Một dòng bộ nhớ cho một lượt cũ."""
+    text = turn.get("text") or ""
+    if turn.get("role") == "user":
+        return f"- Người dùng hỏi: {_clip(text, 140)}"
+    names = _BOLD_NAME_RE.findall(text)
+    if names:
+        return f"- Đã gợi ý: {_clip(', '.join(names), 200)}"
+    first = next((l for l in clean_turn_text(text).splitlines() if l.strip()), "")
+    return f"- Assistant: {_clip(_MD_RE.sub('', first), 180)}"
+
+
+def _format_turn(turn: dict) -> str:
+    who = "Người dùng" if turn.get("role") == "user" else "Assistant"
+    return f"{who}: {clean_turn_text(turn.get('text'))}"
+
+
+class ChatPromptBuilder:
+    def __init__(self, budget: int = 6000, window: int = 6, memory_max_tokens: int = 400,
+                 count_tokens=estimate_tokens):
+        self.budget = budget
+        self.window = window
+        self.memory_max_tokens = memory_max_tokens
+        self.count = count_tokens
+
+    def build(self, fixed_parts, history, question: str):
+        """
+        fixed_parts: các đoạn text cố định (system, hồ sơ, số liệu, ngưỡng) — giữ nguyên thứ tự.
+        history: các lượt trước câu hỏi hiện tại (cũ → mới).
+        Trả về (parts [{"text": ...}], usage).
+        """
+        q_text = f"CÂU HỎI HIỆN TẠI:\n{question}"
+        fixed_tokens = sum(self.count(t) for t in fixed_parts) + self.count(q_text)
+
+        recent = [(_format_turn(t), t) for t in history[-self.window:]] if self.window else []
+        older = list(history[:len(history) - len(recent)])
+        memory = [summarize_turn(t) for t in older]
+
+        def mem_tokens():
+            return self.count("\n".join(memory)) if memory else 0
+
+        def total():
+            hist = (self.count(RECENT_HEADER) + self.count("\n".join(x for x, _ in recent))) if recent else 0
+            return fixed_tokens + (self.count(MEMORY_HEADER) + mem_tokens() if memory else 0) + hist
+
+        # bộ nhớ có trần riêng: bỏ dòng cũ nhất trước
+        while memory and mem_tokens() > self.memory_max_tokens:
+            memory.pop(0)
+        # vượt tổng ngân sách: dồn lượt cũ nhất của cửa sổ vào bộ nhớ, rồi bỏ bớt bộ nhớ
+        while recent and total() > self.budget:
+            _, t = recent.pop(0)
+            older.append(t)
+            memory.append(summarize_turn(t))
+            while memory and (mem_tokens() > self.memory_max_tokens or total() > self.budget):
+                memory.pop(0)
+        while memory and total() > self.budget:
+            memory.pop(0)
+
+        parts = [{"text": t} for t in fixed_parts]
+        if memory:
+            parts += [{"text": MEMORY_HEADER}, {"text": "\n".join(memory)}]
+        if recent:
+            parts += [{"text": RECENT_HEADER}, {"text": "\n".join(x for x, _ in recent)}]
+        parts.append({"text": q_text})
+
+        prompt_tokens = sum(self.count(p["text"]) for p in parts)
+        usage = {"prompt_tokens": prompt_tokens, "budget": self.budget, "recent_turns": len(recent),
+                 "summarized_turns": len(older), "memory_lines": len(memory),
+                 "over_budget": prompt_tokens > self.budget}
+        return parts, usage
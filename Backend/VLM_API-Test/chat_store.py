@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+chat_store.py
+- Lịch sử chat theo chat_id, thay cho defaultdict(list) không giới hạn + ghi đè chat_<id>.json mỗi lượt
+- RAM: LRU tối đa max_sessions phiên, phiên không hoạt động quá idle_s bị đẩy ra, mỗi phiên giữ keep_turns lượt cuối
+- Đĩa: nhật ký append-only chat_<id>.jsonl (mỗi lượt một dòng, reset = một dòng đánh dấu);
+  phiên bị đẩy ra được nạp lại lười từ nhật ký khi chat_id quay lại (nhật ký được nén lại khi nạp nếu quá dài)
+- Khoá chung chỉ giữ khi sửa bảng phiên (LRU); đọc/ghi nhật ký chạy dưới khoá riêng của từng phiên
+  → I/O của một cuộc chat không chặn các cuộc chat khác
+- SharedChatStore: cùng API, lưu trên state_backend (SQLite/Redis) khi chạy nhiều worker
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+_SAFE_ID_RE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class _Session:
+    __slots__ = ("lock", "turns", "last")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = None        # deque các lượt; None = chưa nạp từ nhật ký
+        self.last = 0.0
+
+
+class ChatSessionStore:
+    def __init__(self, journal_dir: Path, max_sessions: int = 1000, idle_s: float = 3600,
+                 keep_turns: int = 24):
+        self.journal_dir = Path(journal_dir)
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        self.max_sessions = max_sessions
+        self.idle_s = idle_s
+        self.keep_turns = keep_turns
+        self._lock = threading.Lock()    # chỉ bảo vệ _sessions và bộ đếm, không giữ khi I/O
+        self._sessions = OrderedDict()   # chat_id -> _Session (LRU theo lần truy cập cuối)
+        self.rehydrated = self.evicted = self.appends = 0
+
+    def _path(self, chat_id: str) -> Path:
+        return self.journal_dir / f"chat_{_SAFE_ID_RE.sub('_', chat_id)}.jsonl"
+
+    # ---- nạp lại từ nhật ký ----
+    def _load(self, chat_id: str) -> deque:
+        turns = deque(maxlen=self.keep_turns)
+        p = self._path(chat_id)
+        if p.exists():
+            lines = 0
+            with open(p, "r", encoding="utf-8") as fp:
+                for line in fp:
+                    lines += 1
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue       # dòng cuối ghi dở khi crash
+                    if rec.get("reset"):
+                        turns.clear()
+                    else:
+                        turns.append(rec)
+            if lines > 4 * self.keep_turns:
+                self._compact(p, turns)
+        else:
+            legacy = self.journal_dir / f"chat_{_SAFE_ID_RE.sub('_', chat_id)}.json"
+            if legacy.exists():        # bản chụp kiểu cũ (ghi đè mỗi lượt)
+                try:
+                    turns.extend(json.loads(legacy.read_text("utf-8")).get("history") or [])
+                except Exception:
+                    pass
+        return turns
+
+    def _entry(self, chat_id: str) -> _Session:
+        """Lấy (tạo) mục phiên dưới _lock: chỉ cập nhật LRU và dọn phiên nhàn rỗi, không đụng đĩa."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(chat_id, None) or _Session()
+            entry.last = now
+            self._sessions[chat_id] = entry
+            while self._sessions:
+                first = next(iter(self._sessions.values()))
+                if len(self._sessions) <= self.max_sessions and now - first.last <= self.idle_s:
+                    break
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+        return entry
+
+    @contextmanager
+    def _session(self, chat_id: str):
+        """Giữ khoá riêng của phiên; lần đầu nạp lại từ nhật ký (I/O ngoài khoá chung)."""
+        entry = self._entry(chat_id)
+        with entry.lock:
+            if entry.turns is None:
+                entry.turns = self._load(chat_id)
+                if entry.turns:
+                    with self._lock:
+                        self.rehydrated += 1
+            yield entry.turns
+
+    @staticmethod
+    def _compact(p: Path, turns):
+        """Nhật ký quá dài so với phần còn dùng → ghi lại chỉ các lượt còn giữ (thay file nguyên tử)."""
+        tmp = p.with_suffix(".jsonl.tmp")
+        with open(tmp, "w", encoding="utf-8") as fp:
+            for rec in turns:
+                fp.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        tmp.replace(p)
+
+    def _journal(self, chat_id: str, rec: dict):
+        with open(self._path(chat_id), "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    # ---- API ----
+    def history(self, chat_id: str, last: int = None) -> list:
+        with self._session(chat_id) as turns:
+            turns = list(turns)
+        return turns[-last:] if last else turns
+
+    def append(self, chat_id: str, turn: dict):
+        with self._session(chat_id) as turns:
+            turns.append(turn)
+            self._journal(chat_id, turn)
+        with self._lock:
+            self.appends += 1
+
+    def reset(self, chat_id: str):
+        with self._session(chat_id) as turns:
+            turns.clear()
+            self._journal(chat_id, {"reset": True, "ts": time.time()})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"live_sessions": len(self._sessions), "max_sessions": self.max_sessions,
+                    "idle_s": self.idle_s, "keep_turns": self.keep_turns, "appends": self.appends,
+                    "rehydrated": self.rehydrated, "evicted": self.evicted, "journal_dir": str(self.journal_dir)}
+
+
+class SharedChatStore:
+    """Cùng API với ChatSessionStore nhưng lưu trên state backend dùng chung (SQLite/Redis) cho nhiều worker."""
+
+    NS = "chat"
+
+    def __init__(self, backend, keep_turns: int = 24, idle_s: float = 7 * 86400):
+        self.backend = backend
+        self.keep_turns = keep_turns
+        self.idle_s = idle_s
+        self.appends = 0
+
+    def history(self, chat_id: str, last: int = None) -> list:
+        return self.backend.lrange(self.NS, chat_id, last=min(last or self.keep_turns, self.keep_turns))
+
+    def append(self, chat_id: str, turn: dict):
+        self.backend.rpush(self.NS, chat_id, turn, max_len=self.keep_turns, ttl=self.idle_s)
+        self.appends += 1
+
+    def reset(self, chat_id: str):
+        self.backend.delete(self.NS, chat_id)
+
+    def stats(self) -> dict:
+        return {"backend": self.backend.kind, "keep_turns": self.keep_turns, "idle_s": self.idle_s,
+                "appends": self.appends}
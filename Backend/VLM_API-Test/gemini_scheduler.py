@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+gemini_scheduler.py
+- Bộ điều phối dùng chung cho mọi lời gọi Gemini (VLM_MODEL + LLM_MODEL) trong process
+- Token bucket theo requests/phút + giới hạn số lời gọi đồng thời
+- Hàng đợi ưu tiên: label (đọc nhãn) > advice > chat
+- Khi gặp 429: cả process cùng lùi (tôn trọng retry_delay của server, có jitter) thay vì mỗi thread tự ngủ
+- Dùng được từ cả thread (call/stream) lẫn asyncio (acall/astream) — chung bucket và hàng đợi
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+
+PRIORITIES = {"label": 0, "advice": 1, "chat": 2}
+_RETRY_DELAY_RE = re.compile(r"retry_delay\s*{\s*seconds:\s*(\d+)")
+
+
+def is_rate_limited(exc: Exception) -> bool:
+    msg = str(exc)
+    return "ResourceExhausted" in msg or "429" in msg or type(exc).__name__ == "ResourceExhausted"
+
+
+def retry_delay_of(exc: Exception):
+    m = _RETRY_DELAY_RE.search(str(exc))
+    return int(m.group(1)) if m else None
+
+
+class GeminiScheduler:
+    ASYNC_POLL_S = 0.05   # waiter asyncio không được notify qua Condition → kiểm tra lại định kỳ
+
+    def __init__(self, rpm: float = 60, max_concurrency: int = 4, burst: int = None,
+                 queue_timeout: float = 120.0, max_backoff: float = 60.0):
+        self.rate = max(rpm, 0.001) / 60.0           # token/giây
+        self.capacity = float(burst or max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_backoff = max_backoff
+
+        self._cond = threading.Condition()
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._blocked_until = 0.0                    # lùi toàn cục sau 429
+        self._inflight = 0
+        self._waiters = []                           # heap (priority, seq)
+        self._seq = itertools.count()
+        self._stats = {k: {"calls": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "rate_limited": 0, "timeouts": 0}
+                       for k in PRIORITIES}
+
+    # ---- token bucket ----
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _enqueue(self, kind: str):
+        me = (PRIORITIES[kind], next(self._seq))
+        heapq.heappush(self._waiters, me)
+        return me
+
+    def _dequeue(self, me):
+        self._waiters.remove(me)
+        heapq.heapify(self._waiters)
+        self._cond.notify_all()
+
+    def _try_take(self, me, kind: str, deadline: float):
+        """Gọi khi giữ _cond: (True, 0) nếu lấy được slot + token, ngược lại (False, số giây nên chờ)."""
+        now = time.monotonic()
+        if now >= deadline:
+            self._stats[kind]["timeouts"] += 1
+            raise RuntimeError("Gemini 429: Hết quota Free Tier/đang quá tải. Hãy bật billing hoặc giảm tần suất gọi.")
+        wait = deadline - now
+        if self._waiters[0] == me and self._inflight < self.max_concurrency:
+            if now < self._blocked_until:
+                wait = min(wait, self._blocked_until - now)
+            else:
+                self._refill(now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    self._inflight += 1
+                    return True, 0.0
+                wait = min(wait, (1.0 - self._tokens) / self.rate)
+        return False, wait
+
+    def _record_wait(self, kind: str, t0: float):
+        waited = (time.monotonic() - t0) * 1000.0
+        st = self._stats[kind]
+        st["calls"] += 1
+        st["wait_ms_total"] += waited
+        st["wait_ms_max"] = max(st["wait_ms_max"], waited)
+
+    def _acquire(self, kind: str):
+        t0 = time.monotonic()
+        deadline = t0 + self.queue_timeout
+        with self._cond:
+            me = self._enqueue(kind)
+            try:
+                while True:
+                    ok, wait = self._try_take(me, kind, deadline)
+                    if ok:
+                        break
+                    self._cond.wait(wait)
+            finally:
+                self._dequeue(me)
+            self._record_wait(kind, t0)
+
+    async def _aacquire(self, kind: str):
+        """Bản asyncio của _acquire: cùng hàng đợi ưu tiên, chờ bằng asyncio.sleep thay vì chiếm thread."""
+        t0 = time.monotonic()
+        deadline = t0 + self.queue_timeout
+        with self._cond:
+            me = self._enqueue(kind)
+        try:
+            while True:
+                with self._cond:
+                    ok, wait = self._try_take(me, kind, deadline)
+                    if ok:
+                        self._record_wait(kind, t0)
+                        return
+                await asyncio.sleep(min(wait, self.ASYNC_POLL_S))
+        finally:
+            with self._cond:
+                self._dequeue(me)
+
+    def _release(self):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def _penalize(self, kind: str, delay: float):
+        with self._cond:
+            self._stats[kind]["rate_limited"] += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = 0.0
+            self._cond.notify_all()
+
+    # ---- API ----
+    def call(self, fn, kind: str = "chat", tries: int = 4):
+        """Chạy fn() (một lời gọi generate_content) qua hàng đợi; tự thử lại khi bị 429."""
+        kind = kind if kind in PRIORITIES else "chat"
+        for i in range(tries):
+            self._acquire(kind)
+            try:
+                return fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self._penalize(kind, self._backoff_delay(i, e))
+            finally:
+                self._release()
+        raise RuntimeError("Gemini 429: Hết quota Free Tier/đang quá tải. Hãy bật billing hoặc giảm tần suất gọi.")
+
+    def stream(self, fn, kind: str = "chat", tries: int = 4):
+        """
+        Như call() nhưng fn() trả về iterator (generate_content(stream=True)); generator này giữ slot
+        đồng thời cho tới khi đọc hết/đóng stream. Chỉ thử lại khi 429 xảy ra trước chunk đầu tiên.
+        """
+        kind = kind if kind in PRIORITIES else "chat"
+        for i in range(tries):
+            self._acquire(kind)
+            started = False
+            try:
+                for chunk in fn():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or not is_rate_limited(e):
+                    raise
+                self._penalize(kind, self._backoff_delay(i, e))
+            finally:
+                self._release()
+        raise RuntimeError("Gemini 429: Hết quota Free Tier/đang quá tải. Hãy bật billing hoặc giảm tần suất gọi.")
+
+    async def acall(self, afn, kind: str = "chat", tries: int = 4):
+        """Như call() cho coroutine: await afn() (vd. generate_content_async)."""
+        kind = kind if kind in PRIORITIES else "chat"
+        for i in range(tries):
+            await self._aacquire(kind)
+            try:
+                return await afn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self._penalize(kind, self._backoff_delay(i, e))
+            finally:
+                self._release()
+        raise RuntimeError("Gemini 429: Hết quota Free Tier/đang quá tải. Hãy bật billing hoặc giảm tần suất gọi.")
+
+    async def astream(self, afn, kind: str = "chat", tries: int = 4):
+        """Như stream() cho async iterator: afn() là coroutine trả về async iterator các chunk."""
+        kind = kind if kind in PRIORITIES else "chat"
+        for i in range(tries):
+            await self._aacquire(kind)
+            started = False
+            try:
+                async for chunk in await afn():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or not is_rate_limited(e):
+                    raise
+                self._penalize(kind, self._backoff_delay(i, e))
+            finally:
+                self._release()
+        raise RuntimeError("Gemini 429: Hết quota Free Tier/đang quá tải. Hãy bật billing hoặc giảm tần suất gọi.")
+
+    def _backoff_delay(self, attempt: int, exc: Exception) -> float:
+        # full jitter trên backoff mũ, nhưng không sớm hơn retry_delay server yêu cầu
+        delay = random.uniform(0.5, 1.0) * min(self.max_backoff, 2 ** (attempt + 1))
+        server_delay = retry_delay_of(exc)
+        if server_delay:
+            delay = max(delay, min(server_delay, self.max_backoff) + random.uniform(0, 1))
+        return delay
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            depth = {k: 0 for k in PRIORITIES}
+            names = {v: k for k, v in PRIORITIES.items()}
+            for prio, _ in self._waiters:
+                depth[names[prio]] += 1
+            out = {
+                "rpm": round(self.rate * 60, 2), "max_concurrency": self.max_concurrency,
+                "inflight": self._inflight, "queue_depth": len(self._waiters), "queue_by_kind": depth,
+                "tokens": round(self._tokens, 2), "backoff_s": round(max(0.0, self._blocked_until - now), 2),
+                "by_kind": {},
+            }
+            for k, st in self._stats.items():
+                avg = st["wait_ms_total"] / st["calls"] if st["calls"] else 0.0
+                out["by_kind"][k] = {"calls": st["calls"], "wait_ms_avg": round(avg, 1),
+                                     "wait_ms_max": round(st["wait_ms_max"], 1),
+                                     "rate_limited": st["rate_limited"], "timeouts": st["timeouts"]}
+            return out
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+hot_reload.py
+- Giữ một giá trị dựng từ file (catalog + chỉ mục + cửa hàng) và dựng lại khi file nguồn đổi, không restart server
+- Dựng bản mới ngoài đường request (thread theo dõi / endpoint admin), xong mới đổi một tham chiếu duy nhất
+  → bên đọc lấy `.current` một lần và luôn thấy một bản nhất quán; request đang chạy giữ bản cũ tới khi xong
+- Phiên bản = băm (đường dẫn, mtime, size) của các file nguồn (+ epoch dùng chung nếu có)
+  → các worker nạp cùng file có cùng version
+- epoch(): giá trị trên state backend dùng chung; một worker đổi epoch (POST /admin/reload) → thread theo dõi
+  của các worker khác thấy chữ ký đổi và dựng lại ở lượt poll kế tiếp
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+
+class Loaded:
+    __slots__ = ("value", "version", "loaded_at", "load_s")
+
+    def __init__(self, value, version: str, load_s: float):
+        self.value = value
+        self.version = version
+        self.loaded_at = datetime.utcnow().isoformat(timespec="seconds")
+        self.load_s = load_s
+
+
+class HotReloader:
+    def __init__(self, name: str, build, watch_paths, poll_s: float = 0, epoch=None):
+        """build() -> giá trị mới; watch_paths() -> các file cần theo dõi (tính lại mỗi lần, file có thể chưa tồn tại);
+        epoch() (tuỳ chọn) -> giá trị JSON dùng chung giữa các worker, đổi = buộc dựng lại."""
+        self.name = name
+        self._build = build
+        self._watch_paths = watch_paths
+        self._epoch = epoch
+        self.poll_s = poll_s
+        self._lock = threading.Lock()          # một lần dựng tại một thời điểm
+        self._thread = None
+        self.reloads = 0
+        self.last_error = None
+        self._failed_sig = None                # file hỏng: không thử lại tới khi file đổi tiếp
+        sig = self._signature()
+        self.current = self._load(sig)
+        self._sig = sig
+
+    def _signature(self):
+        sig = []
+        for p in self._watch_paths():
+            try:
+                st = Path(p).stat()
+                sig.append((str(p), st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append((str(p), None, None))
+        if self._epoch is not None:
+            try:
+                sig.append(("epoch", self._epoch()))
+            except Exception as e:     # backend dùng chung lỗi → chỉ theo dõi file
+                print(f"[WARN] {self.name} epoch unavailable: {e}")
+                sig.append(("epoch", None))
+        return sig
+
+    def _load(self, sig) -> Loaded:
+        t0 = time.perf_counter()
+        value = self._build()
+        version = hashlib.sha1(json.dumps(sig).encode("utf-8")).hexdigest()[:12]
+        return Loaded(value, version, time.perf_counter() - t0)
+
+    def reload(self, force: bool = False) -> dict:
+        """Dựng lại nếu file nguồn đổi (hoặc force). Lỗi khi dựng → giữ bản cũ, ném lại lỗi."""
+        with self._lock:
+            sig = self._signature()
+            if not force and sig in (self._sig, self._failed_sig):
+                return {"reloaded": False, "version": self.current.version}
+            try:
+                loaded = self._load(sig)
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                self._failed_sig = sig
+                raise
+            old, self.current, self._sig = self.current, loaded, sig   # đổi tham chiếu: nguyên tử với bên đọc
+            self.reloads += 1
+            self.last_error = None
+        print(f"[INFO] {self.name} reloaded: {old.version} → {loaded.version} in {loaded.load_s * 1000:.0f} ms")
+        return {"reloaded": True, "version": loaded.version, "previous_version": old.version,
+                "load_ms": round(loaded.load_s * 1000, 1)}
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_s)
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"[WARN] {self.name} reload failed, keeping version {self.current.version}: {e}")
+
+    def start(self):
+        if self.poll_s > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name=f"{self.name}-watch", daemon=True)
+            self._thread.start()
+        return self
+
+    def stats(self) -> dict:
+        cur = self.current
+        return {"version": cur.version, "loaded_at": cur.loaded_at, "load_ms": round(cur.load_s * 1000, 1),
+                "reloads": self.reloads, "watch_s": self.poll_s, "last_error": self.last_error}
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+ingest.py
+- Nhận ảnh upload theo kiểu stream: đọc từng khối, băm sha256 tăng dần, spool vào SpooledTemporaryFile
+- Chặn kích thước tối đa và từ chối file không phải ảnh ngay từ vài byte đầu
+- Giải mã base64 tăng dần, kể cả khi ảnh nằm trong body JSON ({"image_base64": "..."})
+"""
+import base64
+import binascii
+import hashlib
+import json
+import re
+from tempfile import SpooledTemporaryFile
+
+CHUNK = 64 * 1024
+SNIFF_BYTES = 16
+
+_MAGIC = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+)
+_FTYP = {b"heic": "image/heic", b"heix": "image/heic", b"mif1": "image/heif", b"msf1": "image/heif", b"avif": "image/avif"}
+_WS_RE = re.compile(rb"\s+")
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_image_mime(head: bytes):
+    for sig, mime in _MAGIC:
+        if head.startswith(sig):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        return _FTYP.get(head[8:12])
+    return None
+
+
+class ImageUpload:
+    """Ảnh đã nhận: nội dung nằm trong spool (RAM nếu nhỏ, file tạm nếu lớn), kèm sha256/kích thước/mime."""
+
+    __slots__ = ("spool", "size", "sha256", "filename", "source", "mime")
+
+    def __init__(self, spool, size, sha256, filename, source, mime):
+        self.spool, self.size, self.sha256 = spool, size, sha256
+        self.filename, self.source, self.mime = filename, source, mime
+
+    @classmethod
+    def from_bytes(cls, data: bytes, filename, source, max_bytes: int, spool_max: int):
+        sink = ImageSink(max_bytes, spool_max)
+        sink.write(data)
+        return sink.finish(filename, source)
+
+    def open(self):
+        self.spool.seek(0)
+        return self.spool
+
+    def read(self) -> bytes:
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def close(self):
+        try:
+            self.spool.close()
+        except Exception:
+            pass
+
+
+class ImageSink:
+    """Đích ghi tăng dần: giới hạn kích thước, kiểm tra header, sha256, spool."""
+
+    def __init__(self, max_bytes: int, spool_max: int):
+        self.max_bytes = max_bytes
+        self._hash = hashlib.sha256()
+        self._spool = SpooledTemporaryFile(max_size=spool_max)
+        self._head = b""
+        self.size = 0
+        self.mime = None
+
+    def _fail(self, message, status):
+        self.close()
+        raise UploadError(message, status)
+
+    def close(self):
+        """Bỏ phần đã nhận (ảnh không dùng tới / lỗi); gọi nhiều lần không sao."""
+        self._spool.close()
+
+    def write(self, b: bytes):
+        if not b:
+            return
+        self.size += len(b)
+        if self.size > self.max_bytes:
+            self._fail(f"image too large (> {self.max_bytes} bytes)", 413)
+        if self.mime is None and len(self._head) < SNIFF_BYTES:
+            self._head += b[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self.mime = sniff_image_mime(self._head)
+                if self.mime is None:
+                    self._fail("unsupported or non-image upload", 415)
+        self._hash.update(b)
+        self._spool.write(b)
+
+    def finish(self, filename, source) -> ImageUpload:
+        if self.size == 0:
+            self._fail("empty image", 400)
+        if self.mime is None:
+            self.mime = sniff_image_mime(self._head)
+            if self.mime is None:
+                self._fail("unsupported or non-image upload", 415)
+        return ImageUpload(self._spool, self.size, self._hash.hexdigest(), filename, source, self.mime)
+
+
+class Base64Sink:
+    """Giải mã base64 theo từng khối 4 ký tự; bỏ tiền tố 'data:...;base64,' và khoảng trắng."""
+
+    def __init__(self, sink: ImageSink):
+        self.sink = sink
+        self._buf = b""
+        self._head = bytearray()   # gom vài byte đầu để nhận diện data URL
+        self._in_body = False
+
+    def write(self, text: bytes):
+        if not self._in_body:
+            self._head += text
+            if len(self._head) < 5:
+                return
+            if self._head[:5] == b"data:":
+                comma = self._head.find(b",")
+                if comma == -1:
+                    if len(self._head) > 512:
+                        raise UploadError("invalid data URL")
+                    return
+                text = bytes(self._head[comma + 1:])
+            else:
+                text = bytes(self._head)
+            self._in_body = True
+            self._head = bytearray()
+        data = self._buf + _WS_RE.sub(b"", text)
+        n = len(data) // 4 * 4
+        if n:
+            try:
+                self.sink.write(base64.b64decode(data[:n], validate=True))
+            except binascii.Error as e:
+                raise UploadError(f"invalid base64: {e}")
+        self._buf = data[n:]
+
+    def finish(self):
+        if not self._in_body:
+            head, self._head = bytes(self._head), bytearray()
+            if head.startswith(b"data:"):
+                raise UploadError("invalid data URL")
+            self._in_body = True
+            self.write(head)
+        if self._buf:
+            tail = self._buf + b"=" * (-len(self._buf) % 4)
+            self._buf = b""
+            try:
+                self.sink.write(base64.b64decode(tail, validate=True))
+            except binascii.Error as e:
+                raise UploadError(f"invalid base64: {e}")
+
+
+def read_file_stream(stream, sink: ImageSink, filename, source) -> ImageUpload:
+    while True:
+        chunk = stream.read(CHUNK)
+        if not chunk:
+            break
+        sink.write(chunk)
+    return sink.finish(filename, source)
+
+
+def read_json_with_image(stream, image_keys, sink: ImageSink, max_other_bytes: int = 1 << 20):
+    """
+    Quét body JSON theo stream. Giá trị của khoá ảnh cấp 1 (theo thứ tự image_keys, lấy khoá gặp đầu tiên)
+    được giải mã base64 thẳng vào sink; phần còn lại ghép thành JSON "khung" (ảnh thay bằng "").
+    Trả về (fields_dict, has_image).
+    """
+    skel = bytearray()
+    depth, in_str, esc, after_str, want_value = 0, False, False, False, False
+    cur = bytearray()
+    last_str = b""
+    keys = {k.encode() for k in image_keys}
+    b64, carry, has_image = None, b"", False
+
+    while True:
+        chunk = stream.read(CHUNK)
+        if not chunk:
+            break
+        i, n = 0, len(chunk)
+        while i < n:
+            if b64 is not None:
+                # Đường nhanh: đổ nguyên đoạn tới dấu " đóng vào bộ giải mã
+                j = chunk.find(b'"', i)
+                seg = carry + chunk[i:(j if j != -1 else n)]
+                carry = b""
+                if seg.endswith(b"\\"):
+                    seg, carry = seg[:-1], b"\\"
+                b64.write(seg.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b""))
+                if j == -1:
+                    break
+                b64.finish()
+                b64, has_image = None, True
+                skel += b'"'
+                i = j + 1
+                continue
+            c = chunk[i]
+            i += 1
+            skel.append(c)
+            if len(skel) > max_other_bytes:
+                raise UploadError("JSON body too large", 413)
+            if in_str:
+                if esc:
+                    esc = False
+                elif c == 0x5C:   # \
+                    esc = True
+                elif c == 0x22:   # "
+                    in_str, after_str, last_str = False, True, bytes(cur)
+                    continue
+                cur.append(c)
+                continue
+            if c in b" \t\r\n":
+                continue
+            if c == 0x22:
+                if want_value:
+                    want_value = False
+                    b64 = Base64Sink(sink)
+                else:
+                    in_str, cur = True, bytearray()
+                continue
+            if c == 0x3A:         # :
+                want_value = after_str and depth == 1 and last_str in keys and not has_image
+                after_str = False
+                continue
+            want_value = after_str = False
+            if c in b"{[":
+                depth += 1
+            elif c in b"}]":
+                depth -= 1
+
+    if b64 is not None:
+        raise UploadError("truncated JSON body")
+    try:
+        fields = json.loads(bytes(skel).decode("utf-8")) if skel.strip() else {}
+    except Exception as e:
+        raise UploadError(f"invalid JSON body: {e}")
+    if not isinstance(fields, dict):
+        fields = {}
+    return fields, has_image
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+label_jobs.py
+- Bảng job cho chế độ bất đồng bộ của /label/analyze
+- Worker pool riêng chạy lời gọi VLM; request HTTP chỉ nhận job id rồi trả về ngay
+- Bảng bị chặn kích thước (max_jobs) và job đã xong hết hạn sau ttl giây
+- on_change(snapshot) được gọi sau mỗi lần đổi trạng thái (vd. để chép sang state backend dùng chung)
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, CALLING_MODEL, PARSING, DONE, ERROR = "queued", "calling_model", "parsing", "done", "error"
+FINAL_STATES = (DONE, ERROR)
+
+
+class JobTableFull(Exception):
+    pass
+
+
+class JobTable:
+    def __init__(self, workers: int = 4, max_jobs: int = 500, ttl: float = 900.0, on_change=None):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.on_change = on_change
+        self._jobs = OrderedDict()  # id -> job dict, theo thứ tự tạo
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="label-job")
+
+    # ---- nội bộ ----
+    def _expire_locked(self, now: float):
+        for jid in [j for j, job in self._jobs.items()
+                    if job["state"] in FINAL_STATES and now - job["updated_at"] > self.ttl]:
+            self._jobs.pop(jid, None)
+        # Quá tải → bỏ job đã xong cũ nhất trước
+        while len(self._jobs) >= self.max_jobs:
+            victim = next((j for j, job in self._jobs.items() if job["state"] in FINAL_STATES), None)
+            if victim is None:
+                return False
+            self._jobs.pop(victim)
+        return True
+
+    def _set(self, jid: str, state: str, **fields):
+        with self._cond:
+            job = self._jobs.get(jid)
+            if job is None:
+                return
+            job.update(fields)
+            job["state"] = state
+            job["updated_at"] = time.time()
+            job["version"] += 1
+            self._cond.notify_all()
+            snap = dict(job)
+        self._notify(snap)
+
+    def _notify(self, snap: dict):
+        if self.on_change is not None:
+            try:
+                self.on_change(snap)
+            except Exception as e:
+                print(f"[WARN] job on_change failed: {e}")
+
+    def _run(self, jid: str, fn, args):
+        try:
+            payload, status = fn(*args, progress=lambda st: self._set(jid, st))
+            self._set(jid, DONE if payload.get("ok") else ERROR, result=payload, status=status)
+        except Exception as e:
+            self._set(jid, ERROR, result={"ok": False, "error": f"{type(e).__name__}: {e}"}, status=500)
+
+    # ---- API ----
+    def submit(self, fn, *args) -> dict:
+        """fn(*args, progress=cb) -> (payload, http_status); cb(state) báo tiến độ."""
+        now = time.time()
+        with self._cond:
+            if not self._expire_locked(now):
+                raise JobTableFull(f"job table full ({self.max_jobs} active jobs)")
+            jid = uuid.uuid4().hex
+            self._jobs[jid] = {"id": jid, "state": QUEUED, "created_at": now, "updated_at": now,
+                               "version": 0, "result": None, "status": None}
+            snap = dict(self._jobs[jid])
+        self._notify(snap)
+        self._pool.submit(self._run, jid, fn, args)
+        return snap
+
+    def get(self, jid: str):
+        with self._cond:
+            self._expire_locked(time.time())
+            job = self._jobs.get(jid)
+            return dict(job) if job else None
+
+    def wait(self, jid: str, after_version: int, timeout: float):
+        """Chờ tới khi job có version > after_version (hoặc hết timeout); trả snapshot hoặc None."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(jid)
+                if job is None or job["version"] > after_version:
+                    return dict(job) if job else None
+                left = deadline - time.time()
+                if left <= 0:
+                    return dict(job)
+                self._cond.wait(left)
+
+    def stats(self) -> dict:
+        with self._cond:
+            by_state = {}
+            for job in self._jobs.values():
+                by_state[job["state"]] = by_state.get(job["state"], 0) + 1
+            return {"jobs": len(self._jobs), "max_jobs": self.max_jobs, "ttl_s": self.ttl, "by_state": by_state}
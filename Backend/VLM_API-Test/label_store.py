@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+label_store.py
+- Kho nhãn đã trích xuất, khoá theo cache_key (sha256 ảnh gốc)
+- DirLabelStore: bố cục thư mục cũ (label_cache/<key>.json, tuỳ chọn .txt + bản sao có timestamp trong OUT_DIR)
+- SQLiteLabelStore: một file SQLite (WAL), giới hạn số lượng/tuổi với LRU, ghi nền theo lô;
+  có thể xuất song song ra bố cục thư mục cũ (export=DirLabelStore)
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from werkzeug.utils import secure_filename
+
+
+class DirLabelStore:
+    """Bố cục cũ: ghi đồng bộ, không bao giờ xoá."""
+
+    kind = "files"
+
+    def __init__(self, cache_dir: Path, out_dir: Path = None, render_txt=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.out_dir = Path(out_dir) if out_dir else None
+        self.render_txt = render_txt
+
+    def paths(self, key: str):
+        return self.cache_dir / f"{key}.json", self.cache_dir / f"{key}.txt"
+
+    def get(self, key: str):
+        p, _ = self.paths(key)
+        if not p.exists():
+            return None
+        with open(p, "r", encoding="utf-8") as fp:
+            return json.load(fp)
+
+    def _write(self, json_path: Path, txt_path: Path, label: dict):
+        with open(json_path, "w", encoding="utf-8") as fp:
+            json.dump(label, fp, ensure_ascii=False, indent=2)
+        if self.render_txt and txt_path is not None:
+            with open(txt_path, "w", encoding="utf-8") as fp:
+                fp.write(self.render_txt(label))
+
+    def put(self, key: str, label: dict, filename: str = None):
+        json_path, txt_path = self.paths(key)
+        self._write(json_path, txt_path, label)
+        out = self.describe(key)
+        out["cache_json"] = str(json_path)
+        if self.out_dir is not None:
+            ts = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            base_stem = Path(secure_filename(filename or "upload")).stem or "upload"
+            prefix = f"{ts}_{base_stem}"
+            out["json"] = str(self.out_dir / f"{prefix}.json")
+            txt = self.out_dir / f"{prefix}.txt"
+            if self.render_txt:
+                out["txt"] = str(txt)
+            self._write(Path(out["json"]), txt, label)
+        return out
+
+    def describe(self, key: str):
+        json_path, txt_path = self.paths(key)
+        out = {"json": str(json_path)}
+        if self.render_txt:
+            out["txt"] = str(txt_path)
+        return out
+
+    def iter_items(self):
+        for p in self.cache_dir.glob("*.json"):
+            try:
+                yield p.stem, json.loads(p.read_text("utf-8")), p.stat().st_mtime
+            except Exception:
+                continue
+
+    def stats(self):
+        return {"kind": self.kind, "dir": str(self.cache_dir)}
+
+    def close(self):
+        pass
+
+
+class SQLiteLabelStore:
+    """
+    Một file SQLite (WAL). put() chỉ đưa vào hàng đợi; thread nền ghi theo lô,
+    cập nhật thời điểm truy cập (LRU) và xoá bản ghi quá max_items / max_age_s.
+    on_evict(keys) (tuỳ chọn) được gọi từ thread ghi sau mỗi lần xoá, vd. để dọn phash index.
+    Lô ghi lỗi (đĩa đầy, DB bị khoá quá timeout, ...) được rollback và ghi lại sau với backoff tăng dần
+    (tối đa max_backoff_s); nhãn vẫn nằm trong _pending (đọc được) cho tới khi commit thành công.
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, db_path: Path, max_items: int = 5000, max_age_s: float = 30 * 86400,
+                 export: DirLabelStore = None, flush_interval: float = 0.5, batch_size: int = 64,
+                 import_from: DirLabelStore = None, max_backoff_s: float = 30.0):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_items = max_items
+        self.max_age_s = max_age_s
+        self.export = export
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_backoff_s = max_backoff_s
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}      # key -> label chưa flush (đọc được ngay)
+        self._touched = {}      # key -> accessed_at chờ ghi
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self.hits = self.misses = self.writes = self.evicted = self.flush_failures = 0
+        self.last_flush_error = None
+        self.on_evict = None
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS labels (
+                          key TEXT PRIMARY KEY, label TEXT NOT NULL,
+                          created_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS labels_accessed ON labels(accessed_at)")
+        conn.commit()
+        if import_from is not None and self._count(conn) == 0:
+            self._import(conn, import_from)
+
+        self._writer = threading.Thread(target=self._writer_loop, name="label-store-writer", daemon=True)
+        self._writer.start()
+
+    # ---- kết nối theo thread ----
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _count(conn):
+        return conn.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+
+    def _import(self, conn, src: DirLabelStore):
+        rows = [(k, json.dumps(lbl, ensure_ascii=False), ts, ts) for k, lbl, ts in src.iter_items()]
+        if rows:
+            conn.executemany("INSERT OR IGNORE INTO labels VALUES (?,?,?,?)", rows)
+            conn.commit()
+            print(f"[INFO] Label store: imported {len(rows)} labels from {src.cache_dir}")
+
+    # ---- API ----
+    def get(self, key: str):
+        with self._lock:
+            label = self._pending.get(key)
+            if label is not None:
+                self.hits += 1
+                return label
+        row = self._conn().execute("SELECT label, created_at FROM labels WHERE key=?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.max_age_s and now - row[1] > self.max_age_s):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._touched[key] = now
+        return json.loads(row[0])
+
+    def put(self, key: str, label: dict, filename: str = None):
+        with self._lock:
+            self._pending[key] = label
+        self._queue.put((key, label, filename))
+        return self.describe(key)
+
+    def describe(self, key: str):
+        out = {"store": self.kind, "db": str(self.db_path), "key": key}
+        if self.export is not None:
+            out.update(self.export.describe(key))
+        return out
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"kind": self.kind, "db": str(self.db_path), "items": self._count(self._conn()),
+                "pending": pending, "hits": self.hits, "misses": self.misses, "writes": self.writes,
+                "evicted": self.evicted, "flush_failures": self.flush_failures,
+                "last_flush_error": self.last_flush_error, "max_items": self.max_items, "max_age_s": self.max_age_s}
+
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        self._writer.join(timeout)
+
+    # ---- ghi nền ----
+    def _drain(self, block: bool):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait())
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _flush(self, conn, batch):
+        now = time.time()
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        try:
+            evicted, gone = self._write_batch(conn, batch, touched, now)
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                for k, ts in touched.items():       # giữ lượt truy cập mới hơn nếu đã có
+                    self._touched.setdefault(k, ts)
+            raise
+        with self._lock:
+            for k, lbl, _ in batch:
+                if self._pending.get(k) is lbl:
+                    self._pending.pop(k, None)
+            self.writes += len(batch)
+            self.evicted += evicted
+        if gone and self.on_evict is not None:
+            try:
+                self.on_evict(gone)
+            except Exception as e:
+                print(f"[WARN] Label evict hook failed: {e}")
+        if self.export is not None:
+            for k, lbl, filename in batch:
+                try:
+                    self.export.put(k, lbl, filename)
+                except Exception as e:
+                    print(f"[WARN] Label export failed for {k}: {e}")
+
+    def _write_batch(self, conn, batch, touched, now):
+        """Một transaction: ghi lô + lượt truy cập, xoá bản ghi quá tuổi / quá số lượng → (số xoá, keys)."""
+        if batch:
+            conn.executemany(
+                "INSERT INTO labels(key,label,created_at,accessed_at) VALUES (?,?,?,?) "
+                "ON CONFLICT(key) DO UPDATE SET label=excluded.label, accessed_at=excluded.accessed_at",
+                [(k, json.dumps(lbl, ensure_ascii=False), now, now) for k, lbl, _ in batch])
+        if touched:
+            conn.executemany("UPDATE labels SET accessed_at=? WHERE key=?", [(ts, k) for k, ts in touched.items()])
+        gone = []
+        if self.max_age_s:
+            gone += [k for (k,) in conn.execute("SELECT key FROM labels WHERE created_at < ?", (now - self.max_age_s,))]
+            conn.executemany("DELETE FROM labels WHERE key=?", [(k,) for k in gone])
+        if self.max_items:
+            over = self._count(conn) - self.max_items
+            if over > 0:
+                lru = [k for (k,) in conn.execute("SELECT key FROM labels ORDER BY accessed_at LIMIT ?", (over,))]
+                conn.executemany("DELETE FROM labels WHERE key=?", [(k,) for k in lru])
+                gone += lru
+        conn.commit()
+        return len(gone), gone
+
+    def _flush_failed(self, e, retry_in=None):
+        with self._lock:
+            self.flush_failures += 1
+            self.last_flush_error = f"{type(e).__name__}: {e}"
+        print(f"[WARN] Label store flush failed: {e}" + (f" — thử lại sau {retry_in:.1f}s" if retry_in else ""))
+
+    def _writer_loop(self):
+        conn = self._conn()
+        retry, delay = [], 0.0
+        while not self._stop.is_set():
+            if retry:
+                if self._stop.wait(delay):
+                    break
+                batch, retry = retry, []
+            else:
+                batch = self._drain(block=True)
+            if batch or self._touched:
+                try:
+                    self._flush(conn, batch)
+                    delay = 0.0
+                except Exception as e:
+                    retry = batch
+                    delay = min(max(2 * delay, self.flush_interval), self.max_backoff_s)
+                    self._flush_failed(e, delay)
+        # flush phần còn lại khi dừng (lô đang chờ thử lại trước)
+        while True:
+            batch, retry = retry or self._drain(block=False), []
+            if not batch:
+                break
+            try:
+                self._flush(conn, batch)
+            except Exception as e:
+                self._flush_failed(e)
+                break
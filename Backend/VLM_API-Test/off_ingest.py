@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+off_ingest.py
+- Nạp dump Open Food Facts đầy đủ (JSONL hoặc CSV/TSV, có thể .gz, nhiều GB) theo luồng:
+  đọc từng lô dòng → process pool parse + chuẩn hoá (catalog_loader.normalize_off_item) → ghi ra ngay
+- Lọc theo countries_tags và quy tắc "≥3 chỉ tiêu dinh dưỡng" ngay trong worker; số lô đang xử lý có trần
+  (2 × số worker) nên bộ nhớ không phụ thuộc kích thước dump
+- In tiến độ: số bản ghi đọc/giữ, MB đã đọc (nén), bản ghi/giây
+- Kết quả là mảng JSON các bản ghi đã chuẩn hoá: dùng trực tiếp làm CATALOG_PATH hoặc đưa vào build_catalog.py
+
+    python off_ingest.py openfoodfacts-products.jsonl.gz --country vietnam --out Data/off_vn.json
+    python off_ingest.py en.openfoodfacts.org.products.csv.gz --country vietnam --workers 8 --out Data/off_vn.json
+"""
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from catalog_loader import normalize_off_item
+
+BATCH_SIZE = 2000
+PROGRESS_EVERY_S = 5.0
+_NAME_KEYS = ("product_name", "product_name_vi", "product_name_en", "generic_name")
+
+
+def _tags(x):
+    if not x:
+        return []
+    if isinstance(x, str):
+        return [t.strip() for t in x.split(",") if t.strip()]
+    return list(x)
+
+
+def country_tag(country: str) -> str:
+    c = (country or "").strip().lower()
+    return c if ":" in c else f"en:{c}"
+
+
+def off_to_catalog_record(rec: dict) -> dict:
+    """Bản ghi OFF đầy đủ (JSONL: nutriments; CSV: cột *_100g) → dạng rút gọn mà normalize_off_item đọc."""
+    if "nutrition" in rec and ("name" in rec or "brand" in rec):
+        return rec   # đã là dạng rút gọn (như Data/off_vn_no_nulls.json)
+    name = next((rec[k] for k in _NAME_KEYS if rec.get(k)), "")
+    return {
+        "barcode": rec.get("code"),
+        "name": name,
+        "brand": rec.get("brands") or "",
+        "categories_tags": _tags(rec.get("categories_tags")),
+        "countries_tags": _tags(rec.get("countries_tags")),
+        "allergens": _tags(rec.get("allergens_tags") or rec.get("allergens")),
+        "additives": _tags(rec.get("additives_tags")),
+        "ingredients_text": rec.get("ingredients_text") or None,
+        "nutrition": rec.get("nutriments") if isinstance(rec.get("nutriments"), dict) else rec,
+        "image_url": rec.get("image_url") or rec.get("image_front_url"),
+        "selected_images": rec.get("selected_images") if isinstance(rec.get("selected_images"), dict) else None,
+    }
+
+
+def _normalize_batch(kind: str, header, lines, country):
+    """Chạy trong worker: → (bản ghi đã chuẩn hoá, số dòng lỗi)."""
+    out, bad = [], 0
+    for line in lines:
+        try:
+            rec = json.loads(line) if kind == "jsonl" else dict(zip(header, line))
+        except ValueError:
+            bad += 1
+            continue
+        if not isinstance(rec, dict):
+            bad += 1
+            continue
+        rec = off_to_catalog_record(rec)
+        if country and country not in _tags(rec.get("countries_tags")):
+            continue
+        item = normalize_off_item(rec)
+        if item is not None:
+            out.append(item)
+    return out, bad
+
+
+def _detect_kind(path: Path):
+    name = path.name.lower().removesuffix(".gz")
+    if name.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if name.endswith((".csv", ".tsv")):
+        return "csv"
+    return None
+
+
+def is_dump(path) -> bool:
+    return _detect_kind(Path(path)) is not None
+
+
+class _Reader:
+    """Đọc dump theo lô; bytes_read tính trên file gốc (đã nén) để ước lượng tiến độ."""
+
+    def __init__(self, path: Path, kind: str, batch_size: int):
+        self.kind = kind
+        self.batch_size = batch_size
+        self.total_bytes = path.stat().st_size
+        self._raw = open(path, "rb")
+        stream = gzip.GzipFile(fileobj=self._raw) if path.name.lower().endswith(".gz") else self._raw
+        self._text = io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+        self.header = None
+        if kind == "csv":
+            csv.field_size_limit(2 ** 31 - 1)
+            first = self._text.readline()
+            tsv = "\t" in first
+            self.header = first.rstrip("\r\n").split("\t" if tsv else ",")
+            self._rows = csv.reader(self._text, delimiter="\t" if tsv else ",",
+                                    quoting=csv.QUOTE_NONE if tsv else csv.QUOTE_MINIMAL)
+
+    @property
+    def bytes_read(self) -> int:
+        return self._raw.tell()
+
+    def batches(self):
+        src = self._rows if self.kind == "csv" else (l for l in self._text if l.strip())
+        batch = []
+        for x in src:
+            batch.append(x)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self):
+        self._text.close()
+        self._raw.close()
+
+
+def ingest(path, country: str = None, workers: int = None, batch_size: int = BATCH_SIZE, progress=True,
+           stats: dict = None):
+    """Generator các bản ghi catalog đã chuẩn hoá, theo thứ tự trong dump; stats (nếu truyền) được cập nhật tại chỗ."""
+    path = Path(path)
+    kind = _detect_kind(path)
+    if kind is None:
+        raise ValueError(f"Unknown dump format (expect .jsonl / .csv / .tsv, optionally .gz): {path}")
+    country = country_tag(country) if country else None
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    reader = _Reader(path, kind, batch_size)
+    stats = stats if stats is not None else {}
+    stats.update(records=0, kept=0, bad=0, bytes=0, elapsed_s=0.0)
+    t0 = last = time.perf_counter()
+
+    def report(final=False):
+        el = time.perf_counter() - t0
+        stats.update(bytes=reader.bytes_read, elapsed_s=round(el, 2))
+        if progress:
+            pct = 100.0 * stats["bytes"] / reader.total_bytes if reader.total_bytes else 100.0
+            print(f"[INFO] {'done' if final else 'ingest'}: {stats['records']:,} records ({pct:.1f}%, "
+                  f"{stats['bytes'] / 1e6:,.0f} MB), kept {stats['kept']:,}, bad {stats['bad']:,} | "
+                  f"{stats['records'] / max(el, 1e-9):,.0f} rec/s, {stats['bytes'] / 1e6 / max(el, 1e-9):.1f} MB/s",
+                  file=sys.stderr, flush=True)
+
+    def drain(result, n_in):
+        nonlocal last
+        items, bad = result
+        stats["records"] += n_in
+        stats["kept"] += len(items)
+        stats["bad"] += bad
+        if time.perf_counter() - last >= PROGRESS_EVERY_S:
+            last = time.perf_counter()
+            report()
+        return items
+
+    try:
+        if workers <= 1:
+            for batch in reader.batches():
+                yield from drain(_normalize_batch(kind, reader.header, batch, country), len(batch))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for batch in reader.batches():
+                    pending.append((pool.submit(_normalize_batch, kind, reader.header, batch, country), len(batch)))
+                    if len(pending) >= 2 * workers:   # trần bộ nhớ: chờ lô cũ nhất trước khi đọc thêm
+                        fut, n = pending.popleft()
+                        yield from drain(fut.result(), n)
+                while pending:
+                    fut, n = pending.popleft()
+                    yield from drain(fut.result(), n)
+    finally:
+        report(final=True)
+        reader.close()
+
+
+def tee_json_array(items, out_path):
+    """Ghi dần mảng JSON (không giữ cả danh sách trong RAM) và trả lại từng bản ghi cho bên dùng tiếp
+    (vd. build_snapshot cùng lượt); ghi file tạm, chỉ đổi tên khi đã duyệt hết."""
+    out_path = Path(out_path)
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    n = 0
+    with open(tmp, "w", encoding="utf-8") as fh:
+        fh.write("[")
+        for it in items:
+            fh.write(",\n" if n else "\n")
+            fh.write(json.dumps(it, ensure_ascii=False))
+            n += 1
+            yield it
+        fh.write("\n]\n")
+    os.replace(tmp, out_path)
+
+
+def write_json_array(items, out_path) -> int:
+    return sum(1 for _ in tee_json_array(items, out_path))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Nạp dump Open Food Facts (JSONL/CSV, .gz) → catalog JSON đã chuẩn hoá")
+    ap.add_argument("src", help="openfoodfacts-products.jsonl(.gz) hoặc en.openfoodfacts.org.products.csv(.gz)")
+    ap.add_argument("--out", required=True, help="file JSON kết quả (dùng làm CATALOG_PATH / build_catalog.py)")
+    ap.add_argument("--country", default=None, help="lọc theo countries_tags, vd. vietnam hoặc en:vietnam")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = ap.parse_args()
+    n = write_json_array(ingest(args.src, args.country, args.workers, args.batch_size), args.out)
+    print(f"[INFO] Wrote {n} items → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
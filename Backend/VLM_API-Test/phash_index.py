@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+phash_index.py
+- Perceptual hash (dHash 64-bit) cho ảnh nhãn + BK-tree tra cứu theo khoảng cách Hamming
+- Dùng để nhận ra 2 ảnh chụp cùng một bao bì (khác sha256) và trả kết quả từ cache
+- Ảnh phẳng (trơn màu, cháy sáng) cho dHash gần toàn 0 / toàn 1 → không tra / không lưu gần trùng
+- Mỗi entry kèm chữ ký thô (tỉ lệ khung + màu trung bình lưới 4x4) để kiểm tra lần hai trước khi dùng lại nhãn
+- Nhiều worker dùng chung một file log JSONL: thêm / xoá = ghi nối một dòng (khoá file);
+  tra cứu đọc tiếp phần mới từ offset đã đọc; log nhiều dòng xoá thì nén lại
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:        # Windows: chỉ chạy 1 process
+    fcntl = None
+
+from PIL import Image, ImageOps
+
+HASH_SIZE = 8  # 8x8 = 64 bit
+MIN_BITS = 8   # số bit 1 (và bit 0) tối thiểu để dHash đủ thông tin
+SIG_GRID = 4
+SIG_MAX_ASPECT = 0.08   # lệch tỉ lệ khung (tương đối) tối đa
+SIG_MAX_DIFF = 24.0     # lệch màu trung bình tối đa (0..255) trên lưới SIG_GRID x SIG_GRID
+
+
+def _upright(im: Image.Image) -> Image.Image:
+    try:
+        return ImageOps.exif_transpose(im)
+    except Exception:
+        return im
+
+
+def dhash(im: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """dHash: thu nhỏ về (hash_size+1) x hash_size xám, so sánh từng cặp pixel kề nhau."""
+    g = _upright(im).convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    px = list(g.getdata())
+    w = hash_size + 1
+    bits = 0
+    for row in range(hash_size):
+        base = row * w
+        for col in range(hash_size):
+            bits = (bits << 1) | (1 if px[base + col] > px[base + col + 1] else 0)
+    return bits
+
+
+def informative(h: int, hash_size: int = HASH_SIZE) -> bool:
+    """dHash có đủ bit 1 / bit 0 không; ảnh phẳng cho 0x0 (hoặc toàn 1) và mọi ảnh phẳng đều 'gần trùng' nhau."""
+    n = bin(h).count("1")
+    return MIN_BITS <= n <= hash_size * hash_size - MIN_BITS
+
+
+def signature(im: Image.Image) -> str:
+    """Chữ ký thô: 'tỉ lệ khung:hex RGB lưới 4x4' (kiểm tra lần hai, không dùng để tra cứu)."""
+    im = _upright(im)
+    w, h = im.size
+    grid = im.convert("RGB").resize((SIG_GRID, SIG_GRID), Image.BOX)
+    return f"{w / max(h, 1):.4f}:{grid.tobytes().hex()}"
+
+
+def same_picture(a: str, b: str) -> bool:
+    """Hai chữ ký có cùng tỉ lệ khung và màu trung bình gần nhau không."""
+    try:
+        ra, pa = a.split(":", 1)
+        rb, pb = b.split(":", 1)
+        ra, rb = float(ra), float(rb)
+        pa, pb = bytes.fromhex(pa), bytes.fromhex(pb)
+    except (AttributeError, ValueError):
+        return False
+    if len(pa) != len(pb) or not pa or abs(ra - rb) > SIG_MAX_ASPECT * max(ra, rb):
+        return False
+    return sum(abs(x - y) for x, y in zip(pa, pb)) / len(pa) <= SIG_MAX_DIFF
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """BK-tree trên metric Hamming; mỗi node = (hash, [keys], {dist: child})."""
+
+    __slots__ = ("root", "size")
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, h: int, key: str):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, [key], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                if key not in node[1]:
+                    node[1].append(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [key], {}]
+                return
+            node = child
+
+    def remove(self, h: int, key: str):
+        """Bỏ key khỏi node có đúng hash h (node rỗng vẫn giữ làm nút trung gian)."""
+        node = self.root
+        while node is not None:
+            d = hamming(h, node[0])
+            if d == 0:
+                if key in node[1]:
+                    node[1].remove(key)
+                    self.size -= 1
+                return
+            node = node[2].get(d)
+
+    def search(self, h: int, max_dist: int):
+        """Trả về list (dist, key) có khoảng cách ≤ max_dist, sắp xếp tăng dần."""
+        out = []
+        if self.root is None or max_dist < 0:
+            return out
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= max_dist:
+                out += [(d, k) for k in node[1]]
+            lo, hi = d - max_dist, d + max_dist
+            for cd, child in node[2].items():
+                if lo <= cd <= hi:
+                    stack.append(child)
+        out.sort(key=lambda x: x[0])
+        return out
+
+
+class PHashIndex:
+    """Chỉ mục cache_key -> (dHash, chữ ký), lưu trong file log JSONL để sống sót qua restart."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._reset()
+        n = self._refresh()
+        if n:
+            print(f"[INFO] phash index loaded: {n} entries")
+
+    def _reset(self):
+        self._tree = BKTree()
+        self._entries = {}     # key -> (hash, chữ ký)
+        self._offset = 0       # đã đọc log tới byte này
+        self._ino = None
+        self._head = None      # dòng đầu file: nén lại ghi dòng "gen" mới → nhận ra cả khi inode bị dùng lại
+        self._lines = 0        # số dòng log (gồm cả dòng xoá / ghi đè) → quyết định nén
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path.with_suffix(self.path.suffix + ".lock"), "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _apply(self, rec: dict):
+        if "k" not in rec:     # dòng "gen" đầu log đã nén
+            return
+        key = rec["k"]
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._tree.remove(old[0], key)
+        if "h" in rec:
+            h = int(rec["h"], 16)
+            self._entries[key] = (h, rec.get("s") or "")
+            self._tree.add(h, key)
+
+    def _refresh(self) -> int:
+        """_merge_from_disk dưới khoá chia sẻ: không đọc xen giữa lúc worker khác nén (thay file) log."""
+        if not self.path.exists():
+            return 0
+        with self._file_lock(shared=True):
+            return self._merge_from_disk()
+
+    def _merge_from_disk(self) -> int:
+        """
+        Đọc tiếp phần log mới (do worker khác ghi); file bị nén lại (inode / dòng đầu đổi, ngắn đi) → đọc lại từ đầu.
+        Gọi khi đang giữ khoá file. stat lấy từ chính fd đang đọc nên inode / size / nội dung luôn cùng một file.
+        """
+        try:
+            fp = open(self.path, "rb")
+        except FileNotFoundError:
+            return 0
+        with fp:
+            st = os.fstat(fp.fileno())
+            head = fp.readline()
+            if st.st_ino != self._ino or st.st_size < self._offset or head != self._head:
+                self._reset()
+                self._ino, self._head = st.st_ino, head
+            if st.st_size == self._offset:
+                return 0
+            before = len(self._entries)
+            fp.seek(self._offset)
+            chunk = fp.read()
+        end = chunk.rfind(b"\n") + 1      # bỏ dòng cuối đang ghi dở
+        for line in chunk[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+                self._lines += 1
+            except Exception:
+                continue
+        self._offset += end
+        return len(self._entries) - before
+
+    def _append(self, recs):
+        with self._file_lock():
+            with open(self.path, "ab") as fp:
+                fp.write(b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in recs))
+            self._merge_from_disk()
+            if self._lines > 2 * len(self._entries) + 256:
+                self._compact()
+
+    def _compact(self):
+        """Ghi lại log chỉ gồm entry còn sống (đang giữ khoá file)."""
+        tmp = self.path.with_suffix(self.path.suffix + f".{os.getpid()}.tmp")
+        gen = json.dumps({"gen": f"{os.getpid()}-{time.time_ns()}"}) + "\n"
+        tmp.write_text(gen + "".join(json.dumps({"k": k, "h": f"{h:016x}", "s": s}) + "\n"
+                                     for k, (h, s) in self._entries.items()), "utf-8")
+        tmp.replace(self.path)
+        self._reset()
+        self._merge_from_disk()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key: str, h: int, sig: str):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._append([{"k": key, "h": f"{h:016x}", "s": sig}])
+
+    def discard(self, keys):
+        """Bỏ các key (nhãn đã bị xoá khỏi kho)."""
+        with self._lock:
+            recs = [{"k": k} for k in keys if k in self._entries]
+            if recs:
+                self._append(recs)
+
+    def search(self, h: int, max_dist: int):
+        """[(dist, key, chữ ký)] trong ngưỡng, gần nhất trước."""
+        with self._lock:
+            self._refresh()
+            return [(d, k, self._entries[k][1]) for d, k in self._tree.search(h, max_dist)]
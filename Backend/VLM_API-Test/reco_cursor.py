@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+reco_cursor.py
+- Con trỏ phân trang đề xuất dạng token mờ có ký HMAC: "<payload base64url>.<chữ ký>"
+- Payload chỉ gồm danh mục, dấu vân tay hồ sơ và offset → server không giữ trạng thái theo phiên;
+  worker nào cũng phục vụ được trang tiếp theo bằng cách tính lại/cắt lại bảng xếp hạng
+"""
+import base64
+import hashlib
+import hmac
+import json
+
+
+class CursorError(ValueError):
+    pass
+
+
+def _b64e(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+
+def _b64d(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+
+def fingerprint(*parts) -> str:
+    blob = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:16]
+
+
+class CursorSigner:
+    def __init__(self, secret: bytes):
+        self._secret = secret
+
+    def _sig(self, body: str) -> str:
+        return _b64e(hmac.new(self._secret, body.encode("ascii"), hashlib.sha256).digest()[:16])
+
+    def encode(self, payload: dict) -> str:
+        body = _b64e(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        return f"{body}.{self._sig(body)}"
+
+    def decode(self, token: str) -> dict:
+        token = str(token)
+        if not token.isascii():     # token hợp lệ luôn là base64url; hmac/encode("ascii") không nhận chữ có dấu
+            raise CursorError("malformed cursor")
+        try:
+            body, sig = token.split(".", 1)
+        except ValueError:
+            raise CursorError("malformed cursor")
+        if not hmac.compare_digest(sig, self._sig(body)):
+            raise CursorError("bad cursor signature")
+        try:
+            payload = json.loads(_b64d(body).decode("utf-8"))
+        except Exception:
+            raise CursorError("malformed cursor")
+        if not isinstance(payload, dict):
+            raise CursorError("malformed cursor")
+        return payload
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+response_cache.py
+- Cache câu trả lời LLM theo khoá băm chuẩn hoá của input (dùng cho /advice)
+- Tầng RAM: LRU có TTL; tầng đĩa tuỳ chọn: một file SQLite (WAL) sống qua restart
+- Dòng hết hạn trên đĩa được dọn theo chu kỳ (purge_every_s, có index created_at), không phải mỗi lần put;
+  get() vẫn bỏ qua dòng hết hạn chưa kịp dọn
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+def canonical_key(*parts) -> str:
+    """sha256 của JSON chuẩn hoá (sort_keys, không khoảng trắng) — dict cùng nội dung cho cùng khoá."""
+    blob = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, name: str, max_items: int = 1024, ttl_s: float = 7 * 86400, disk_path: Path = None,
+                 purge_every_s: float = 600.0):
+        self.name = name
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.purge_every_s = purge_every_s
+        self._purged_at = 0.0
+        self.disk_path = Path(disk_path) if disk_path else None
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()   # key -> (value, created_at)
+        self._local = threading.local()
+        self.hits = self.disk_hits = self.misses = self.puts = 0
+        if self.disk_path is not None:
+            self.disk_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = self._conn()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                              key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses(created_at)")
+            conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.disk_path), timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl_s) and now - created_at > self.ttl_s
+
+    def _remember(self, key, value, created_at):
+        self._mem[key] = (value, created_at)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                if not self._expired(hit[1], now):
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return hit[0]
+                self._mem.pop(key, None)
+        if self.disk_path is not None:
+            try:
+                row = self._conn().execute("SELECT value, created_at FROM responses WHERE key=?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"[WARN] Response cache '{self.name}' read failed: {e}")
+                row = None
+            if row is not None and not self._expired(row[1], now):
+                value = json.loads(row[0])
+                with self._lock:
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self.puts += 1
+            purge = bool(self.ttl_s) and now - self._purged_at >= self.purge_every_s
+            if purge:
+                self._purged_at = now
+        if self.disk_path is not None:
+            try:
+                conn = self._conn()
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?)",
+                             (key, json.dumps(value, ensure_ascii=False), now))
+                if purge:
+                    conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_s,))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"[WARN] Response cache '{self.name}' write failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"items": len(self._mem), "max_items": self.max_items, "ttl_s": self.ttl_s,
+                    "disk": str(self.disk_path) if self.disk_path else None,
+                    "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "puts": self.puts,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -5,23 +5,44 @@ HealthScan Server — mixed catalog loader + image support
 - Đề xuất sản phẩm kèm ảnh minh hoạ, ẩn barcode trong phần văn bản
 """
 
-import os, io, re, json, base64, mimetypes, time, hashlib
+import os, io, re, json, base64, mimetypes, time, hashlib, hmac, atexit, threading, uuid
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
-from PIL import Image
+from PIL import Image, ImageOps
 from dotenv import load_dotenv, find_dotenv
 import google.generativeai as genai
 import requests
 
+from phash_index import PHashIndex, dhash, informative, same_picture, signature
+from label_jobs import JobTable, JobTableFull, FINAL_STATES, CALLING_MODEL, PARSING
+from singleflight import SingleFlight
+from gemini_scheduler import GeminiScheduler
+from ingest import (ImageSink, ImageUpload, Base64Sink, UploadError,
+                    read_file_stream, read_json_with_image)
+from label_store import DirLabelStore, SQLiteLabelStore
+from advice_engine import CircuitBreaker, local_advice
+from response_cache import ResponseCache, canonical_key
+from state_backend import make_backend
+from catalog_index import CatalogIndex
+from catalog_loader import load_catalog, norm_barcode
+from catalog_snapshot import CatalogSnapshot, is_snapshot
+from hot_reload import HotReloader
+from store_index import StoreIndex
+from chat_store import ChatSessionStore, SharedChatStore
+from reco_cursor import CursorSigner, CursorError, fingerprint
+from chat_prompt import ChatPromptBuilder
+
 # ==== Load env ====
 load_dotenv(find_dotenv())
 API_KEY = os.getenv("GEMINI_API_KEY")
 PORT = int(os.getenv("PORT", "8888"))
 ASR_UPSTREAM = os.getenv("ASR_URL", "").strip()  # ví dụ: https://xxxxx.ngrok-free.app/transcribe
+ASR_TIMEOUT_S = float(os.getenv("ASR_TIMEOUT_S", "60"))
 if not ASR_UPSTREAM:
     print("[WARN] ASR_URL is empty; /asr proxy will return 503 if called.")
 
@@ -32,6 +53,20 @@ OUT_DIR = Path(os.getenv("OUT_DIR", BASE_DIR / "outputs"))
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 LABEL_CACHE_DIR = OUT_DIR / "label_cache"
 LABEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+# Ảnh gần trùng (dHash) trong ngưỡng Hamming này được phục vụ từ cache; -1 = tắt
+PHASH_MAX_DIST = int(os.getenv("PHASH_MAX_DIST", "6"))
+
+# Chuẩn hoá ảnh trước khi gửi VLM (kích thước upload quyết định phần lớn độ trễ/chi phí)
+IMG_MAX_SIDE    = int(os.getenv("IMG_MAX_SIDE", "1600"))
+IMG_FORMAT      = os.getenv("IMG_FORMAT", "JPEG").upper()          # JPEG | WEBP
+IMG_QUALITY     = max(1, min(95, int(os.getenv("IMG_QUALITY", "85"))))
+IMG_GRAYSCALE   = os.getenv("IMG_GRAYSCALE", "0") == "1"
+IMG_AUTOCONTRAST= os.getenv("IMG_AUTOCONTRAST", "0") == "1"
+
+# Giới hạn upload: mỗi ảnh ≤ MAX_IMAGE_MB, cả request ≤ MAX_REQUEST_MB (batch nhiều ảnh)
+MAX_IMAGE_BYTES    = int(float(os.getenv("MAX_IMAGE_MB", "15")) * 1024 * 1024)
+MAX_REQUEST_BYTES  = int(float(os.getenv("MAX_REQUEST_MB", "64")) * 1024 * 1024)
+UPLOAD_SPOOL_BYTES = 1024 * 1024   # ảnh lớn hơn mức này được spool xuống file tạm
 
 DATA_DIR = BASE_DIR / "Data"
 
@@ -67,6 +102,11 @@ VLM_MODEL = genai.GenerativeModel("gemini-1.5-flash")   # đọc nhãn từ ản
 LLM_MODEL = genai.GenerativeModel("gemini-1.5-flash")   # tư vấn/llm tổng quát
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+
+@app.errorhandler(413)
+def _too_large(e):
+    return jsonify(ok=False, error=f"request too large (> {MAX_REQUEST_BYTES} bytes)"), 413
 
 # ==== CORS (GET/POST/OPTIONS) ====
 ALLOWED = [
@@ -112,21 +152,37 @@ Chỉ in JSON, không thêm giải thích.
 """
 
 # ==== Utils ====
-def call_gemini_with_backoff(model, parts, tries=4):
-    for i in range(tries):
-        try:
-            return model.generate_content(parts)
-        except Exception as e:
-            msg = str(e)
-            if "ResourceExhausted" in msg or "429" in msg:
-                delay = max(1, 2 ** i)
-                m = re.search(r"retry_delay\s*{\s*seconds:\s*(\d+)", msg)
-                if m:
-                    delay = max(delay, int(m.group(1)))
-                time.sleep(min(delay, 60))
-                continue
-            raise
-    raise RuntimeError("Gemini 429: Hết quota Free Tier/đang quá tải. Hãy bật billing hoặc giảm tần suất gọi.")
+# Mọi lời gọi Gemini đi qua một bộ điều phối chung: RPM + số lời gọi đồng thời + ưu tiên label > advice > chat
+# Chạy nhiều worker (wsgi.py đặt GEMINI_WORKERS): mỗi process nhận một phần quota RPM
+GEMINI_SCHED = GeminiScheduler(
+    rpm=float(os.getenv("GEMINI_RPM", "60")) / max(1, int(os.getenv("GEMINI_WORKERS", "1"))),
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "4")),
+    queue_timeout=float(os.getenv("GEMINI_QUEUE_TIMEOUT_S", "120")),
+)
+
+def call_gemini_with_backoff(model, parts, tries=4, kind="chat"):
+    return GEMINI_SCHED.call(lambda: model.generate_content(parts), kind=kind, tries=tries)
+
+def _chunk_text(chunk) -> str:
+    try:
+        return chunk.text or ""
+    except ValueError:   # chunk không có parts (vd. bị chặn an toàn)
+        return ""
+
+def stream_gemini_with_backoff(model, parts, kind="chat"):
+    """Iterator các đoạn text từ generate_content(stream=True), qua cùng bộ điều phối."""
+    for chunk in GEMINI_SCHED.stream(lambda: model.generate_content(parts, stream=True), kind=kind):
+        text = _chunk_text(chunk)
+        if text:
+            yield text
+
+def _prompt_key(parts) -> str:
+    return _sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+def _generate_text_once(flight, model, parts) -> str:
+    """generate_content qua single-flight: prompt giống hệt nhau đang bay chỉ gọi model một lần."""
+    text, _ = flight.do(_prompt_key(parts), lambda: call_gemini_with_backoff(model, parts, kind=flight.name).text or "")
+    return text
 
 def _extract_json(text: str) -> dict:
     start = text.find("{"); end = text.rfind("}")
@@ -138,20 +194,74 @@ def _extract_json(text: str) -> dict:
         if m: return json.loads(m.group(1))
         raise
 
-def _detect_mime(img_bytes: bytes, fallback: str = "image/jpeg") -> str:
+_FMT_MIME = {"JPEG":"image/jpeg","JPG":"image/jpeg","PNG":"image/png","WEBP":"image/webp","BMP":"image/bmp","TIFF":"image/tiff"}
+
+def _mime_of(im, fallback: str = "image/jpeg") -> str:
+    fmt = (getattr(im, "format", None) or "").upper()
+    return _FMT_MIME.get(fmt, fallback)
+
+def _decode_image(upload: ImageUpload):
+    """Giải mã ảnh MỘT lần (đọc thẳng từ spool); kết quả dùng lại cho mime, dHash và chuẩn hoá."""
     try:
-        im = Image.open(io.BytesIO(img_bytes))
-        fmt = (im.format or "").upper()
-        mapping = {"JPEG":"image/jpeg","JPG":"image/jpeg","PNG":"image/png","WEBP":"image/webp","BMP":"image/bmp","TIFF":"image/tiff"}
-        return mapping.get(fmt, fallback)
+        im = Image.open(upload.open())
+        im.load()
+        return im
     except Exception:
-        return fallback
+        return None
+
+def _normalize_image(im, upload: ImageUpload, fallback_mime: str = "image/jpeg"):
+    """
+    EXIF-orientation → thu nhỏ cạnh dài ≤ IMG_MAX_SIDE → (xám / tăng tương phản)
+    → nén lại JPEG/WebP với IMG_QUALITY. Trả về (bytes, mime) để gửi VLM;
+    giữ nguyên ảnh gốc nếu không giải mã được, hoặc bản nén không nhỏ hơn và ảnh không phải xoay theo EXIF
+    (ảnh đã xoay luôn gửi bản nén lại: VLM không tự đọc EXIF orientation).
+    """
+    src_mime = _mime_of(im, fallback_mime) if im is not None else fallback_mime
+    if im is None:
+        return upload.read(), src_mime
+    try:
+        rotated = (im.getexif().get(0x0112) or 1) != 1     # 0x0112 = Orientation
+        out = ImageOps.exif_transpose(im)
+        if max(out.size) > IMG_MAX_SIDE:
+            out.thumbnail((IMG_MAX_SIDE, IMG_MAX_SIDE), Image.LANCZOS)
+        if out.mode in ("RGBA", "LA", "P"):
+            rgba = out.convert("RGBA")
+            bg = Image.new("RGB", rgba.size, "white")
+            bg.paste(rgba, mask=rgba.split()[-1])
+            out = bg
+        out = out.convert("L") if IMG_GRAYSCALE else out.convert("RGB")
+        if IMG_AUTOCONTRAST:
+            out = ImageOps.autocontrast(out, cutoff=1)
+        fmt = "WEBP" if IMG_FORMAT == "WEBP" else "JPEG"
+        buf = io.BytesIO()
+        out.save(buf, fmt, quality=IMG_QUALITY, optimize=True)
+        data = buf.getvalue()
+    except Exception as e:
+        print(f"[WARN] Image normalize failed ({type(e).__name__}: {e}); sending original")
+        return upload.read(), src_mime
+    if len(data) >= upload.size and not rotated:
+        print(f"[INFO] Image normalize: kept original {upload.size} bytes ({src_mime})")
+        return upload.read(), src_mime
+    saved = upload.size - len(data)
+    print(f"[INFO] Image normalize: {upload.size} -> {len(data)} bytes "
+          f"(saved {saved}, {100.0 * saved / upload.size:.0f}%), "
+          f"{im.size[0]}x{im.size[1]} -> {out.size[0]}x{out.size[1]} {fmt}")
+    return data, _FMT_MIME[fmt]
 
 def _sha256(b: bytes) -> str:
     return hashlib.sha256(b).hexdigest()
 
-def _cache_paths(key: str):
-    return LABEL_CACHE_DIR / f"{key}.json", LABEL_CACHE_DIR / f"{key}.txt"
+PHASH_INDEX = PHashIndex(LABEL_CACHE_DIR / "phash_index.jsonl")
+
+def _phash(im):
+    """(dHash, chữ ký) của ảnh, hoặc None nếu không giải mã được / ảnh quá phẳng để so gần trùng."""
+    if im is None:
+        return None
+    try:
+        h = dhash(im)
+        return (h, signature(im)) if informative(h) else None
+    except Exception:
+        return None
 
 def _human_text_from_label(label: dict) -> str:
     lines = []
@@ -184,6 +294,37 @@ def _human_text_from_label(label: dict) -> str:
     else: lines.append("-")
     return "\n".join(lines)
 
+# ==== Label store ====
+# LABEL_STORE=sqlite (mặc định): 1 file SQLite WAL, LRU/TTL, ghi nền theo lô
+# LABEL_STORE=files: bố cục thư mục cũ (label_cache/<key>.json)
+# LABEL_EXPORT_FILES=1: với sqlite, vẫn xuất thêm bố cục thư mục cũ từ thread ghi nền
+# Bản .txt/.md không ghi lúc phân tích nữa; render khi có người đọc qua GET /label/<key>.txt|.md
+LABEL_STORE_KIND   = os.getenv("LABEL_STORE", "sqlite").lower()
+LABEL_EXPORT_FILES = os.getenv("LABEL_EXPORT_FILES", "0") == "1"
+
+def _make_label_store():
+    legacy = DirLabelStore(LABEL_CACHE_DIR)
+    if LABEL_STORE_KIND == "files":
+        return legacy
+    return SQLiteLabelStore(
+        Path(os.getenv("LABEL_DB_PATH", OUT_DIR / "label_cache.sqlite3")),
+        max_items=int(os.getenv("LABEL_CACHE_MAX_ITEMS", "5000")),
+        max_age_s=float(os.getenv("LABEL_CACHE_MAX_AGE_DAYS", "30")) * 86400,
+        export=legacy if LABEL_EXPORT_FILES else None,
+        import_from=legacy,
+    )
+
+LABEL_STORE = _make_label_store()
+atexit.register(LABEL_STORE.close)
+if hasattr(LABEL_STORE, "on_evict"):
+    LABEL_STORE.on_evict = PHASH_INDEX.discard   # nhãn bị xoá (LRU/TTL) → bỏ luôn dHash trỏ tới nó
+
+# ---------- Trạng thái dùng chung (chat, xếp hạng đề xuất, job) ----------
+# STATE_BACKEND=memory (mặc định, 1 process) | sqlite | sqlite:///path.sqlite3 | redis://host:6379/0
+# Nhiều worker cần backend dùng chung (xem wsgi.py); kho nhãn SQLite và phash index vốn đã dùng chung qua file
+STATE = make_backend(os.getenv("STATE_BACKEND", "memory"), OUT_DIR,
+                     memory_limits={"reco": int(os.getenv("RECO_RANK_CACHE_MAX", "128"))})
+
 # ---------- Helpers cá nhân hoá & hiển thị ----------
 def _bar(value, max_value, width=16):
     try:
@@ -464,148 +605,76 @@ def _normalize_md(text: str) -> str:
         out.append(l)
     return "\n".join(out)
 
+class _MdLineStream:
+    """
+    _normalize_md theo từng dòng khi chunk về. Chỉ phần đầu dòng (#, *, •) bị sửa nên một dòng được
+    giữ lại tới khi qua phần đầu dòng, sau đó phần còn lại của dòng được đẩy ra ngay.
+    """
+    _HEAD_RE = re.compile(r'^\s*(#{1,6}\s*|[*•]\s*)?')
+
+    def __init__(self):
+        self._head = ""
+        self._in_line = False
+        self._parts = []
+
+    def feed(self, text: str) -> str:
+        out = []
+        for piece in re.split(r'(\n)', text):
+            if piece == "\n":
+                if not self._in_line:
+                    out.append(_normalize_md(self._head))
+                    self._head = ""
+                out.append("\n")
+                self._in_line = False
+            elif piece:
+                if self._in_line:
+                    out.append(piece)
+                    continue
+                self._head += piece
+                if self._HEAD_RE.match(self._head).end() < len(self._head):
+                    out.append(_normalize_md(self._head))
+                    self._head, self._in_line = "", True
+        s = "".join(out)
+        self._parts.append(s)
+        return s
+
+    def flush(self) -> str:
+        s = "" if self._in_line else _normalize_md(self._head)
+        self._head, self._in_line = "", False
+        self._parts.append(s)
+        return s
+
+    @property
+    def started(self) -> bool:
+        return any(self._parts)
+
+    def text(self) -> str:
+        return "".join(self._parts)
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(gen):
+    return Response(gen, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # ==== Catalog & Stores (cho /recommend) ====
-def _to_float(x):
-    try:
-        if x is None: return None
-        return float(str(x).replace(",", ".").strip())
-    except Exception:
-        return None
+# Snapshot đã biên dịch (build_catalog.py) nếu có và được dựng từ đúng CATALOG_PATH (đường dẫn, size, sha256),
+# không thì đọc JSON như cũ
+CATALOG_SNAPSHOT = os.getenv("CATALOG_SNAPSHOT", str(DATA_DIR / "catalog.snap"))
 
-def _off_extract_nutrition(n: dict):
-    def _num(x):
+def _load_catalog_any():
+    if is_snapshot(CATALOG_SNAPSHOT):
         try:
-            return float(str(x).replace(",", "."))
-        except Exception:
-            return None
-    def get(key):
-        for k in (f"{key}_100g", key, f"{key}-100g", f"{key}_value"):
-            if k in n and n[k] is not None:
-                return _num(n[k])
-        return None
-
-    sugars = get("sugars")
-    salt   = get("salt")
-    sodium = get("sodium")
-    prot   = get("proteins")
-    satfat = get("saturated-fat")
-    kcal   = get("energy-kcal")
-    fiber  = get("fiber")
-    carbs  = get("carbohydrates")
-    fat    = get("fat")
-
-    if sodium is None and salt is not None:
-        sodium = salt * 0.393  # g Na ≈ g muối * 0.393
-
-    return {
-        "sugars_g": sugars,
-        "carbs_g": carbs,
-        "sodium_g": sodium,
-        "salt_g": salt,
-        "satfat_g": satfat,
-        "protein_g": prot,
-        "fat_g": fat,
-        "fiber_g": fiber,
-        "energy_kcal": kcal,
-    }
-
-def _pick_image(it: dict):
-    img = it.get("image_url") or it.get("image_front_url") or it.get("image_nutrition_url")
-    if not img:
-        sel = it.get("selected_images") or {}
-        front = sel.get("front") or {}
-        img = front.get("display") or front.get("small") or front.get("thumb")
-    return img
-
-def _pick_category_value(it: dict):
-    cat = (it.get("category") or "").strip()
-    if not cat:
-        tags = it.get("categories_tags") or []
-        if tags:
-            last = str(tags[-1])
-            cat = last.split(":", 1)[-1]
-    return (cat or "").lower().strip()
-
-def _load_catalog_off_format(raw_list):
-    out = []
-    for it in raw_list:
-        if not isinstance(it, dict):
-            continue
-        name  = (it.get("name")  or "").strip()
-        brand = (it.get("brand") or "").strip()
-        if not (name or brand):
-            continue
-        norm = _off_extract_nutrition(it.get("nutrition") or {})
-        if sum(v is not None for v in norm.values()) < 3:
-            continue
-        out.append({
-            "barcode": it.get("barcode"),        # giữ nội bộ
-            "name": name,
-            "brand": brand,
-            "category": _pick_category_value(it),
-            "countries": [str(x).split(":")[-1] for x in (it.get("countries_tags") or [])],
-            "allergens": it.get("allergens") or [],
-            "additives": it.get("additives") or [],
-            "nutrition_100g": norm,
-            "image": _pick_image(it),
-        })
-    print(f"[INFO] Catalog(OFF) loaded: {len(out)} items")
-    return out
-
-def _load_catalog_old_format(raw_list):
-    out = []
-    for it in raw_list:
-        if not it or not isinstance(it, dict):
-            continue
-        if it.get("eligible") is False:
-            continue
-        name = (it.get("name") or "").strip()
-        brand = (it.get("brand") or "").strip()
-        if not (name or brand):
-            continue
-        nut = (it.get("nutrition_100g") or {})
-        norm = {
-            "sugars_g":  _to_float(nut.get("sugars_g")),
-            "carbs_g":   _to_float(nut.get("carbs_g")),
-            "sodium_g":  _to_float(nut.get("sodium_g")),
-            "salt_g":    _to_float(nut.get("salt_g")),
-            "satfat_g":  _to_float(nut.get("satfat_g")),
-            "protein_g": _to_float(nut.get("protein_g")),
-            "fat_g":     _to_float(nut.get("fat_g")),
-            "fiber_g":   _to_float(nut.get("fiber_g")),
-            "energy_kcal": _to_float(nut.get("energy_kcal")),
-        }
-        if sum(v is not None for v in norm.values()) < 3:
-            continue
-        out.append({
-            "barcode": it.get("barcode"),
-            "name": name,
-            "brand": brand,
-            "category": (it.get("category") or "").lower().strip(),
-            "countries": it.get("countries") or [],
-            "allergens": it.get("allergens") or [],
-            "additives": it.get("additives") or [],
-            "nutrition_100g": norm,
-            "image": it.get("image"),
-        })
-    print(f"[INFO] Catalog(old) loaded: {len(out)} items")
-    return out
-
-def _load_catalog(path: str):
-    p = Path(path)
-    if not p.exists():
-        print(f"[WARN] Catalog not found at {p.resolve()}")
-        return []
-    raw = json.loads(p.read_text("utf-8"))
-
-    if isinstance(raw, list) and raw:
-        looks_old = isinstance(raw[0], dict) and ("nutrition_100g" in raw[0] or "eligible" in raw[0])
-        if looks_old:
-            return _load_catalog_old_format(raw)
-        return _load_catalog_off_format(raw)
-
-    print("[WARN] Catalog file is not a list. Empty catalog returned.")
-    return []
+            snap = CatalogSnapshot(CATALOG_SNAPSHOT)
+            why = snap.source_mismatch(CATALOG_PATH)
+            if why is None:
+                return snap
+            print(f"[WARN] Catalog snapshot does not match CATALOG_PATH ({why}), using JSON "
+                  f"(rebuild: python build_catalog.py \"{CATALOG_PATH}\")")
+        except Exception as e:
+            print(f"[WARN] Catalog snapshot unusable ({e}), using JSON")
+    return load_catalog(CATALOG_PATH)
 
 def _load_stores(path: str):
     p = Path(path)
@@ -627,8 +696,17 @@ def _load_stores(path: str):
     print(f"[INFO] Stores loaded: {len(out)} entries")
     return out
 
-CATALOG = _load_catalog(CATALOG_PATH)
-STORES = _load_stores(STORES_PATH)
+def _build_barcode_index(catalog):
+    if hasattr(catalog, "barcode_index"):
+        idx = catalog.barcode_index()
+    else:
+        idx = {}
+        for it in catalog:
+            code = norm_barcode(it.get("barcode"))
+            if code and code not in idx:
+                idx[code] = it
+    print(f"[INFO] Barcode index: {len(idx)} codes")
+    return idx
 
 # ==== Nutri-Score (đơn giản hoá, thực phẩm & đồ uống) ====
 def _ns_points_negative_food(nut):
@@ -709,14 +787,14 @@ _BUCKETS = {
     "condiment":{"condiment"},
     "misc":     {"misc"}
 }
-def _bucket_of(cat: str):
-    cat = (cat or "").lower().strip()
-    for k, s in _BUCKETS.items():
-        if cat in s: return k
-    return "misc"
+# category → bucket (category thuộc nhiều bucket, vd. yogurt → lấy bucket khai báo trước như vòng lặp cũ)
+_BUCKET_OF_CAT = {}
+for _b, _cats in _BUCKETS.items():
+    for _c in _cats:
+        _BUCKET_OF_CAT.setdefault(_c, _b)
 
-def _same_bucket(cat1, cat2):
-    return _bucket_of(cat1) == _bucket_of(cat2)
+def _bucket_of(cat: str):
+    return _BUCKET_OF_CAT.get((cat or "").lower().strip(), "misc")
 
 def _guess_category_from_label(label: dict) -> str:
     text = " ".join([
@@ -743,15 +821,6 @@ def _profile_allergy_set(profile: dict):
     if isinstance(al, str): al = [al]
     return {str(x).lower() for x in al if str(x).strip()}
 
-def _has_allergen(item_allergens, user_allergies: set):
-    if not user_allergies: return False
-    for a in item_allergens or []:
-        a = str(a).lower()
-        for ua in user_allergies:
-            if ua in a or a.endswith(ua):
-                return True
-    return False
-
 def _goals_text(profile: dict) -> str:
     g = profile.get("goals") or {}
     parts = []
@@ -759,7 +828,15 @@ def _goals_text(profile: dict) -> str:
     if g.get("note"): parts.append(g.get("note"))
     return ", ".join(str(x) for x in parts if str(x).strip())
 
-def _score_item(item: dict, profile: dict, goals_text: str = ""):
+_PROTEIN_GOAL_KW = ("tăng cơ", "protein", "giảm mỡ", "no lâu")
+_FIBER_GOAL_KW = ("tiêu hoá", "giảm cân", "ít đói")
+
+def _goal_flags(goals_text: str):
+    """(thưởng protein?, thưởng chất xơ?) theo mục tiêu — dùng chung cho bản scalar và bản vector."""
+    g = (goals_text or "").lower()
+    return any(k in g for k in _PROTEIN_GOAL_KW), any(k in g for k in _FIBER_GOAL_KW)
+
+def _score_item(item: dict, profile: dict, goals_text: str = "", bucket: str = None):
     nut = item["nutrition_100g"]
     score, reasons = 0.0, []
 
@@ -780,13 +857,13 @@ def _score_item(item: dict, profile: dict, goals_text: str = ""):
         if satfat <= 3: score += 1
         elif satfat > 5: score -= 1
 
-    goals_text = goals_text.lower()
-    if protein is not None and any(k in goals_text for k in ["tăng cơ","protein","giảm mỡ","no lâu"]):
+    protein_goal, fiber_goal = _goal_flags(goals_text)
+    if protein is not None and protein_goal:
         if protein >= 10: score += 2; reasons.append("Protein cao (≥10g/100g)")
-    if fiber is not None and any(k in goals_text for k in ["tiêu hoá","giảm cân","ít đói"]):
+    if fiber is not None and fiber_goal:
         if fiber >= 5: score += 1; reasons.append("Chất xơ đáng kể (≥5g/100g)")
 
-    if kcal is not None and _bucket_of(item["category"]) in {"snack"} and kcal > 480:
+    if kcal is not None and (bucket or _bucket_of(item["category"])) in {"snack"} and kcal > 480:
         score -= 1; reasons.append("Năng lượng cao cho snack")
 
     return score, reasons
@@ -797,49 +874,49 @@ def _health_level(score: float) -> str:
     if score >= 1.0: return "Hạn chế"
     return "Tránh"
 
-def _stores_for_item(item, topn=3):
-    brand = (item.get("brand") or "").lower()
-    cat   = (item.get("category") or "").lower()
-    bucket= _bucket_of(cat)
-
-    scored = []
-    for s in STORES:
-        sc = 0
-        if brand:
-            if any((brand in ch) or (ch in brand) for ch in s["chains"]):
-                sc += 2
-        if (bucket in s["categories"]) or (cat in s["categories"]):
-            sc += 1
-        if sc > 0:
-            scored.append((sc, s))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    out = []
-    for sc, s in scored[:topn]:
-        out.append({"store": s["store"], "district": s["district"], "type": s.get("type","supermarket")})
-    return out
-
-def _recommend_core(profile, label, k=5, category=None):
-    if not CATALOG:
+# Catalog + chỉ mục (bucket / Nutri-Score / natri / dị ứng / cửa hàng tính sẵn) + cửa hàng dựng chung một khối; khi file nguồn đổi
+# (thread theo dõi mỗi CATALOG_WATCH_S giây, hoặc POST /admin/reload) khối mới được dựng ngoài request rồi đổi nguyên khối
+CatalogData = namedtuple("CatalogData", "catalog index barcodes stores")
+
+def _build_catalog_data():
+    catalog = _load_catalog_any()
+    brands = (catalog.field(i, "brand") if hasattr(catalog, "field") else catalog[i].get("brand")
+              for i in range(len(catalog)))
+    stores = StoreIndex(_load_stores(STORES_PATH), _bucket_of, brands,
+                        memo_size=int(os.getenv("STORE_MEMO_SIZE", "4096")))
+    return CatalogData(catalog, CatalogIndex(catalog, _bucket_of, stores), _build_barcode_index(catalog), stores)
+
+def _catalog_sources():
+    return [CATALOG_PATH, Path(CATALOG_SNAPSHOT) / "meta.json", STORES_PATH]
+
+CATALOG_WATCH_S = float(os.getenv("CATALOG_WATCH_S", "10"))   # 0 = tắt theo dõi, chỉ nạp lại qua /admin/reload
+CATALOG_DATA = HotReloader("catalog", _build_catalog_data, _catalog_sources, poll_s=CATALOG_WATCH_S,
+                           epoch=lambda: STATE.get("admin", "catalog_epoch")).start()
+
+def _catalog() -> CatalogData:
+    """Bản catalog hiện tại; lấy một lần mỗi request rồi dùng tiếp để không lẫn hai phiên bản."""
+    return CATALOG_DATA.current.value
+
+def _recommend_core(profile, label, k=5, category=None, data: CatalogData = None):
+    data = data or _catalog()
+    index = data.index
+    if not len(index):
         return {"ok": False, "error": "Catalog trống"}
     cat = category or _guess_category_from_label(label)
     bucket = _bucket_of(cat)
     goals  = _goals_text(profile)
     user_allergies = _profile_allergy_set(profile)
 
-    pool = [it for it in CATALOG if _same_bucket(it["category"], bucket)] or CATALOG[:]
-    scored = []
-    for it in pool:
-        if _has_allergen(it.get("allergens"), user_allergies):
-            continue
-        s, reasons = _score_item(it, profile, goals_text=goals)
-        ns = _nutriscore(it["nutrition_100g"], is_beverage=(_bucket_of(it["category"])=="beverage"))
-        scored.append((s, reasons, ns, it))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = scored[:max(1, int(k))]
+    pos = index.candidates(bucket)
+    if user_allergies:   # dị ứng → mã chuẩn → OR bitset → bỏ khỏi ứng viên (allergen_index)
+        pos = index.allergens.exclude(pos, user_allergies)
+    # điểm cả bucket tính theo cột (vector_scoring); lý do chỉ dựng cho top-k bằng _score_item
+    top = index.top(pos, max(1, int(k)), *_goal_flags(goals))
 
     out = []
-    for (s, reasons, ns, it) in top:
-        n = it["nutrition_100g"]
+    for (s, e) in top:
+        it, n = e.item, e.item["nutrition_100g"]
+        _, reasons = _score_item(it, profile, goals_text=goals, bucket=e.bucket)
         out.append({
             "name": it.get("name"),
             "brand": it.get("brand"),
@@ -849,128 +926,513 @@ def _recommend_core(profile, label, k=5, category=None):
             "health_score": round(float(s), 2),
             "health_level": _health_level(s),
             "reasons": reasons,
-            "nutriscore": {"grade": ns["grade"], "points": ns["points"]},
+            "nutriscore": e.nutriscore,
             "n_100g": {
                 "sugars_g": n.get("sugars_g"),
-                "sodium_mg": int(round(n.get("sodium_g",0)*1000)) if n.get("sodium_g") is not None else None,
+                "sodium_mg": e.sodium_mg,
                 "satfat_g": n.get("satfat_g"),
                 "protein_g": n.get("protein_g"),
                 "kcal": n.get("energy_kcal")
             },
-            "stores": _stores_for_item(it, topn=3)
+            "stores": index.stores_for(e.pos, topn=3)
         })
-    return {"ok": True, "category_guess": cat, "bucket": _bucket_of(cat), "items": out}
+    return {"ok": True, "category_guess": cat, "bucket": bucket, "items": out}
 
 # ==== API: /_health ====
 @app.get("/_health")
 def _health():
+    data = _catalog()
     return jsonify(ok=True, version=APP_VERSION,
-                   catalog=len(CATALOG), stores=len(STORES),
+                   catalog=len(data.catalog), catalog_index=data.index.stats(), stores=len(data.stores), barcodes=len(data.barcodes),
+                   store_index=data.stores.stats(),
                    catalog_path=CATALOG_PATH,
+                   catalog_snapshot=str(data.catalog.path) if hasattr(data.catalog, "path") else None,
+                   catalog_reload=CATALOG_DATA.stats(),
+                   phash_index=len(PHASH_INDEX), phash_max_dist=PHASH_MAX_DIST,
+                   label_store=LABEL_STORE.stats(),
+                   label_jobs=LABEL_JOBS.stats(),
+                   gemini=GEMINI_SCHED.stats(),
+                   singleflight={f.name: f.stats() for f in (LABEL_FLIGHT, ADVICE_FLIGHT, CHAT_FLIGHT)},
+                   advice_breaker=dict(ADVICE_BREAKER.stats(), latency_budget_s=ADVICE_LATENCY_BUDGET_S),
+                   advice_cache=ADVICE_CACHE.stats(),
+                   chat_sessions=CHAT_HIST.stats(),
+                   state_backend=STATE.stats(),
                    asr_upstream=ASR_UPSTREAM,   # <-- thêm dòng này
                    routes=sorted(str(r) for r in app.url_map.iter_rules()))
 
-# ==== API: /label/analyze ====
-def _read_image_from_request():
-    data = request.get_json(silent=True) or {}
-    if request.content_type and "multipart/form-data" in request.content_type:
-        f = request.files.get("image") or request.files.get("file")
-        if not f or f.filename == "":
-            return None, None, None, "missing file field"
-        img_bytes = f.read(); filename = f.filename
-        return img_bytes, filename, "multipart", None
-    b64 = data.get("image_base64") or data.get("image") or ""
-    if b64:
-        if b64.startswith("data:"):
-            b64 = b64.split(",", 1)[1]
-        try:
-            img_bytes = base64.b64decode(b64, validate=True)
-            return img_bytes, "upload.png", "base64", None
-        except Exception as e:
-            return None, None, None, f"invalid base64: {e}"
-    return None, None, None, "missing image"
+# ==== API: /label/<key>.txt|.md (render lười, có memo) ====
+LABEL_TEXT_CACHE_MAX = int(os.getenv("LABEL_TEXT_CACHE_MAX", "256"))
+_LABEL_TEXT_CACHE = OrderedDict()  # (cache_key, fmt) -> text
+_LABEL_TEXT_LOCK = threading.Lock()
+_LABEL_TEXT_RENDERERS = {
+    "txt": (_human_text_from_label, "text/plain; charset=utf-8"),
+    "md":  (_render_label_all_md,   "text/markdown; charset=utf-8"),
+}
+_CACHE_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
 
-@app.route("/label/analyze", methods=["POST","OPTIONS"])
-def analyze_label():
+def _saved_info(saved: dict, key: str) -> dict:
+    out = dict(saved)
+    out.setdefault("txt", f"/label/{key}.txt")
+    out["md"] = f"/label/{key}.md"
+    return out
+
+def _label_text(key: str, fmt: str):
+    with _LABEL_TEXT_LOCK:
+        text = _LABEL_TEXT_CACHE.get((key, fmt))
+        if text is not None:
+            _LABEL_TEXT_CACHE.move_to_end((key, fmt))
+            return text
+    label = LABEL_STORE.get(key)
+    if label is None:
+        return None
+    text = _LABEL_TEXT_RENDERERS[fmt][0](label)
+    with _LABEL_TEXT_LOCK:
+        _LABEL_TEXT_CACHE[(key, fmt)] = text
+        while len(_LABEL_TEXT_CACHE) > LABEL_TEXT_CACHE_MAX:
+            _LABEL_TEXT_CACHE.popitem(last=False)
+    return text
+
+def _label_text_response(cache_key: str, fmt: str):
+    if not _CACHE_KEY_RE.match(cache_key or ""):
+        return jsonify(ok=False, error="invalid cache_key"), 400
+    text = _label_text(cache_key, fmt)
+    if text is None:
+        return jsonify(ok=False, error="label not found"), 404
+    return Response(text, mimetype=_LABEL_TEXT_RENDERERS[fmt][1])
+
+@app.get("/label/<cache_key>.txt")
+def label_text(cache_key):
+    return _label_text_response(cache_key, "txt")
+
+@app.get("/label/<cache_key>.md")
+def label_markdown(cache_key):
+    return _label_text_response(cache_key, "md")
+
+# ==== API: /label/by-barcode (tra catalog, không gọi VLM) ====
+def _as_tag_list(x):
+    if not x: return []
+    if isinstance(x, str): x = x.split(",")
+    return [str(t).strip() for t in x if str(t).strip()]
+
+def _label_from_catalog_item(it: dict) -> dict:
+    """Dựng payload cùng dạng với nhãn VLM từ bản ghi catalog (giá trị theo 100 g)."""
+    n = it.get("nutrition_100g") or {}
+    rows = [
+        ("Fat", n.get("fat_g"), "g"),
+        ("Saturated fat", n.get("satfat_g"), "g"),
+        ("Carbohydrate", n.get("carbs_g"), "g"),
+        ("Sugars", n.get("sugars_g"), "g"),
+        ("Fiber", n.get("fiber_g"), "g"),
+        ("Protein", n.get("protein_g"), "g"),
+        ("Sodium", round(n["sodium_g"] * 1000, 1) if n.get("sodium_g") is not None else None, "mg"),
+    ]
+    allergens = _as_tag_list(it.get("allergens"))
+    kcal = n.get("energy_kcal")
+    return {
+        "language": "",
+        "ingredients_raw": it.get("ingredients_text") or "",
+        "ingredients": [],
+        "nutrition_facts": {
+            "serving_size": "100 g",
+            "servings_per_container": "",
+            "calories": f"{kcal:g} kcal" if kcal is not None else "",
+            "nutrients": [{"name": name, "amount": f"{amt:g}", "unit": unit} for name, amt, unit in rows if amt is not None],
+        },
+        "warnings": [f"có chất gây dị ứng: {a.split(':')[-1]}" for a in allergens],
+        "allergens": allergens,
+        "additives": _as_tag_list(it.get("additives")),
+        "product": {"name": it.get("name"), "brand": it.get("brand"), "category": it.get("category"), "image": it.get("image")},
+    }
+
+def _lookup_barcode(code):
+    code = norm_barcode(code)
+    return _catalog().barcodes.get(code) if code else None
+
+def _barcode_payload(it: dict, barcode, source: str = "catalog"):
+    return dict(
+        ok=True,
+        label=_label_from_catalog_item(it),
+        meta={"source": source, "barcode": str(barcode), "cached": True, "vlm": False},
+    )
+
+@app.route("/label/by-barcode", methods=["GET","POST","OPTIONS"])
+def label_by_barcode():
     if request.method == "OPTIONS":
         return ("", 204)
-    img_bytes, filename, source, err = _read_image_from_request()
-    if err:
-        return jsonify(ok=False, error=err), 400
+    code = request.args.get("barcode") or (request.get_json(silent=True) or {}).get("barcode")
+    if not code:
+        return jsonify(ok=False, error="missing barcode"), 400
+    it = _lookup_barcode(code)
+    if it is None:
+        return jsonify(ok=False, error="barcode not in catalog", barcode=str(code)), 404
+    return jsonify(_barcode_payload(it, code))
 
-    cache_key = _sha256(img_bytes)
-    cache_json_path, cache_txt_path = _cache_paths(cache_key)
-    if cache_json_path.exists():
-        with open(cache_json_path, "r", encoding="utf-8") as fp:
-            label = json.load(fp)
-        return jsonify(
+# ==== API: /label/analyze ====
+def _new_image_sink():
+    return ImageSink(MAX_IMAGE_BYTES, UPLOAD_SPOOL_BYTES)
+
+def _upload_from_b64(b64: str, filename: str) -> ImageUpload:
+    sink = _new_image_sink()
+    dec = Base64Sink(sink)
+    try:
+        dec.write(b64.encode("ascii", "ignore"))
+        dec.finish()
+        return sink.finish(filename, "base64")
+    except BaseException:
+        sink.close()
+        raise
+
+def _read_image_from_request():
+    """
+    Nhận 1 ảnh theo stream (không giữ nhiều bản sao trong RAM) → (ImageUpload | None, fields, err, http_status).
+    - multipart: field "image" | "file"
+    - JSON: {"image_base64" | "image": "<base64 | data URL>", ...} — giải mã dần, không parse nguyên body
+    - body thô image/* hoặc application/octet-stream
+    fields = các trường còn lại (form / JSON) để đọc barcode, async...
+    """
+    ctype = (request.content_type or "").lower()
+    sink = _new_image_sink()
+    fields, upload = {}, None
+    try:
+        if "multipart/form-data" in ctype:
+            fields = request.form.to_dict()
+            f = request.files.get("image") or request.files.get("file")
+            if not f or f.filename == "":
+                return None, fields, "missing file field", 400
+            upload = read_file_stream(f.stream, sink, f.filename, "multipart")
+        elif ctype.startswith("image/") or ctype.startswith("application/octet-stream"):
+            fields = request.args.to_dict()
+            upload = read_file_stream(request.stream, sink, fields.get("filename") or "upload", "raw")
+        else:
+            fields, has_image = read_json_with_image(request.stream, ("image_base64", "image"), sink)
+            if not has_image:
+                return None, fields, "missing image", 400
+            upload = sink.finish("upload.png", "base64")
+        return upload, fields, None, 200
+    except UploadError as e:
+        return None, fields, str(e), e.status
+    finally:
+        if upload is None:      # không có ảnh / lỗi giữa chừng → đóng spool (file tạm nếu đã tràn RAM)
+            sink.close()
+
+# Upload trùng nhau đồng thời → chỉ một lời gọi VLM, các request còn lại chờ kết quả
+LABEL_FLIGHT = SingleFlight("label")
+
+def _analyze_image(upload: ImageUpload, progress=None):
+    """
+    Lõi đọc nhãn dùng chung cho /label/analyze, /label/analyze/batch và job nền → (payload, http_status).
+    progress(state) (tuỳ chọn) được gọi khi bắt đầu gọi model và khi parse kết quả. Đóng upload khi xong.
+    """
+    cache_key = upload.sha256   # đã băm tăng dần lúc nhận
+    try:
+        (payload, status), shared = LABEL_FLIGHT.do(
+            cache_key, lambda: _analyze_image_once(upload, cache_key, progress))
+    finally:
+        upload.close()
+    if shared:
+        meta = dict(payload.get("meta") or {}, source=upload.source, filename=upload.filename, coalesced=True)
+        payload = dict(payload, meta=meta)
+    return payload, status
+
+def _analyze_image_once(upload: ImageUpload, cache_key: str, progress=None):
+    progress = progress or (lambda state: None)
+    filename, source = upload.filename, upload.source
+    label = LABEL_STORE.get(cache_key)
+    match_key, match_dist = (cache_key, 0) if label is not None else (None, None)
+
+    # mime đã dò từ magic bytes lúc nhận (ingest) → trúng cache chính xác thì không cần giải mã ảnh
+    src_mime = upload.mime or (mimetypes.guess_type(filename or "")[0] or "").lower() or "image/jpeg"
+    im = phash = None
+    if match_key is None:
+        im = _decode_image(upload)
+        if im is not None:
+            src_mime = _mime_of(im, src_mime)
+        phash = _phash(im) if PHASH_MAX_DIST >= 0 else None
+
+    # Không trùng byte-by-byte → thử ảnh gần trùng theo dHash, rồi kiểm tra lần hai bằng chữ ký thô
+    if phash is not None:
+        for dist, key, sig in PHASH_INDEX.search(phash[0], PHASH_MAX_DIST):
+            if not same_picture(sig, phash[1]):
+                continue
+            label = LABEL_STORE.get(key)
+            if label is None:            # nhãn đã bị xoá → bỏ dHash, thử ứng viên kế tiếp
+                PHASH_INDEX.discard([key])
+                continue
+            match_dist, match_key = dist, key
+            break
+
+    if match_key is not None:
+        return dict(
             ok=True,
             label=label,
-            saved={"json": str(cache_json_path), "txt": str(cache_txt_path)},
-            meta={"source": source, "filename": filename, "mime": _detect_mime(img_bytes),
-                  "cached": True, "cache_key": cache_key},
-        )
+            saved=_saved_info(LABEL_STORE.describe(match_key), match_key),
+            meta={"source": source, "filename": filename, "mime": src_mime,
+                  "cached": True, "cache_key": match_key,
+                  "near_duplicate": match_key != cache_key, "match_distance": match_dist},
+        ), 200
 
-    f_mime = (mimetypes.guess_type(filename or "")[0] or "").lower()
-    mime = _detect_mime(img_bytes, f_mime or "image/jpeg")
+    upload_bytes, mime = _normalize_image(im, upload, src_mime)
     prompt = (
         "Đọc nhãn thực phẩm trong ảnh (tiếng Việt nếu có). "
         "Trích xuất Thành phần và Giá trị dinh dưỡng theo schema bên dưới.\n" + SCHEMA_HINT
     )
-    parts = [{"text": prompt}, {"inline_data": {"mime_type": mime, "data": img_bytes}}]
+    parts = [{"text": prompt}, {"inline_data": {"mime_type": mime, "data": upload_bytes}}]
+    progress(CALLING_MODEL)
     try:
-        result = call_gemini_with_backoff(VLM_MODEL, parts)
+        result = call_gemini_with_backoff(VLM_MODEL, parts, kind="label")
         text = result.text or ""
     except Exception as e:
-        return jsonify(ok=False, error="Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))), 502
+        return dict(ok=False, error="Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))), 502
+    progress(PARSING)
     try:
         label = _extract_json(text)
     except Exception as e:
-        return jsonify(ok=False, error=f"Parse JSON failed: {e}", raw=text[:5000]), 500
+        return dict(ok=False, error=f"Parse JSON failed: {e}", raw=text[:5000]), 500
 
     label.setdefault("ingredients", [])
     label.setdefault("nutrition_facts", {}).setdefault("nutrients", [])
     label.setdefault("warnings", [])
 
-    with open(cache_json_path, "w", encoding="utf-8") as fp:
-        json.dump(label, fp, ensure_ascii=False, indent=2)
-    with open(cache_txt_path, "w", encoding="utf-8") as fp:
-        fp.write(_human_text_from_label(label))
-
-    ts = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
-    base_stem = Path(secure_filename(filename or "upload")).stem or "upload"
-    prefix = f"{ts}_{base_stem}"
-    json_path = OUT_DIR / f"{prefix}.json"
-    txt_path  = OUT_DIR / f"{prefix}.txt"
-    with open(json_path, "w", encoding="utf-8") as fp:
-        json.dump(label, fp, ensure_ascii=False, indent=2)
-    with open(txt_path, "w", encoding="utf-8") as fp:
-        fp.write(_human_text_from_label(label))
-
-    return jsonify(
+    saved = _saved_info(LABEL_STORE.put(cache_key, label, filename), cache_key)
+    if phash is not None:
+        PHASH_INDEX.add(cache_key, *phash)
+
+    return dict(
         ok=True,
         label=label,
-        saved={"json": str(json_path), "txt": str(txt_path), "cache_json": str(cache_json_path)},
+        saved=saved,
         meta={"source": source, "filename": filename, "mime": mime,
-              "cached": False, "cache_key": cache_key},
-    )
+              "cached": False, "cache_key": cache_key,
+              "original_bytes": upload.size, "upload_bytes": len(upload_bytes)},
+    ), 200
 
-# ==== API: /advice (cá nhân hoá con số) ====
-@app.route("/advice", methods=["POST","OPTIONS"])
-def advice():
+@app.route("/label/analyze", methods=["POST","OPTIONS"])
+def analyze_label():
     if request.method == "OPTIONS":
         return ("", 204)
+    upload, fields, err, status = _read_image_from_request()
+    # Có barcode và nằm trong catalog → trả luôn, không tốn lời gọi Gemini
+    code = fields.get("barcode") or request.args.get("barcode")
+    it = _lookup_barcode(code) if code else None
+    if it is not None:
+        if upload is not None:
+            upload.close()
+        return jsonify(_barcode_payload(it, code, source="barcode"))
+    if err:
+        return jsonify(ok=False, error=err), status
+    if _wants_async(fields):
+        try:
+            job = LABEL_JOBS.submit(_analyze_image, upload)
+        except JobTableFull as e:
+            upload.close()
+            return jsonify(ok=False, error=str(e)), 503
+        return jsonify(ok=True, job_id=job["id"], state=job["state"],
+                       poll=f"/label/jobs/{job['id']}", events=f"/label/jobs/{job['id']}/events"), 202
+    payload, status = _analyze_image(upload)
+    return jsonify(payload), status
+
+# ==== API: /label/jobs (chế độ bất đồng bộ) ====
+LABEL_JOB_TTL_S = float(os.getenv("LABEL_JOB_TTL_S", "900"))
+LABEL_JOBS = JobTable(workers=int(os.getenv("LABEL_JOB_WORKERS", "4")),
+                      max_jobs=int(os.getenv("LABEL_JOB_MAX", "500")),
+                      ttl=LABEL_JOB_TTL_S,
+                      # nhiều worker: chép trạng thái job sang STATE để worker khác trả lời được khi poll
+                      on_change=(lambda job: STATE.set("jobs", job["id"], job, ttl=LABEL_JOB_TTL_S)) if STATE.shared else None)
+SSE_HEARTBEAT_S = 15.0
+SSE_REMOTE_POLL_S = 0.5
+
+def _find_job(job_id):
+    job = LABEL_JOBS.get(job_id)
+    if job is None and STATE.shared:
+        job = STATE.get("jobs", job_id)
+    return job
+
+def _wait_job(job_id, version, timeout):
+    """Như LABEL_JOBS.wait, nhưng job do worker khác chạy thì poll STATE."""
+    if LABEL_JOBS.get(job_id) is not None or not STATE.shared:
+        return LABEL_JOBS.wait(job_id, version, timeout=timeout)
+    deadline = time.time() + timeout
+    while True:
+        job = STATE.get("jobs", job_id)
+        if job is None or job["version"] > version or time.time() >= deadline:
+            return job
+        time.sleep(SSE_REMOTE_POLL_S)
+
+def _wants_async(fields: dict):
+    flag = request.args.get("async") or fields.get("async")
+    return str(flag).lower() in ("1", "true", "yes")
+
+def _job_view(job):
+    out = {"ok": True, "job_id": job["id"], "state": job["state"],
+           "created_at": job["created_at"], "updated_at": job["updated_at"]}
+    if job["state"] in FINAL_STATES:
+        out["result"] = job["result"]
+        out["status"] = job["status"]
+    return out
 
-    body = request.get_json(silent=True) or {}
-    profile = body.get("profile")
-    label = body.get("label")
-    if not profile or not label:
-        return jsonify(ok=False, error="Missing profile or label"), 400
+@app.get("/label/jobs/<job_id>")
+def label_job(job_id):
+    job = _find_job(job_id)
+    if not job:
+        return jsonify(ok=False, error="job not found or expired"), 404
+    return jsonify(_job_view(job))
+
+@app.get("/label/jobs/<job_id>/events")
+def label_job_events(job_id):
+    job = _find_job(job_id)
+    if not job:
+        return jsonify(ok=False, error="job not found or expired"), 404
+
+    def stream(job):
+        # Gửi trạng thái hiện tại, sau đó mỗi lần đổi trạng thái; đóng stream khi xong/lỗi
+        while True:
+            yield _sse("state", _job_view(job))
+            if job["state"] in FINAL_STATES:
+                return
+            version = job["version"]
+            while True:
+                nxt = _wait_job(job_id, version, timeout=SSE_HEARTBEAT_S)
+                if nxt is None:
+                    yield "event: error\ndata: {\"ok\": false, \"error\": \"job expired\"}\n\n"
+                    return
+                if nxt["version"] > version:
+                    job = nxt
+                    break
+                yield ": keep-alive\n\n"
+
+    return _sse_response(stream(job))
+
+# ==== API: /label/analyze/batch ====
+LABEL_BATCH_WORKERS = int(os.getenv("LABEL_BATCH_WORKERS", "4"))
+LABEL_BATCH_MAX     = int(os.getenv("LABEL_BATCH_MAX", "32"))
+LABEL_BATCH_POOL    = ThreadPoolExecutor(max_workers=LABEL_BATCH_WORKERS, thread_name_prefix="label-batch")
+
+def _read_batch_from_request(max_items: int):
+    """
+    Trả về (list (ImageUpload | None, err, http_status) theo đúng thứ tự gửi lên, số ảnh).
+    - multipart: nhiều field "images" (hoặc "image"/"file")
+    - JSON: {"images": ["<base64>", {"image_base64": "...", "filename": "..."}, ...]}
+    Quá max_items ảnh → (None, số ảnh), trả về trước khi spool / giải mã ảnh nào.
+    """
+    items = []
+    if request.content_type and "multipart/form-data" in request.content_type:
+        files = request.files.getlist("images") or request.files.getlist("image") or request.files.getlist("file")
+        if len(files) > max_items:
+            return None, len(files)
+        for f in files:
+            if not f or f.filename == "":
+                items.append((None, "missing file field", 400))
+                continue
+            try:
+                items.append((read_file_stream(f.stream, _new_image_sink(), f.filename, "multipart"), None, 200))
+            except UploadError as e:
+                items.append((None, str(e), e.status))
+        return items, len(items)
+    data = request.get_json(silent=True) or {}
+    images = data.get("images") if isinstance(data, dict) else None
+    if not isinstance(images, list):
+        images = []
+    if len(images) > max_items:
+        return None, len(images)
+    for i, it in enumerate(images):
+        if isinstance(it, dict):
+            b64 = it.get("image_base64") or it.get("image") or ""
+            name = it.get("filename") or f"upload_{i}.png"
+        else:
+            b64, name = str(it or ""), f"upload_{i}.png"
+        if not b64:
+            items.append((None, "missing image", 400))
+            continue
+        try:
+            items.append((_upload_from_b64(b64, name), None, 200))
+        except UploadError as e:
+            items.append((None, str(e), e.status))
+    return items, len(items)
 
-    metrics = _extract_metrics(label)
-    targets = _targets_for_profile(profile)
-    facts   = _summarize_profile_facts(profile)
+def _analyze_batch_item(item):
+    upload, err, status = item
+    if err:
+        return dict(ok=False, error=err), status
+    try:
+        return _analyze_image(upload)
+    except Exception as e:
+        return dict(ok=False, error=f"{type(e).__name__}: {e}"), 500
+
+@app.route("/label/analyze/batch", methods=["POST","OPTIONS"])
+def analyze_label_batch():
+    if request.method == "OPTIONS":
+        return ("", 204)
+    items, n = _read_batch_from_request(LABEL_BATCH_MAX)
+    if items is None:
+        return jsonify(ok=False, error=f"too many images: {n} > {LABEL_BATCH_MAX}"), 413
+    if not items:
+        return jsonify(ok=False, error="missing images"), 400
+
+    t0 = time.time()
+    # pool.map giữ nguyên thứ tự đầu vào; lỗi từng ảnh nằm trong kết quả của ảnh đó
+    results = []
+    for i, (payload, status) in enumerate(LABEL_BATCH_POOL.map(_analyze_batch_item, items)):
+        results.append(dict(payload, index=i, status=status))
+    n_ok = sum(1 for r in results if r.get("ok"))
+    return jsonify(ok=n_ok == len(results), count=len(results), succeeded=n_ok,
+                   failed=len(results) - n_ok, elapsed_ms=int((time.time() - t0) * 1000),
+                   results=results)
 
+# ==== API: /advice (cá nhân hoá con số) ====
+ADVICE_FLIGHT = SingleFlight("advice")
+
+# Fallback cục bộ: khi Gemini lỗi/chậm quá ADVICE_LATENCY_BUDGET_S hoặc client gửi mode=fast
+ADVICE_LATENCY_BUDGET_S = float(os.getenv("ADVICE_LATENCY_BUDGET_S", "8"))
+ADVICE_BREAKER = CircuitBreaker(
+    failure_threshold=int(os.getenv("ADVICE_BREAKER_FAILURES", "3")),
+    reset_timeout=float(os.getenv("ADVICE_BREAKER_RESET_S", "60")),
+)
+ADVICE_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("ADVICE_WORKERS", "8")), thread_name_prefix="advice")
+
+# Cache câu trả lời: prompt /advice chỉ phụ thuộc facts + metrics + targets → khoá băm chuẩn hoá
+# (kèm tên model + phiên bản prompt; đổi prompt thì tăng ADVICE_PROMPT_VERSION)
+ADVICE_PROMPT_VERSION = "1"
+ADVICE_CACHE = ResponseCache(
+    "advice",
+    max_items=int(os.getenv("ADVICE_CACHE_MAX_ITEMS", "2048")),
+    ttl_s=float(os.getenv("ADVICE_CACHE_TTL_H", "168")) * 3600,
+    disk_path=(Path(os.getenv("ADVICE_CACHE_DB", OUT_DIR / "advice_cache.sqlite3"))
+               if os.getenv("ADVICE_CACHE_DISK", "1") == "1" else None),
+    purge_every_s=float(os.getenv("ADVICE_CACHE_PURGE_S", "600")),
+)
+
+def _cache_advice(cache_key, fut):
+    """done-callback: kể cả khi quá ngân sách thời gian, kết quả về muộn vẫn được cache cho lần sau."""
+    if not fut.cancelled() and fut.exception() is None:
+        md = _normalize_md((fut.result() or "").strip())
+        if md:
+            ADVICE_CACHE.put(cache_key, md)
+
+def _model_name(model):
+    return getattr(model, "model_name", None) or type(model).__name__
+
+def _label_allergy_hits(label, profile):
+    """Dị ứng trong hồ sơ xuất hiện trong thành phần (ingredients_raw / tên / ghi chú nguyên liệu)."""
+    user = {a for a in _profile_allergy_set(profile)
+            if a not in ("không có","khong co","none","no","no allergy","no allergies")}
+    if not user:
+        return []
+    parts = [(label or {}).get("ingredients_raw") or ""]
+    for it in (label or {}).get("ingredients") or []:
+        if isinstance(it, dict):
+            parts += [str(it.get("name") or ""), str(it.get("notes") or "")]
+    text = " ".join(parts).lower()
+    return sorted(a for a in user if a in text)
+
+def _local_advice_payload(metrics, targets, label, profile, reason):
+    md, level = local_advice(metrics, targets, _label_allergy_hits(label, profile))
+    return dict(ok=True, advice_markdown=md, metrics=metrics, targets=targets,
+                engine="local", level=level, fallback_reason=reason)
+
+def _local_advice_response(metrics, targets, label, profile, reason):
+    return jsonify(_local_advice_payload(metrics, targets, label, profile, reason))
+
+def _advice_prompt(facts, metrics, targets):
     system = (
         "Bạn là chuyên gia dinh dưỡng lâm sàng. Luôn dùng CON SỐ cụ thể, "
         "không dùng từ mơ hồ như 'nhiều/ít/có thể'. "
@@ -986,18 +1448,162 @@ def advice():
         "YÊU CẦU:\n"
         "- So sánh từng chỉ tiêu (đường, natri, bão hoà, protein, chất xơ, phụ gia) với ngưỡng.\n"
         "- Với protein/chất xơ: nêu rõ dải 6–10 g = vừa, ≥10 g = tốt (nếu mục tiêu liên quan).\n"
-        "- Phụ gia: ghi rõ số đếm và ngưỡng 'ít phụ gia' = ≤ {add_max}; 'nhiều' = > {add_max}.\n"
+        f"- Phụ gia: ghi rõ số đếm và ngưỡng 'ít phụ gia' = ≤ {targets['additives_max']}; 'nhiều' = > {targets['additives_max']}.\n"
         "- Nếu transfat_flag=true → mức **Tránh**.\n"
         "- Tần suất theo mức: Phù hợp (dùng thường xuyên), Cần cân nhắc (≤ 3 lần/tuần), Hạn chế (≤ 1–2 lần/tuần), Tránh (không dùng)."
-    ).format(add_max=targets["additives_max"])
+    )
+    return [{"text": system}, {"text": user}]
+
+def _advice_prepare(body, mode=None, check_breaker=True):
+    """
+    Phần chung của /advice, /advice/stream (và bản ASGI): kiểm tra input, mode=fast, cache, circuit breaker.
+    Trả về (payload, status, plan): payload khác None → trả lời ngay; ngược lại plan cho lời gọi Gemini.
+    Bản stream truyền check_breaker=False và tự gọi ADVICE_BREAKER.allow() trong generator (xem _advice_open).
+    """
+    profile = body.get("profile")
+    label = body.get("label")
+    if not profile or not label:
+        return {"ok": False, "error": "Missing profile or label"}, 400, None
+
+    metrics = _extract_metrics(label)
+    targets = _targets_for_profile(profile)
+    if str(body.get("mode") or mode or "").lower() == "fast":
+        return _local_advice_payload(metrics, targets, label, profile, "mode_fast"), 200, None
+    facts   = _summarize_profile_facts(profile)
+
+    cache_key = canonical_key(facts, metrics, targets, _model_name(LLM_MODEL), ADVICE_PROMPT_VERSION)
+    md = ADVICE_CACHE.get(cache_key)
+    if md is not None:
+        return dict(ok=True, advice_markdown=md, metrics=metrics, targets=targets, engine="gemini", cached=True), 200, None
+
+    if check_breaker and not ADVICE_BREAKER.allow():
+        return _local_advice_payload(metrics, targets, label, profile, "circuit_open"), 200, None
 
+    return None, 200, {"profile": profile, "label": label, "metrics": metrics, "targets": targets,
+                       "cache_key": cache_key, "parts": _advice_prompt(facts, metrics, targets)}
+
+def _advice_open(plan):
+    """
+    Breaker cho bản stream, gọi trong generator: generator bị đóng trước khi chạy (client ngắt ngay)
+    thì không giữ lượt thử half-open. Trả None nếu được gọi Gemini, ngược lại payload cục bộ.
+    """
+    if ADVICE_BREAKER.allow():
+        return None
+    return _local_advice_payload(plan["metrics"], plan["targets"], plan["label"], plan["profile"], "circuit_open")
+
+def _advice_fallback(plan, reason, err=None):
+    """Gemini lỗi/chậm: ghi nhận vào breaker và trả payload của bộ tư vấn cục bộ."""
+    ADVICE_BREAKER.record_failure()
+    if err is not None:
+        print(f"[WARN] /advice: Gemini error {type(err).__name__}: {err} — dùng bộ tư vấn cục bộ")
+    else:
+        print(f"[WARN] /advice: Gemini > {ADVICE_LATENCY_BUDGET_S}s, dùng bộ tư vấn cục bộ")
+    return _local_advice_payload(plan["metrics"], plan["targets"], plan["label"], plan["profile"], reason)
+
+def _advice_success(plan, md, store=False):
+    """
+    Gemini trả lời xong: ghi nhận vào breaker, trả payload. /advice ghi cache qua done-callback (_cache_advice)
+    nên không ghi ở đây; bản stream không có future → store=True (gọi ngoài event loop).
+    """
+    ADVICE_BREAKER.record_success()
+    if store and md:
+        ADVICE_CACHE.put(plan["cache_key"], md)
+    return dict(ok=True, advice_markdown=md, metrics=plan["metrics"], targets=plan["targets"], engine="gemini", cached=False)
+
+@app.route("/advice", methods=["POST","OPTIONS"])
+def advice():
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    payload, status, plan = _advice_prepare(request.get_json(silent=True) or {}, request.args.get("mode"))
+    if plan is None:
+        return jsonify(payload), status
+
+    fut = ADVICE_POOL.submit(_generate_text_once, ADVICE_FLIGHT, LLM_MODEL, plan["parts"])
+    fut.add_done_callback(lambda f: _cache_advice(plan["cache_key"], f))
     try:
-        result = call_gemini_with_backoff(LLM_MODEL, [{"text": system}, {"text": user}])
-        md = _normalize_md((result.text or "").strip())
+        md = _normalize_md(fut.result(timeout=ADVICE_LATENCY_BUDGET_S).strip())
+    except FutureTimeout:
+        # lời gọi vẫn chạy nền (kết quả về muộn vẫn được cache); trả ngay bản cục bộ
+        return jsonify(_advice_fallback(plan, "timeout"))
     except Exception as e:
-        return jsonify(ok=False, error="Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))), 502
+        return jsonify(_advice_fallback(plan, f"gemini_error: {type(e).__name__}", e))
+    return jsonify(_advice_success(plan, md))
+
+def _sse_answer(payload, chat_id=None):
+    """Câu trả lời có sẵn (cache/cục bộ/intent cố định) dưới dạng SSE: một delta + done."""
+    text = payload.get("advice_markdown") or payload.get("reply_markdown") or ""
+    return [_sse("delta", {"text": text}), _sse("done", payload)]
+
+@app.route("/advice/stream", methods=["POST","OPTIONS"])
+def advice_stream():
+    """
+    Như /advice nhưng trả SSE: meta (metrics/targets) → delta {"text"} theo từng đoạn → done (payload như /advice).
+    Cache/mode=fast/breaker giữ nguyên; lỗi trước đoạn đầu tiên → bộ tư vấn cục bộ, lỗi giữa chừng → event error.
+    """
+    if request.method == "OPTIONS":
+        return ("", 204)
 
-    return jsonify(ok=True, advice_markdown=md, metrics=metrics, targets=targets)
+    payload, status, plan = _advice_prepare(request.get_json(silent=True) or {}, request.args.get("mode"),
+                                            check_breaker=False)
+    if status != 200:
+        return jsonify(payload), status
+
+    def events():
+        src = payload or plan
+        yield _sse("meta", {"metrics": src["metrics"], "targets": src["targets"]})
+        local = payload if plan is None else _advice_open(plan)
+        if local is not None:
+            yield from _sse_answer(local)
+            return
+
+        norm = _MdLineStream()
+        try:
+            for text in stream_gemini_with_backoff(LLM_MODEL, plan["parts"], kind="advice"):
+                out = norm.feed(text)
+                if out:
+                    yield _sse("delta", {"text": out})
+            out = norm.flush()
+            if out:
+                yield _sse("delta", {"text": out})
+        except GeneratorExit:
+            # client ngắt giữa chừng: trả lại lượt thử half-open (nếu đang giữ)
+            ADVICE_BREAKER.release()
+            raise
+        except Exception as e:
+            if norm.started:
+                ADVICE_BREAKER.record_failure()
+                yield _sse("error", {"ok": False, "error": f"Gemini error: {type(e).__name__}"})
+                return
+            yield from _sse_answer(_advice_fallback(plan, f"gemini_error: {type(e).__name__}", e))
+            return
+        yield _sse("done", _advice_success(plan, norm.text().strip(), store=True))
+
+    return _sse_response(events())
+
+# ==== API: /admin/reload (nạp lại catalog + cửa hàng, không restart) ====
+# Cần ADMIN_TOKEN + header X-Admin-Token; không đặt ADMIN_TOKEN → endpoint tắt (403), kể cả từ localhost
+# (sau reverse proxy cùng máy mọi request đều đến từ 127.0.0.1).
+# Chỉ worker nhận request dựng lại ngay; các worker khác thấy catalog_epoch đổi trên STATE_BACKEND dùng chung
+# và dựng lại ở lượt poll kế tiếp (CATALOG_WATCH_S). CATALOG_WATCH_S=0 hoặc STATE_BACKEND=memory với nhiều
+# worker → các worker khác không biết, chỉ đổi khi tự nhận /admin/reload hoặc restart.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def _admin_allowed():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+
+@app.post("/admin/reload")
+def admin_reload():
+    if not _admin_allowed():
+        return jsonify(ok=False, error="forbidden" if ADMIN_TOKEN else "admin disabled (set ADMIN_TOKEN)"), 403
+    try:
+        STATE.set("admin", "catalog_epoch", uuid.uuid4().hex)   # báo các worker khác (thread theo dõi)
+        res = CATALOG_DATA.reload(force=True)
+    except Exception as e:
+        return jsonify(ok=False, error=f"reload failed: {type(e).__name__}: {e}",
+                       version=CATALOG_DATA.current.version), 500
+    data = _catalog()
+    return jsonify(ok=True, catalog=len(data.catalog), stores=len(data.stores), **res)
 
 # ==== Recommend API ====
 @app.route("/recommend", methods=["POST","OPTIONS"])
@@ -1014,11 +1620,27 @@ def recommend():
     return jsonify(res), (200 if res.get("ok") else 400)
 
 # ==== Chatbot ====
-from collections import defaultdict
-import uuid
-
-CHAT_HIST = defaultdict(list)
 MAX_TURNS = 12
+# Lịch sử chat: 1 process → LRU + đẩy phiên nhàn rỗi khỏi RAM, nhật ký append-only OUT_DIR/chat_<id>.jsonl;
+# backend dùng chung → danh sách trên STATE (hết hạn sau CHAT_TTL_DAYS không hoạt động)
+if STATE.shared:
+    CHAT_HIST = SharedChatStore(STATE, keep_turns=2 * MAX_TURNS,
+                                idle_s=float(os.getenv("CHAT_TTL_DAYS", "7")) * 86400)
+else:
+    CHAT_HIST = ChatSessionStore(
+        OUT_DIR,
+        max_sessions=int(os.getenv("CHAT_MAX_SESSIONS", "1000")),
+        idle_s=float(os.getenv("CHAT_IDLE_MIN", "60")) * 60,
+        keep_turns=2 * MAX_TURNS,
+    )
+CHAT_FLIGHT = SingleFlight("chat")
+
+# Prompt /chat theo ngân sách token: cửa sổ CHAT_HISTORY_WINDOW lượt gần nhất + bộ nhớ tóm tắt các lượt cũ hơn
+CHAT_PROMPT = ChatPromptBuilder(
+    budget=int(os.getenv("CHAT_PROMPT_BUDGET", "6000")),
+    window=int(os.getenv("CHAT_HISTORY_WINDOW", "6")),
+    memory_max_tokens=int(os.getenv("CHAT_MEMORY_MAX_TOKENS", "400")),
+)
 
 SHOPPER_ASSISTANT_SYSTEM = """
 Bạn là HealthScan AI – chuyên gia dinh dưỡng lâm sàng & “coach” mua sắm siêu thị.
@@ -1046,15 +1668,65 @@ GỢI Ý TỐT HƠN
 - Khi người dùng bấm **Sản phẩm thay thế** hoặc nói **Bổ sung sản phẩm thay thế**: luôn hiển thị theo thứ tự từ phù hợp nhất trở xuống; 5 sản phẩm mỗi lần.
 """
 
-def _format_history_for_prompt(hist):
-    lines = []
-    for h in hist[-MAX_TURNS:]:
-        who = "Người dùng" if h["role"] == "user" else "Assistant"
-        lines.append(f"{who}: {h['text']}")
-    return "\n".join(lines)
+# Phân trang đề xuất không trạng thái: con trỏ ký HMAC (danh mục + vân tay hồ sơ + offset) đi kèm câu trả lời
+# (reco_cursor trong response và trong lượt assistant của CHAT_HIST); bảng xếp hạng chỉ là cache, tính lại được
+RECO_PAGE_SIZE = 5
+RECO_MAX_ITEMS = 50
+RECO_RANK_TTL_S = float(os.getenv("RECO_RANK_TTL_S", "600"))
+RECO_CURSOR = CursorSigner((os.getenv("RECO_CURSOR_SECRET") or
+                            hashlib.sha256(f"reco-cursor:{API_KEY}".encode()).hexdigest()).encode())
+
+def _profile_fingerprint(profile):
+    """Chỉ các đặc trưng ảnh hưởng xếp hạng trong _recommend_core: mục tiêu + dị ứng."""
+    return fingerprint(_goals_text(profile), sorted(_profile_allergy_set(profile)))
+
+def _reco_ranking(cat, fp, profile, label):
+    loaded = CATALOG_DATA.current   # khoá theo phiên bản catalog: nạp lại → xếp hạng mới
+    key = f"{loaded.version}|{cat}|{fp}"
+    items = STATE.get("reco", key)
+    if items is not None:
+        return items
+    rec = _recommend_core(profile, label, k=RECO_MAX_ITEMS, category=cat, data=loaded.value)
+    if not rec.get("ok"):
+        return None
+    STATE.set("reco", key, rec["items"], ttl=RECO_RANK_TTL_S)
+    return rec["items"]
 
-# Bộ nhớ phân trang đề xuất theo chat_id
-RECO_STATE = {}  # chat_id -> {"index": int, "items": list_cached}
+def _last_reco_cursor(chat_id):
+    for h in reversed(CHAT_HIST.history(chat_id)):
+        if h.get("reco_cursor"):
+            return h["reco_cursor"]
+    return None
+
+def _reco_page(chat_id, profile, label, token=None):
+    """Trang đề xuất tiếp theo → (markdown, cursor kế tiếp | None). Con trỏ lấy từ body, nếu không có thì từ lịch sử chat."""
+    fp = _profile_fingerprint(profile)
+    cur = None
+    token = token or _last_reco_cursor(chat_id)
+    if token:
+        try:
+            cur = RECO_CURSOR.decode(token)
+        except CursorError as e:
+            print(f"[WARN] reco cursor rejected: {e}")
+    if cur and cur.get("fp") == fp and cur.get("c"):
+        cat, start = cur["c"], max(0, int(cur.get("o") or 0))
+    else:   # chưa có con trỏ / hồ sơ đã đổi → bắt đầu lại
+        cat, start = _guess_category_from_label(label), 0
+
+    items = _reco_ranking(cat, fp, profile, label)
+    if items is None:
+        return "Xin lỗi, catalog chưa sẵn sàng để đề xuất.", None
+
+    end = min(start + RECO_PAGE_SIZE, len(items))
+    rows = []
+    rows.append("**Trả lời nhanh**: Dưới đây là các sản phẩm thay thế xếp từ phù hợp nhất trở xuống.")
+    rows.append(f"- Nhóm danh mục: {cat or '—'}")
+    rows.append("")
+    rows += _format_reco_items(items[start:end])
+    if end < len(items):
+        rows.append("")
+        rows.append("- Nhập “Bổ sung sản phẩm thay thế” để xem thêm 5 lựa chọn tiếp theo.")
+    return "\n".join(rows), RECO_CURSOR.encode({"c": cat, "fp": fp, "o": end})
 
 def _format_reco_items(items):
     rows = []
@@ -1090,40 +1762,50 @@ def asr_proxy():
         if not f or f.filename == "":
             return jsonify(ok=False, error="missing 'file' field"), 400
         files = {"file": (f.filename, f.stream, f.mimetype or "audio/m4a")}
-        data = None
     else:
-        data = request.get_json(silent=True) or {}
-        b64 = data.get("audio_base64") or data.get("file_base64") or ""
-        if not b64:
-            return jsonify(ok=False, error="missing audio data"), 400
-        if b64.startswith("data:"):
-            b64 = b64.split(",", 1)[1]
-        raw = base64.b64decode(b64, validate=True)
-        files = {"file": ("upload.m4a", io.BytesIO(raw), "audio/m4a")}
+        upload, err = _asr_file_from_json(request.get_json(silent=True) or {})
+        if err:
+            return jsonify(ok=False, error=err), 400
+        name, raw, mime = upload
+        files = {"file": (name, io.BytesIO(raw), mime)}
 
     try:
-        r = requests.post(ASR_UPSTREAM, files=files, json=data if files is None else None, timeout=60)
-        ct = r.headers.get("content-type", "")
-        if "application/json" in ct:
-            js = r.json()
-            text = js.get("text") or js.get("transcript") or js.get("result") or ""
-        else:
-            text = r.text or ""
-
-        if not r.ok:
-            return jsonify(ok=False, status=r.status_code, error=text[:1000]), r.status_code
-
-        return jsonify(ok=True, text=text)
+        r = requests.post(ASR_UPSTREAM, files=files, timeout=ASR_TIMEOUT_S)
+        payload, status = _asr_payload(r.status_code, r.headers.get("content-type", ""), r.content)
+        return jsonify(payload), status
     except Exception as e:
         return jsonify(ok=False, error=f"ASR proxy error: {e}"), 502
 
+def _asr_file_from_json(data):
+    """Body JSON {audio_base64|file_base64} → ((filename, bytes, mime), None) hoặc (None, lỗi). Dùng chung sync/ASGI."""
+    b64 = data.get("audio_base64") or data.get("file_base64") or ""
+    if not b64:
+        return None, "missing audio data"
+    if b64.startswith("data:"):
+        b64 = b64.split(",", 1)[1]
+    return ("upload.m4a", base64.b64decode(b64, validate=True), "audio/m4a"), None
+
+def _asr_payload(status_code, content_type, raw: bytes):
+    """Chuẩn hoá phản hồi upstream ASR → (payload, http_status)."""
+    if "application/json" in (content_type or ""):
+        js = json.loads(raw or b"{}")
+        text = js.get("text") or js.get("transcript") or js.get("result") or ""
+    else:
+        text = (raw or b"").decode("utf-8", "replace")
+    if status_code >= 400:
+        return {"ok": False, "status": status_code, "error": text[:1000]}, status_code
+    return {"ok": True, "text": text}, 200
 
-@app.route("/chat", methods=["POST","OPTIONS"])
-def chat():
-    if request.method == "OPTIONS":
-        return ("", 204)
 
-    body = request.get_json(silent=True) or {}
+def _chat_save(chat_id, reply, extra=None):
+    CHAT_HIST.append(chat_id, dict({"role": "assistant", "text": reply, "ts": datetime.utcnow().isoformat()}, **(extra or {})))
+
+def _chat_begin(body):
+    """
+    Phần chung của /chat và /chat/stream: ghi lượt user, xử lý intent cố định.
+    Trả về (chat_id, built_in_reply, context_blocks, error, extra) — đúng một trong built_in_reply/context_blocks/error
+    khác None; extra là các trường thêm vào response và lượt assistant (vd. reco_cursor).
+    """
     message = (body.get("message") or "").strip()
     profile = body.get("profile") or {}
     label = body.get("label") or {}
@@ -1131,15 +1813,15 @@ def chat():
     chat_id = body.get("chat_id") or uuid.uuid4().hex
 
     if not message:
-        return jsonify(ok=False, error="Missing 'message'"), 400
+        return chat_id, None, None, "Missing 'message'", {}
     if reset:
-        CHAT_HIST.pop(chat_id, None)
-        RECO_STATE.pop(chat_id, None)
+        CHAT_HIST.reset(chat_id)
 
-    CHAT_HIST[chat_id].append({"role": "user", "text": message, "ts": datetime.utcnow().isoformat()})
+    CHAT_HIST.append(chat_id, {"role": "user", "text": message, "ts": datetime.utcnow().isoformat()})
 
     intent = _detect_intent(message)
     built_in_reply = None
+    extra = {}
 
     if intent == "SHOW_PROFILE":
         built_in_reply = _render_profile_md(profile)
@@ -1148,73 +1830,88 @@ def chat():
     elif intent == "SHOW_NUTRITION":
         built_in_reply = _render_nutrition_md(label)
     elif intent == "RECOMMEND":
-        state = RECO_STATE.get(chat_id)
-        if not state:
-            rec = _recommend_core(profile, label, k=50)
-            if not rec.get("ok"):
-                built_in_reply = "Xin lỗi, catalog chưa sẵn sàng để đề xuất."
-            else:
-                RECO_STATE[chat_id] = {"index": 0, "items": rec["items"], "cat": rec["category_guess"]}
-                state = RECO_STATE[chat_id]
-
-        if state:
-            start = state["index"]
-            end = min(start + 5, len(state["items"]))
-            batch = state["items"][start:end]
-            state["index"] = end
-            rows = []
-            rows.append("**Trả lời nhanh**: Dưới đây là các sản phẩm thay thế xếp từ phù hợp nhất trở xuống.")
-            rows.append(f"- Nhóm danh mục: {state.get('cat','—')}")
-            rows.append("")
-            rows += _format_reco_items(batch)
-            if end < len(state["items"]):
-                rows.append("")
-                rows.append("- Nhập “Bổ sung sản phẩm thay thế” để xem thêm 5 lựa chọn tiếp theo.")
-            built_in_reply = "\n".join(rows)
+        built_in_reply, cursor = _reco_page(chat_id, profile, label, body.get("reco_cursor"))
+        if cursor:
+            extra["reco_cursor"] = cursor
 
     if built_in_reply:
-        reply = _normalize_md(built_in_reply)
-        CHAT_HIST[chat_id].append({"role": "assistant", "text": reply, "ts": datetime.utcnow().isoformat()})
-        chat_dump = {"chat_id": chat_id, "updated_at": datetime.utcnow().isoformat(),
-                     "history": CHAT_HIST[chat_id][-MAX_TURNS:]}
-        with open(OUT_DIR / f"chat_{chat_id}.json", "w", encoding="utf-8") as fp:
-            json.dump(chat_dump, fp, ensure_ascii=False, indent=2)
-        return jsonify(ok=True, chat_id=chat_id, reply_markdown=reply)
+        return chat_id, _normalize_md(built_in_reply), None, None, extra
 
     facts = _summarize_profile_facts(profile)
     metrics = _extract_metrics(label)
     targets = _targets_for_profile(profile)
-    context_blocks = [
-        {"text": SHOPPER_ASSISTANT_SYSTEM},
-        {"text": "HỒ SƠ (tóm tắt chuẩn hoá):"},
-        {"text": facts},
-        {"text": "SỐ LIỆU NHÃN (JSON):"},
-        {"text": json.dumps(metrics, ensure_ascii=False)},
-        {"text": "NGƯỠNG (JSON):"},
-        {"text": json.dumps(targets, ensure_ascii=False)},
-        {"text": "HỘI THOẠI GẦN NHẤT:"},
-        {"text": _format_history_for_prompt(CHAT_HIST[chat_id])},
-        {"text": f"CÂU HỎI HIỆN TẠI:\n{message}"},
+    fixed = [
+        SHOPPER_ASSISTANT_SYSTEM,
+        "HỒ SƠ (tóm tắt chuẩn hoá):", facts,
+        "SỐ LIỆU NHÃN (JSON):", json.dumps(metrics, ensure_ascii=False),
+        "NGƯỠNG (JSON):", json.dumps(targets, ensure_ascii=False),
     ]
-    try:
-        result = call_gemini_with_backoff(LLM_MODEL, context_blocks)
-        reply_raw = (result.text or "").strip()
-        reply = _normalize_md(reply_raw)
-    except Exception as e:
-        return jsonify(ok=False, error="Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))), 502
+    # lượt cuối trong lịch sử chính là câu hỏi vừa ghi → không lặp lại trong phần hội thoại
+    history = CHAT_HIST.history(chat_id, last=2 * MAX_TURNS)[:-1]
+    context_blocks, usage = CHAT_PROMPT.build(fixed, history, message)
+    extra["prompt_tokens"] = usage["prompt_tokens"]
+    if usage["over_budget"]:
+        print(f"[WARN] /chat {chat_id}: prompt {usage['prompt_tokens']} tokens > budget {usage['budget']}")
+    return chat_id, None, context_blocks, None, extra
 
-    CHAT_HIST[chat_id].append({"role": "assistant", "text": reply, "ts": datetime.utcnow().isoformat()})
-    chat_dump = {
-        "chat_id": chat_id,
-        "updated_at": datetime.utcnow().isoformat(),
-        "history": CHAT_HIST[chat_id][-MAX_TURNS:],
-    }
-    with open(OUT_DIR / f"chat_{chat_id}.json", "w", encoding="utf-8") as fp:
-        json.dump(chat_dump, fp, ensure_ascii=False, indent=2)
+@app.route("/chat", methods=["POST","OPTIONS"])
+def chat():
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    chat_id, reply, context_blocks, err, extra = _chat_begin(request.get_json(silent=True) or {})
+    if err:
+        return jsonify(ok=False, error=err), 400
+
+    if reply is None:
+        try:
+            reply_raw = _generate_text_once(CHAT_FLIGHT, LLM_MODEL, context_blocks).strip()
+            reply = _normalize_md(reply_raw)
+        except Exception as e:
+            return jsonify(ok=False, error="Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))), 502
+
+    _chat_save(chat_id, reply, extra)
+    return jsonify(ok=True, chat_id=chat_id, reply_markdown=reply, **extra)
+
+@app.route("/chat/stream", methods=["POST","OPTIONS"])
+def chat_stream():
+    """SSE: meta {"chat_id"} → delta {"text"} theo từng đoạn → done {"chat_id","reply_markdown"}; lưu CHAT_HIST khi xong."""
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    chat_id, reply, context_blocks, err, extra = _chat_begin(request.get_json(silent=True) or {})
+    if err:
+        return jsonify(ok=False, error=err), 400
+
+    def events():
+        yield _sse("meta", {"chat_id": chat_id})
+        if reply is not None:
+            yield _sse("delta", {"text": reply})
+            _chat_save(chat_id, reply, extra)
+            yield _sse("done", dict({"ok": True, "chat_id": chat_id, "reply_markdown": reply}, **extra))
+            return
+
+        norm = _MdLineStream()
+        try:
+            for text in stream_gemini_with_backoff(LLM_MODEL, context_blocks, kind="chat"):
+                out = norm.feed(text)
+                if out:
+                    yield _sse("delta", {"text": out})
+            out = norm.flush()
+            if out:
+                yield _sse("delta", {"text": out})
+        except Exception as e:
+            yield _sse("error", {"ok": False, "chat_id": chat_id,
+                                 "error": "Xin lỗi, có lỗi khi xử lý:\nGemini error: {0}\n{1}".format(type(e).__name__, str(e))})
+            return
+
+        final = norm.text().strip()
+        _chat_save(chat_id, final, extra)
+        yield _sse("done", dict({"ok": True, "chat_id": chat_id, "reply_markdown": final}, **extra))
 
-    return jsonify(ok=True, chat_id=chat_id, reply_markdown=reply)
+    return _sse_response(events())
 
 # ==== Run ====
 if __name__ == "__main__":
-    print(f"[INFO] Using catalog: {CATALOG_PATH}")
+    print(f"[INFO] Using catalog: {getattr(_catalog().catalog, 'path', None) or CATALOG_PATH}")
     app.run(host="0.0.0.0", port=PORT, debug=True)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+singleflight.py
+- Gộp các lời gọi đồng thời có cùng khoá: request đầu tiên thực thi, các request trùng chờ và dùng chung kết quả
+- Dùng cho /label/analyze (khoá = cache_key), /advice và /chat (khoá = hash prompt)
+- ado(): bản asyncio cho chế độ ASGI (gộp trong cùng event loop)
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "dups")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.dups = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._acalls = {}   # key -> asyncio.Future (chế độ ASGI)
+        self.requests = 0   # tổng số lần gọi do()
+        self.executed = 0   # số lần thực sự chạy fn
+        self.coalesced = 0  # số lần được gộp vào lời gọi đang chạy
+
+    def do(self, key, fn):
+        """Chạy fn() một lần cho mỗi key đang bay; trả về (result, shared). Lỗi của leader được ném lại cho mọi follower."""
+        with self._lock:
+            self.requests += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                call.dups += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+    async def ado(self, key, afn):
+        """Như do() nhưng cho coroutine; các request trùng await cùng một Future."""
+        with self._lock:
+            self.requests += 1
+            fut = self._acalls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._acalls[key] = asyncio.get_running_loop().create_future()
+                fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # không cảnh báo "never retrieved"
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return await asyncio.shield(fut), True
+
+        try:
+            result = await afn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+        finally:
+            with self._lock:
+                self._acalls.pop(key, None)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "executed": self.executed,
+                    "coalesced": self.coalesced, "in_flight": len(self._calls) + len(self._acalls)}
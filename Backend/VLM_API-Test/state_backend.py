@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+state_backend.py
+- Trạng thái dùng chung giữa các request (lịch sử chat, bảng xếp hạng đề xuất, trạng thái job)
+  sau một giao diện nhỏ kiểu Redis: get/set/delete (có TTL) + rpush/lrange cho danh sách
+- MemoryBackend: trong process (mặc định, chạy 1 process như app.run)
+- SQLiteBackend: một file SQLite (WAL) dùng chung cho nhiều worker trên cùng máy
+- RedisBackend: cùng giao diện trên Redis/Valkey/KeyDB (cần `pip install redis`)
+Chọn bằng STATE_BACKEND = memory | sqlite:///đường/dẫn.sqlite3 | redis://host:6379/0
+"""
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class MemoryBackend:
+    kind = "memory"
+    shared = False
+
+    def __init__(self, default_max: int = 1024, limits: dict = None):
+        self.default_max = default_max
+        self.limits = limits or {}
+        self._lock = threading.Lock()
+        self._ns = {}          # ns -> OrderedDict key -> (value, expires_at | None)
+
+    def _bucket(self, ns):
+        b = self._ns.get(ns)
+        if b is None:
+            b = self._ns[ns] = OrderedDict()
+        return b
+
+    def _live(self, b, key, now):
+        hit = b.get(key)
+        if hit is None:
+            return None
+        if hit[1] is not None and hit[1] <= now:
+            b.pop(key, None)
+            return None
+        b.move_to_end(key)
+        return hit
+
+    def _store(self, ns, b, key, value, ttl):
+        b[key] = (value, time.time() + ttl if ttl else None)
+        b.move_to_end(key)
+        cap = self.limits.get(ns, self.default_max)
+        while len(b) > cap:
+            b.popitem(last=False)
+
+    def get(self, ns: str, key: str):
+        with self._lock:
+            hit = self._live(self._bucket(ns), key, time.time())
+            return hit[0] if hit else None
+
+    def set(self, ns: str, key: str, value, ttl: float = None):
+        with self._lock:
+            self._store(ns, self._bucket(ns), key, value, ttl)
+
+    def delete(self, ns: str, key: str):
+        with self._lock:
+            self._bucket(ns).pop(key, None)
+
+    def rpush(self, ns: str, key: str, value, max_len: int = None, ttl: float = None) -> int:
+        with self._lock:
+            b = self._bucket(ns)
+            hit = self._live(b, key, time.time())
+            items = hit[0] if hit else []
+            items.append(value)
+            if max_len and len(items) > max_len:
+                del items[:len(items) - max_len]
+            self._store(ns, b, key, items, ttl)
+            return len(items)
+
+    def lrange(self, ns: str, key: str, last: int = None) -> list:
+        with self._lock:
+            hit = self._live(self._bucket(ns), key, time.time())
+            items = list(hit[0]) if hit else []
+        return items[-last:] if last else items
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"kind": self.kind, "namespaces": {ns: len(b) for ns, b in self._ns.items()}}
+
+
+class SQLiteBackend:
+    """Nhiều process cùng mở một file; SQLite lo khoá ghi. Giá trị lưu dạng JSON."""
+
+    kind = "sqlite"
+    shared = True
+    PURGE_EVERY = 256
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS kv (
+                          ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL,
+                          PRIMARY KEY (ns, key))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS lists (
+                          seq INTEGER PRIMARY KEY AUTOINCREMENT, ns TEXT NOT NULL, key TEXT NOT NULL,
+                          value TEXT NOT NULL, expires_at REAL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS lists_key ON lists(ns, key, seq)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _maybe_purge(self, conn, now):
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            conn.execute("DELETE FROM lists WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def get(self, ns: str, key: str):
+        row = self._conn().execute("SELECT value FROM kv WHERE ns=? AND key=? AND (expires_at IS NULL OR expires_at > ?)",
+                                   (ns, key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, ns: str, key: str, value, ttl: float = None):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO kv VALUES (?,?,?,?)",
+                         (ns, key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None))
+            self._maybe_purge(conn, now)
+
+    def delete(self, ns: str, key: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM kv WHERE ns=? AND key=?", (ns, key))
+            conn.execute("DELETE FROM lists WHERE ns=? AND key=?", (ns, key))
+
+    def rpush(self, ns: str, key: str, value, max_len: int = None, ttl: float = None) -> int:
+        now = time.time()
+        exp = now + ttl if ttl else None
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO lists(ns,key,value,expires_at) VALUES (?,?,?,?)",
+                         (ns, key, json.dumps(value, ensure_ascii=False), exp))
+            if ttl:
+                conn.execute("UPDATE lists SET expires_at=? WHERE ns=? AND key=?", (exp, ns, key))
+            if max_len:
+                conn.execute("""DELETE FROM lists WHERE ns=? AND key=? AND seq NOT IN
+                                (SELECT seq FROM lists WHERE ns=? AND key=? ORDER BY seq DESC LIMIT ?)""",
+                             (ns, key, ns, key, max_len))
+            n = conn.execute("SELECT COUNT(*) FROM lists WHERE ns=? AND key=?", (ns, key)).fetchone()[0]
+            self._maybe_purge(conn, now)
+        return n
+
+    def lrange(self, ns: str, key: str, last: int = None) -> list:
+        q = "SELECT value FROM lists WHERE ns=? AND key=? AND (expires_at IS NULL OR expires_at > ?) ORDER BY seq DESC"
+        args = [ns, key, time.time()]
+        if last:
+            q += " LIMIT ?"
+            args.append(last)
+        rows = self._conn().execute(q, args).fetchall()
+        return [json.loads(r[0]) for r in reversed(rows)]
+
+    def stats(self) -> dict:
+        conn = self._conn()
+        return {"kind": self.kind, "db": str(self.db_path),
+                "kv": conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0],
+                "list_items": conn.execute("SELECT COUNT(*) FROM lists").fetchone()[0]}
+
+
+class RedisBackend:
+    kind = "redis"
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "healthscan"):
+        import redis   # phụ thuộc tuỳ chọn
+        self._r = redis.Redis.from_url(url)
+        self.url = url
+        self.prefix = prefix
+
+    def _k(self, ns, key):
+        return f"{self.prefix}:{ns}:{key}"
+
+    @staticmethod
+    def _ttl_ms(ttl: float) -> int:
+        """TTL theo mili giây, làm tròn lên, tối thiểu 1: int(0.5) = 0 bị Redis từ chối (invalid expire time)."""
+        return max(1, math.ceil(ttl * 1000))
+
+    def get(self, ns: str, key: str):
+        raw = self._r.get(self._k(ns, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, ns: str, key: str, value, ttl: float = None):
+        self._r.set(self._k(ns, key), json.dumps(value, ensure_ascii=False), px=self._ttl_ms(ttl) if ttl else None)
+
+    def delete(self, ns: str, key: str):
+        self._r.delete(self._k(ns, key))
+
+    def rpush(self, ns: str, key: str, value, max_len: int = None, ttl: float = None) -> int:
+        k = self._k(ns, key)
+        p = self._r.pipeline()
+        p.rpush(k, json.dumps(value, ensure_ascii=False))
+        if max_len:
+            p.ltrim(k, -max_len, -1)
+        if ttl:
+            p.pexpire(k, self._ttl_ms(ttl))
+        p.llen(k)
+        return p.execute()[-1]
+
+    def lrange(self, ns: str, key: str, last: int = None) -> list:
+        return [json.loads(x) for x in self._r.lrange(self._k(ns, key), -last if last else 0, -1)]
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "url": self.url.split("@")[-1]}
+
+
+def make_backend(spec: str, default_dir: Path, memory_limits: dict = None):
+    spec = (spec or "memory").strip()
+    if spec == "memory":
+        return MemoryBackend(limits=memory_limits)
+    if spec == "sqlite":
+        return SQLiteBackend(Path(default_dir) / "state.sqlite3")
+    if spec.startswith("sqlite:///"):
+        return SQLiteBackend(Path(spec[len("sqlite:///"):]))
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(spec)
+    raise ValueError(f"Unknown STATE_BACKEND: {spec}")
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+store_index.py
+- Chỉ mục cửa hàng dựng lúc nạp (cùng khối catalog): category / bucket → cửa hàng, chuỗi (chains) đã chuẩn hoá
+- Hãng ↔ chuỗi (chuỗi con hai chiều, chữ thường như _load_stores: str(x).lower()) tính sẵn lúc nạp cho
+  tập hãng của catalog; hãng lạ (không có trong catalog) tính tại chỗ, không nhớ
+- Danh sách cửa hàng cho mỗi cặp (hãng, category) nhớ lại trong LRU có giới hạn (memo_size)
+- Cách chấm giữ nguyên bản cũ: +2 nếu hãng khớp chuỗi, +1 nếu bucket / category có trong cửa hàng,
+  sắp giảm dần (ổn định, theo thứ tự file) và lấy topn
+"""
+import threading
+from collections import OrderedDict
+
+_NONE = frozenset()
+
+
+def _lower(brand) -> str:
+    return str(brand or "").lower()
+
+
+class StoreIndex:
+    def __init__(self, stores: list, bucket_of, brands=(), memo_size: int = 4096):
+        """
+        stores: list dict như _load_stores (chains / categories đã chữ thường); bucket_of(category) -> bucket;
+        brands: hãng của các item trong catalog (tính sẵn bảng hãng → cửa hàng).
+        """
+        self.stores = stores
+        self._bucket_of = bucket_of
+        self._chains = sorted({ch for s in stores for ch in s["chains"]})
+        self._chain_stores = {ch: {i for i, s in enumerate(stores) if ch in s["chains"]} for ch in self._chains}
+        self.by_category = {}
+        for i, s in enumerate(stores):
+            for c in s["categories"]:
+                self.by_category.setdefault(c, set()).add(i)
+        self._brands = {}         # hãng (đã chuẩn hoá) → tập vị trí cửa hàng; chỉ đọc sau khi dựng
+        for b in {_lower(x) for x in brands} - {""}:
+            self._brands[b] = self._match(b)
+        self.memo_size = memo_size
+        self._memo = OrderedDict()   # (hãng, category, topn) → danh sách kết quả (LRU)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stores)
+
+    def _match(self, brand: str) -> frozenset:
+        hit = set()
+        for ch in self._chains:
+            if brand in ch or ch in brand:
+                hit |= self._chain_stores[ch]
+        return frozenset(hit) if hit else _NONE
+
+    def brand_stores(self, brand) -> frozenset:
+        """Cửa hàng có chuỗi khớp hãng (brand in chain hoặc chain in brand)."""
+        brand = _lower(brand)
+        if not brand:
+            return _NONE
+        hit = self._brands.get(brand)
+        return hit if hit is not None else self._match(brand)
+
+    def ranked(self, brand, category, topn: int = 3) -> list:
+        """Danh sách cửa hàng đã nhớ (dùng chung giữa các request, không sửa tại chỗ)."""
+        brand, cat = _lower(brand), _lower(category)
+        key = (brand, cat, topn)
+        with self._lock:
+            out = self._memo.get(key)
+            if out is not None:
+                self._memo.move_to_end(key)
+                return out
+        by_brand = self.brand_stores(brand)
+        by_cat = self.by_category.get(self._bucket_of(cat), set()) | self.by_category.get(cat, set())
+        scored = [(2 * (i in by_brand) + (i in by_cat), self.stores[i]) for i in sorted(by_brand | by_cat)]
+        scored.sort(key=lambda x: x[0], reverse=True)
+        out = [{"store": s["store"], "district": s["district"], "type": s.get("type", "supermarket")}
+               for _, s in scored[:topn]]
+        with self._lock:
+            self._memo[key] = out
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return out
+
+    def stats(self) -> dict:
+        return {"stores": len(self.stores), "chains": len(self._chains), "categories": len(self.by_category),
+                "brands": len(self._brands), "memo": len(self._memo), "memo_size": self.memo_size}
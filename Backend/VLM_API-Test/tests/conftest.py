@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+conftest.py
+- Chạy test trong thư mục tạm (OUT_DIR), không theo dõi file catalog, model Gemini thay bằng bản giả
+    cd Backend/VLM_API-Test && python -m pytest -q tests
+"""
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+os.environ["OUT_DIR"] = tempfile.mkdtemp(prefix="vlm_test_")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ["CATALOG_WATCH_S"] = "0"
+
+import pytest
+
+LABEL = {"language": "vi", "ingredients_raw": "đường, sữa", "ingredients": [{"name": "Đường"}],
+         "nutrition_facts": {"nutrients": []}, "warnings": []}
+
+
+class FakeModel:
+    def __init__(self, text: str):
+        self.text = text
+        self.calls = 0
+
+    def generate_content(self, parts, **kw):
+        self.calls += 1
+        if kw.get("stream"):
+            return iter([FakeModel(t) for t in self.text.split(" ")])
+        return self
+
+
+@pytest.fixture(scope="session")
+def server():
+    import server as srv
+    return srv
+
+
+@pytest.fixture
+def vlm(server, monkeypatch):
+    model = FakeModel(json.dumps(LABEL, ensure_ascii=False))
+    monkeypatch.setattr(server, "VLM_MODEL", model)
+    return model
+
+
+@pytest.fixture
+def llm(server, monkeypatch):
+    model = FakeModel("## Trả lời nhanh\n* ok")
+    monkeypatch.setattr(server, "LLM_MODEL", model)
+    return model
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
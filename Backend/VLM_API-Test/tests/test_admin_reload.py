@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from hot_reload import HotReloader
+
+
+def test_reload_disabled_without_token(server, client, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "")
+    r = client.post("/admin/reload", environ_base={"REMOTE_ADDR": "127.0.0.1"})
+    assert r.status_code == 403
+
+
+def test_reload_requires_matching_token(server, client, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "s3cret")
+    assert client.post("/admin/reload", headers={"X-Admin-Token": "nope"}).status_code == 403
+    before = server.STATE.get("admin", "catalog_epoch")
+    r = client.post("/admin/reload", headers={"X-Admin-Token": "s3cret"})
+    assert r.status_code == 200 and r.get_json()["reloaded"] is True
+    assert server.STATE.get("admin", "catalog_epoch") not in (None, before)
+
+
+def test_shared_epoch_triggers_reload_in_other_workers(tmp_path):
+    shared, builds = {"epoch": 1}, []
+    src = tmp_path / "src.json"
+    src.write_text("[]")
+
+    def build():
+        builds.append(1)
+        return len(builds)
+
+    other = HotReloader("catalog", build, lambda: [src], epoch=lambda: shared["epoch"])
+    assert other.reload() == {"reloaded": False, "version": other.current.version}
+    shared["epoch"] = 2                                # worker khác nhận /admin/reload
+    assert other.reload()["reloaded"] is True and other.current.value == 2
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import time
+
+from advice_engine import CircuitBreaker
+from conftest import LABEL
+from response_cache import ResponseCache
+
+PROFILE = {"goals": {"selected": ["Giảm cân"]}}
+
+
+def _half_open(server, monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    monkeypatch.setattr(server, "ADVICE_BREAKER", breaker)
+    monkeypatch.setattr(server.ADVICE_CACHE, "get", lambda key: None)
+    return breaker
+
+
+def test_stream_closed_mid_probe_releases_breaker(server, client, llm, monkeypatch):
+    breaker = _half_open(server, monkeypatch)
+    r = client.post("/advice/stream", json={"profile": PROFILE, "label": LABEL}, buffered=False)
+    it = iter(r.response)
+    next(it)            # meta
+    next(it)            # delta đầu tiên: đang giữ lượt thử half-open
+    assert breaker._probing
+    r.close()
+    assert not breaker._probing and breaker.allow()
+
+
+def test_stream_closed_before_start_keeps_no_probe(server, client, llm, monkeypatch):
+    breaker = _half_open(server, monkeypatch)
+    client.post("/advice/stream", json={"profile": PROFILE, "label": LABEL}, buffered=False).close()
+    assert breaker.allow()
+
+
+def test_cache_miss_writes_advice_once(server, client, llm, monkeypatch):
+    puts = []
+    monkeypatch.setattr(server.ADVICE_CACHE, "get", lambda key: None)
+    monkeypatch.setattr(server.ADVICE_CACHE, "put", lambda key, value: puts.append(key))
+    assert client.post("/advice", json={"profile": PROFILE, "label": LABEL}).get_json()["engine"] == "gemini"
+    deadline = time.time() + 2
+    while not puts and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert len(puts) == 1
+
+
+def test_disk_cache_purges_on_interval(tmp_path):
+    cache = ResponseCache("t", ttl_s=10, disk_path=tmp_path / "c.sqlite3", purge_every_s=3600)
+    cache.put("old", "a")
+    cache._conn().execute("UPDATE responses SET created_at = 0")
+    cache._conn().commit()
+    cache.put("new", "b")        # trong chu kỳ: chưa dọn
+    assert cache._conn().execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 2
+    cache._purged_at = 0
+    cache.put("newer", "c")
+    assert cache._conn().execute("SELECT key FROM responses ORDER BY key").fetchall() == [("new",), ("newer",)]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+import pytest
+
+asgi = pytest.importorskip("asgi")
+from starlette.testclient import TestClient
+
+
+@pytest.fixture
+def aclient(server):
+    with TestClient(asgi.app) as c:
+        yield c
+
+
+def test_chunked_body_over_limit_is_rejected(aclient, monkeypatch):
+    monkeypatch.setattr(asgi, "MAX_REQUEST_BYTES", 1024)
+
+    def chunks():                                   # không có Content-Length → Transfer-Encoding: chunked
+        for _ in range(8):
+            yield b"x" * 512
+
+    r = aclient.post("/chat", content=chunks(), headers={"content-type": "application/json"})
+    assert r.status_code == 413
+
+
+def test_advice_cache_write_runs_off_event_loop(monkeypatch):
+    seen = []
+    monkeypatch.setattr(asgi, "_cache_advice", lambda key, task: seen.append((key, threading.current_thread())))
+
+    async def run():
+        fut = asyncio.get_running_loop().create_future()
+        fut.set_result("ok")
+        asgi._cache_advice_later("k")(fut)
+        for _ in range(100):
+            if seen:
+                break
+            await asyncio.sleep(0.01)
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(run())
+    assert seen and seen[0][0] == "k" and seen[0][1] is not loop_thread
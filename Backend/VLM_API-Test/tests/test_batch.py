@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import io
+
+
+def test_too_many_images_rejected_before_decoding(server, client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(server, "LABEL_BATCH_MAX", 2)
+    monkeypatch.setattr(server, "_upload_from_b64", lambda *a: calls.append("b64"))
+    monkeypatch.setattr(server, "read_file_stream", lambda *a: calls.append("file"))
+
+    r = client.post("/label/analyze/batch", json={"images": ["aGk="] * 3})
+    assert r.status_code == 413 and "3 > 2" in r.get_json()["error"]
+    files = [(io.BytesIO(b"x"), f"{i}.jpg") for i in range(3)]
+    r = client.post("/label/analyze/batch", data={"images": files}, content_type="multipart/form-data")
+    assert r.status_code == 413
+    assert calls == []
+
+
+def test_empty_or_invalid_batch_is_400(client):
+    assert client.post("/label/analyze/batch", json={"images": "aGk="}).status_code == 400
+    assert client.post("/label/analyze/batch", json={}).status_code == 400
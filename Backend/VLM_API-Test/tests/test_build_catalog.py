@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import sys
+
+import build_catalog
+from catalog_loader import load_catalog
+from catalog_snapshot import CatalogSnapshot
+
+OFF = "Data/off_vn_no_nulls (1).json"
+
+
+def _build_from_dump(tmp_path, monkeypatch):
+    dump = tmp_path / "products.jsonl.gz"
+    with gzip.open(dump, "wt", encoding="utf-8") as fh:
+        for rec in json.load(open(OFF, encoding="utf-8")):
+            fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    snap = tmp_path / "catalog.snap"
+    monkeypatch.setattr(sys, "argv", ["build_catalog.py", str(dump), "--out", str(snap), "--country", "vietnam",
+                                      "--workers", "1", "--verify"])
+    build_catalog.main()
+    return dump, snap, tmp_path / "catalog.json"
+
+
+def test_dump_build_records_normalized_json_and_filter(tmp_path, monkeypatch):
+    dump, snap_dir, json_out = _build_from_dump(tmp_path, monkeypatch)
+    snap = CatalogSnapshot(snap_dir)
+    assert snap.meta["source"]["path"] == str(json_out.resolve())
+    assert snap.meta["source_filter"] == {"dump": str(dump.resolve()), "country": "en:vietnam"}
+    assert snap.source_mismatch(json_out) is None and snap.source_mismatch(dump) is not None
+    assert load_catalog(dump) == []                    # dump thô: không nổ, báo cần build
+
+
+def test_server_loads_dump_build_and_falls_back_to_json(server, tmp_path, monkeypatch):
+    _, snap_dir, json_out = _build_from_dump(tmp_path, monkeypatch)
+    monkeypatch.setattr(server, "CATALOG_PATH", str(json_out))
+    monkeypatch.setattr(server, "CATALOG_SNAPSHOT", str(snap_dir))
+    snap = server._load_catalog_any()
+    assert isinstance(snap, CatalogSnapshot)
+
+    json_out.write_text(json_out.read_text("utf-8") + " ", "utf-8")    # nguồn đổi → snapshot bị từ chối
+    items = server._load_catalog_any()
+    assert isinstance(items, list) and len(items) == len(snap) and items[0] == snap[0]
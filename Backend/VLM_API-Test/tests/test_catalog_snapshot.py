@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+
+from catalog_loader import load_catalog
+from catalog_snapshot import CatalogSnapshot, build_snapshot
+
+SRC = "Data/health_catalog.json"
+
+
+def _snapshot(tmp_path):
+    src = tmp_path / "catalog.json"
+    shutil.copy(SRC, src)
+    build_snapshot(load_catalog(src), tmp_path / "catalog.snap", source=src)
+    return src, CatalogSnapshot(tmp_path / "catalog.snap")
+
+
+def test_snapshot_round_trip(tmp_path):
+    src, snap = _snapshot(tmp_path)
+    items = load_catalog(src)
+    assert len(snap) == len(items) and all(snap[i] == items[i] for i in range(len(items)))
+
+
+def test_snapshot_matches_only_its_source(tmp_path):
+    src, snap = _snapshot(tmp_path)
+    assert snap.source_mismatch(src) is None
+    os.utime(src, (1, 1))                              # chỉ đổi mtime, nội dung y hệt
+    assert snap.source_mismatch(src) is None
+
+    other = tmp_path / "other.json"
+    shutil.copy("Data/off_vn_no_nulls (1).json", other)
+    assert "CATALOG_PATH" in snap.source_mismatch(other)
+
+    data = json.loads(src.read_text("utf-8"))
+    data[0]["name"] = data[0]["name"][::-1]            # cùng size, khác nội dung
+    src.write_text(json.dumps(data, ensure_ascii=False), "utf-8")
+    assert snap.source_mismatch(src) is not None
+
+
+def test_snapshot_allergen_bitsets_match_json(tmp_path, server):
+    src, snap = _snapshot(tmp_path)
+    from catalog_index import CatalogIndex
+    a, b = CatalogIndex(load_catalog(src), server._bucket_of), CatalogIndex(snap, server._bucket_of)
+    assert a.allergens.stats() == b.allergens.stats()
+    for allergies in ({"milk"}, {"nut", "gluten"}, {"Đậu phộng"}, {"tôm cua"}, {"không"}):
+        assert list(a.allergens.exclude(a._all, allergies)) == list(b.allergens.exclude(b._all, allergies))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import json
+
+
+def _sse_events(body: str):
+    out = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        out.append((lines["event"], json.loads(lines["data"])))
+    return out
+
+
+def test_streamed_turn_keeps_prompt_metadata(server, client, llm):
+    r = client.post("/chat/stream", json={"chat_id": "stream-meta", "message": "Sữa chua có tốt cho tiêu hoá không?"})
+    events = _sse_events(r.get_data(as_text=True))
+    done = events[-1][1]
+    assert events[-1][0] == "done" and "prompt_tokens" in done
+    saved = server.CHAT_HIST.history("stream-meta")[-1]
+    assert saved["role"] == "assistant" and saved["prompt_tokens"] == done["prompt_tokens"]
+
+
+def test_stream_and_plain_chat_store_same_fields(server, client, llm):
+    client.post("/chat", json={"chat_id": "plain-meta", "message": "Sữa chua có tốt cho tiêu hoá không?"})
+    client.post("/chat/stream", json={"chat_id": "stream-meta-2", "message": "Sữa chua có tốt cho tiêu hoá không?"}).get_data()
+    plain, stream = server.CHAT_HIST.history("plain-meta")[-1], server.CHAT_HIST.history("stream-meta-2")[-1]
+    assert set(plain) == set(stream)
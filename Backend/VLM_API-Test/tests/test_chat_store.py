@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from chat_store import ChatSessionStore
+
+
+def test_evicted_session_rehydrates_from_journal(tmp_path):
+    store = ChatSessionStore(tmp_path, max_sessions=2, keep_turns=3)
+    for i in range(5):
+        store.append("a", {"q": i})
+    store.append("b", {"q": "b"})
+    store.append("c", {"q": "c"})                  # đẩy "a" ra khỏi RAM
+    assert store.history("a") == [{"q": 2}, {"q": 3}, {"q": 4}]
+    assert store.stats()["rehydrated"] == 1
+    store.reset("a")
+    assert ChatSessionStore(tmp_path).history("a") == []
+
+
+def test_journal_io_of_one_session_does_not_block_others(tmp_path):
+    store = ChatSessionStore(tmp_path)
+    journal, started = store._journal, threading.Event()
+
+    def slow_journal(chat_id, rec):
+        if chat_id == "slow":
+            started.set()
+            time.sleep(0.5)
+        journal(chat_id, rec)
+
+    store._journal = slow_journal
+    t = threading.Thread(target=store.append, args=("slow", {"q": 1}))
+    t.start()
+    started.wait(2)
+    t0 = time.perf_counter()
+    store.append("fast", {"q": 1})
+    assert store.history("fast") == [{"q": 1}]
+    assert time.perf_counter() - t0 < 0.25
+    t.join()
+    assert store.history("slow") == [{"q": 1}]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import io
+
+from PIL import Image
+
+from ingest import ImageUpload
+
+
+def _upload(im, fmt="PNG", **save):
+    buf = io.BytesIO()
+    im.save(buf, fmt, **save)
+    return ImageUpload.from_bytes(buf.getvalue(), "x.jpg", "file", 1 << 24, 1 << 20)
+
+
+def _flat(size=(96, 64)):
+    return Image.new("RGB", size, (200, 40, 40))
+
+
+def test_rotated_image_is_sent_upright_even_if_not_smaller(server):
+    exif = Image.Exif()
+    exif[0x0112] = 6                                  # xoay 90°
+    up = _upload(_flat(), exif=exif)                  # PNG trơn màu: bản JPEG nén lại không nhỏ hơn
+    data, mime = server._normalize_image(Image.open(up.open()), up)
+    assert len(data) >= up.size and mime == "image/jpeg"
+    assert Image.open(io.BytesIO(data)).size == (64, 96)
+
+
+def test_unrotated_image_keeps_smaller_original(server):
+    up = _upload(_flat())
+    data, _ = server._normalize_image(Image.open(up.open()), up)
+    assert data == up.read()
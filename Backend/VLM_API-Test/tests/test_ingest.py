@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from ingest import ImageSink
+
+
+@pytest.fixture
+def sinks(server, monkeypatch):
+    made = []
+
+    def new_sink():
+        made.append(ImageSink(server.MAX_IMAGE_BYTES, server.UPLOAD_SPOOL_BYTES))
+        return made[-1]
+
+    monkeypatch.setattr(server, "_new_image_sink", new_sink)
+    return made
+
+
+def test_json_without_image_closes_sink(client, sinks):
+    r = client.post("/label/analyze", json={"barcode": ""})
+    assert r.status_code == 400 and r.get_json()["error"] == "missing image"
+    assert len(sinks) == 1 and sinks[0]._spool.closed
+
+
+def test_invalid_base64_closes_sink(client, sinks):
+    r = client.post("/label/analyze", json={"image_base64": "iVBO!!!!"})
+    assert r.status_code == 400
+    r = client.post("/label/analyze/batch", json={"images": ["iVBO!!!!"]})
+    assert r.get_json()["results"][0]["ok"] is False
+    assert len(sinks) == 2 and all(s._spool.closed for s in sinks)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+
+from label_store import SQLiteLabelStore
+
+
+def _wait(cond, timeout=3.0):
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_failed_flush_is_retried_not_dropped(tmp_path):
+    store = SQLiteLabelStore(tmp_path / "labels.sqlite3", flush_interval=0.01, max_backoff_s=0.05)
+    fails = [2]
+
+    write_batch = store._write_batch
+
+    def flaky_write(conn, *args):
+        if fails[0]:
+            fails[0] -= 1
+            conn.execute("INSERT INTO labels VALUES ('partial', '{}', 0, 0)")    # phải bị rollback
+            raise sqlite3.OperationalError("disk I/O error")
+        return write_batch(conn, *args)
+
+    store._write_batch = flaky_write
+    try:
+        store.put("k1", {"x": 1})
+        assert _wait(lambda: store.stats()["pending"] == 0)
+        st = store.stats()
+        assert st["flush_failures"] == 2 and "disk I/O error" in st["last_flush_error"]
+        assert st["writes"] == 1 and st["items"] == 1
+        store._pending.clear()
+        assert store.get("k1") == {"x": 1}
+    finally:
+        store.close()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+from PIL import Image, ImageDraw
+
+from phash_index import PHashIndex, dhash, informative, same_picture, signature
+
+
+def _solid(color, size=(640, 480)):
+    return Image.new("RGB", size, color)
+
+
+def _label_image(seed=0, size=(1200, 900)):
+    im = Image.new("RGB", size, "white")
+    d = ImageDraw.Draw(im)
+    for i in range(12):
+        d.rectangle([50 + i * 80, 50 + (i * 37 + seed * 113) % 600, 110 + i * 80, 700 + (i * 53) % 150],
+                    fill=(i * 20 % 255, 80, 160))
+    return im
+
+
+def _jpeg(im, quality=90) -> bytes:
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _analyze(client, data: bytes, name="x.jpg"):
+    r = client.post("/label/analyze", data={"image": (io.BytesIO(data), name)},
+                    content_type="multipart/form-data")
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()
+
+
+def test_flat_images_are_not_informative():
+    for color in ("red", "blue", "white", "black"):
+        assert not informative(dhash(_solid(color)))
+    assert informative(dhash(_label_image()))
+
+
+def test_signature_separates_colours_and_aspect():
+    assert not same_picture(signature(_solid("red")), signature(_solid("blue")))
+    assert not same_picture(signature(_label_image()), signature(_label_image(size=(900, 1200))))
+    assert same_picture(signature(_label_image()), signature(Image.open(io.BytesIO(_jpeg(_label_image(), 40)))))
+
+
+def test_solid_colour_uploads_each_call_model(client, vlm):
+    for color in ("red", "blue"):
+        body = _analyze(client, _jpeg(_solid(color)))
+        assert body["meta"]["cached"] is False
+    assert vlm.calls == 2
+
+
+def test_reencoded_photo_hits_near_duplicate(client, vlm):
+    _analyze(client, _jpeg(_label_image(seed=3), 95))
+    body = _analyze(client, _jpeg(_label_image(seed=3), 60))
+    assert body["meta"]["cached"] is True and body["meta"]["near_duplicate"] is True
+    assert vlm.calls == 1
+
+
+def test_index_log_add_discard_and_reload(tmp_path):
+    path = tmp_path / "phash.jsonl"
+    h, sig = dhash(_label_image()), signature(_label_image())
+    idx = PHashIndex(path)
+    idx.add("a", h, sig)
+    idx.add("b", h ^ 1, sig)
+    other = PHashIndex(path)                     # worker khác đọc cùng file log
+    assert [k for _, k, _ in other.search(h, 2)] == ["a", "b"]
+    idx.discard(["a"])
+    assert [k for _, k, _ in other.search(h, 2)] == ["b"]
+    assert len(PHashIndex(path)) == 1
+
+
+def test_reader_follows_compaction_by_other_worker(tmp_path):
+    path = tmp_path / "phash.jsonl"
+    h, sig = dhash(_label_image()), signature(_label_image())
+    writer, reader = PHashIndex(path), PHashIndex(path)
+    writer.add("keep", h, sig)
+    assert [k for _, k, _ in reader.search(h, 0)] == ["keep"]
+    for i in range(300):                         # đủ dòng xoá để writer nén log (thay file)
+        writer.add(f"tmp{i}", h ^ (1 << 63), sig)
+        writer.discard([f"tmp{i}"])
+    writer.add("new", h ^ 1, sig)
+    assert [k for _, k, _ in reader.search(h, 1)] == ["keep", "new"] and len(reader) == 2
+    # log bị viết lại tại chỗ (cùng inode, không ngắn đi, vd. inode được dùng lại) → nhận ra nhờ dòng "gen" đầu file
+    keep = json.dumps({"k": "keep", "h": f"{h:016x}", "s": sig}) + "\n"
+    size = path.stat().st_size
+    path.write_text(json.dumps({"gen": "other"}) + "\n" + keep * (size // len(keep) + 1), "utf-8")
+    assert [k for _, k, _ in reader.search(h, 1)] == ["keep"] and len(reader) == 1
+
+
+def test_missing_label_falls_through_to_next_hit(server, client, vlm):
+    im = _label_image(seed=5)
+    h, sig = dhash(im), signature(im)
+    server.PHASH_INDEX.add("gone-label", h, sig)  # dHash còn nhưng nhãn đã bị xoá khỏi kho
+    _analyze(client, _jpeg(im))
+    assert vlm.calls == 1
+    assert all(k != "gone-label" for _, k, _ in server.PHASH_INDEX.search(h, 0))
+
+
+def test_exact_cache_hit_skips_decode(server, client, vlm, monkeypatch):
+    data = _jpeg(_label_image(seed=7))
+    _analyze(client, data)
+    monkeypatch.setattr(server, "_decode_image", lambda upload: (_ for _ in ()).throw(AssertionError("decoded")))
+    body = _analyze(client, data, name="y.bin")
+    assert body["meta"]["cached"] is True and body["meta"]["mime"] == "image/jpeg"
+    assert vlm.calls == 1
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from reco_cursor import CursorError, CursorSigner
+
+
+@pytest.mark.parametrize("token", ["ă.b", "abc.é", "abc", "", "!!.!!"])
+def test_malformed_tokens_raise_cursor_error(token):
+    with pytest.raises(CursorError):
+        CursorSigner(b"k").decode(token)
+
+
+def test_round_trip_and_tampering():
+    s = CursorSigner(b"k")
+    token = s.encode({"c": "sữa", "o": 6})
+    assert s.decode(token) == {"c": "sữa", "o": 6}
+    with pytest.raises(CursorError):
+        CursorSigner(b"other").decode(token)
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from state_backend import RedisBackend
+
+
+class _Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self.calls.append((name, a, kw)) or (self if name == "pipeline" else [1])
+
+
+def test_redis_fractional_ttl_is_rounded_up_in_ms():
+    be = object.__new__(RedisBackend)
+    be.prefix, be._r = "t", _Recorder()
+    be.set("ns", "k", 1, ttl=0.25)
+    be.set("ns", "k", 1, ttl=1e-6)
+    be.rpush("ns", "l", 1, ttl=2.5)
+    calls = be._r.calls
+    assert calls[0][2]["px"] == 250 and calls[1][2]["px"] == 1
+    assert ("pexpire", ("t:ns:l", 2500), {}) in calls
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from catalog_loader import load_catalog
+from store_index import StoreIndex
+
+
+def _scan(item, stores, bucket_of, topn=3):
+    """Cách chấm gốc: duyệt mọi cửa hàng cho từng item."""
+    brand, cat = (item.get("brand") or "").lower(), (item.get("category") or "").lower()
+    bucket, scored = bucket_of(cat), []
+    for s in stores:
+        sc = 2 * bool(brand and any(brand in ch or ch in brand for ch in s["chains"]))
+        sc += (bucket in s["categories"]) or (cat in s["categories"])
+        if sc:
+            scored.append((sc, s))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [{"store": s["store"], "district": s["district"], "type": s.get("type", "supermarket")}
+            for _, s in scored[:topn]]
+
+
+def test_store_index_matches_full_scan(server):
+    stores = server._load_stores(server.STORES_PATH)
+    idx = StoreIndex(stores, server._bucket_of)
+    for path in ("Data/health_catalog.json", "Data/off_vn_no_nulls (1).json"):
+        for it in load_catalog(path):
+            for k in (1, 3, 10):
+                assert idx.ranked(it.get("brand"), it.get("category"), k) == _scan(it, stores, server._bucket_of, k)
+
+
+def test_brand_map_is_precomputed_and_memo_bounded(server):
+    stores = server._load_stores(server.STORES_PATH)
+    items = load_catalog("Data/health_catalog.json")
+    idx = StoreIndex(stores, server._bucket_of, [it.get("brand") for it in items] + [None, 123], memo_size=8)
+    for it in items:
+        idx.ranked(it.get("brand"), it.get("category"))
+    st = idx.stats()
+    assert st["memo"] == 8 and st["brands"] == len({(it.get("brand") or "").lower() for it in items} - {""}) + 1
+    assert idx.brand_stores("  lạ  ") == frozenset() and idx.stats()["brands"] == st["brands"]
+    for brand in {it.get("brand") for it in items if it.get("brand")}:
+        assert idx.brand_stores(brand.upper()) == idx._match(brand.lower())
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import vector_scoring as vs
+from bench_scoring import synth_catalog
+from catalog_index import CatalogIndex
+
+GOALS = ("", "tăng cơ", "giảm cân", "tăng cơ, tiêu hoá")
+BUCKETS = ("snack", "beverage", "misc", "milk")
+
+
+@pytest.fixture(scope="module")
+def index(server):
+    return CatalogIndex(synth_catalog(5000, seed=1), server._bucket_of)
+
+
+def test_nutriscore_columns_match_scalar(server, index):
+    for e in map(index.entry, range(len(index))):
+        ns = server._nutriscore(e.item["nutrition_100g"], is_beverage=(e.bucket == "beverage"))
+        assert (ns["grade"], ns["points"]) == (e.ns_grade, e.ns_points), e.item
+
+
+@pytest.mark.parametrize("goals", GOALS)
+@pytest.mark.parametrize("bucket", BUCKETS)
+def test_scores_and_top_k_match_scalar(server, index, goals, bucket):
+    pos = index.candidates(bucket)
+    vec = vs.score_columns(index.cols, pos, *server._goal_flags(goals), index.is_snack)
+    ref = np.array([server._score_item(index.item(i), {}, goals_text=goals)[0] for i in pos])
+    assert np.array_equal(vec, ref)
+    ranked = sorted(range(len(ref)), key=lambda j: ref[j], reverse=True)[:50]   # sort ổn định như bản cũ
+    assert list(vs.top_k(vec, 50)) == ranked
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+vector_scoring.py
+- Bản NumPy của _nutriscore / _score_item trong server.py, chạy trên cột nutrition_100g (float64, NaN = thiếu)
+- Điểm theo ngưỡng: np.searchsorted trên bảng bậc; thưởng theo mục tiêu / phạt snack: mặt nạ boolean
+- top_k: np.argpartition, giữ thứ tự như sort ổn định của bản cũ (điểm giảm dần, hoà → thứ tự catalog)
+- Ngưỡng phải khớp bản scalar; kiểm tra bằng `python -m pytest -q tests/test_vector_scoring.py`
+
+Cần: pip install numpy
+"""
+import numpy as np
+
+NUTRIENT_COLS = ("sugars_g", "sodium_g", "satfat_g", "protein_g", "fiber_g", "energy_kcal")
+GRADES = "ABCDE"
+
+# ---- Nutri-Score (đơn giản hoá) ----
+_NS_ENERGY_KJ = np.array([335, 670, 1005, 1340, 1675, 2010, 2345, 2680, 3015, 3350], dtype=float)
+_NS_SUGARS = np.array([4.5, 9, 13.5, 18, 22.5, 27, 31, 36, 40, 45])
+_NS_SATFAT = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], dtype=float)
+_NS_SODIUM_MG = np.array([90, 180, 270, 360, 450, 540, 630, 720, 810, 900], dtype=float)
+_NS_FIBER = np.array([0.9, 1.9, 2.8, 3.7, 4.7])
+_NS_PROTEIN = np.array([1.6, 3.2, 4.8, 6.4, 8.0])
+_GRADE_FOOD = np.array([-1, 2, 10, 18], dtype=float)      # ≤ → A B C D, còn lại E
+_GRADE_BEVERAGE = np.array([1, 5, 9], dtype=float)        # ≤ → B C D, còn lại E
+
+# ---- _score_item: bậc (≤ cận trên) → điểm ----
+_SUGAR_EDGES, _SUGAR_PTS = np.array([5.0, 8.0]), np.array([2.0, 1.0, -1.0])
+_SODIUM_EDGES, _SODIUM_PTS = np.array([0.12, 0.4]), np.array([2.0, 0.0, -1.0])
+_SATFAT_EDGES, _SATFAT_PTS = np.array([3.0, 5.0]), np.array([1.0, 0.0, -1.0])
+
+
+def columns(items) -> dict:
+    """nutrition_100g của từng item → {tên: mảng float64}, None → NaN."""
+    n = len(items)
+    cols = {c: np.full(n, np.nan) for c in NUTRIENT_COLS}
+    for i, it in enumerate(items):
+        nut = it.get("nutrition_100g") or {}
+        for c in NUTRIENT_COLS:
+            v = nut.get(c)
+            if v is not None:
+                cols[c][i] = v
+    return cols
+
+
+def _upto(steps, x, cap):
+    """Chỉ số bậc 1-based của bậc đầu tiên có x ≤ ngưỡng, tối đa cap (như vòng `if x<=t: return i`)."""
+    return np.minimum(np.searchsorted(steps, x, side="left") + 1, cap)
+
+
+def nutriscore_columns(cols: dict, is_beverage) -> tuple:
+    """→ (points int32, chỉ số hạng trong GRADES uint8); giá trị thiếu tính là 0 như `nut.get(...) or 0.0`."""
+    z = {c: np.nan_to_num(cols[c], nan=0.0) for c in ("energy_kcal", "sugars_g", "satfat_g", "sodium_g",
+                                                       "fiber_g", "protein_g")}
+    neg = (_upto(_NS_ENERGY_KJ, z["energy_kcal"] * 4.184, 10) + _upto(_NS_SUGARS, z["sugars_g"], 10)
+           + _upto(_NS_SATFAT, z["satfat_g"], 10) + _upto(_NS_SODIUM_MG, z["sodium_g"] * 1000.0, 10))
+    pfiber = np.searchsorted(_NS_FIBER, z["fiber_g"], side="left")
+    pprot = _upto(_NS_PROTEIN, z["protein_g"], 5)
+    total = neg - (pfiber + np.where(neg >= 11, 0, pprot))
+    grade_food = np.searchsorted(_GRADE_FOOD, total, side="left")
+    grade_bev = 1 + np.searchsorted(_GRADE_BEVERAGE, total, side="left")
+    return total.astype(np.int32), np.where(is_beverage, grade_bev, grade_food).astype(np.uint8)
+
+
+def _tiered(x, edges, pts):
+    return np.where(np.isnan(x), 0.0, pts[np.searchsorted(edges, x, side="left")])
+
+
+def score_columns(cols: dict, pos, protein_goal: bool, fiber_goal: bool, is_snack) -> np.ndarray:
+    """Điểm cá nhân hoá của các item ở vị trí pos (cùng công thức _score_item, không kèm lý do)."""
+    take = {c: cols[c][pos] for c in NUTRIENT_COLS}
+    score = (_tiered(take["sugars_g"], _SUGAR_EDGES, _SUGAR_PTS)
+             + _tiered(take["sodium_g"], _SODIUM_EDGES, _SODIUM_PTS)
+             + _tiered(take["satfat_g"], _SATFAT_EDGES, _SATFAT_PTS))
+    with np.errstate(invalid="ignore"):   # so sánh với NaN → False
+        if protein_goal:
+            score += np.where(take["protein_g"] >= 10, 2.0, 0.0)
+        if fiber_goal:
+            score += np.where(take["fiber_g"] >= 5, 1.0, 0.0)
+        score -= np.where(is_snack[pos] & (take["energy_kcal"] > 480), 1.0, 0.0)
+    return score
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Chỉ số k điểm cao nhất, giảm dần; hoà điểm giữ thứ tự xuất hiện."""
+    n = len(scores)
+    if n == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < n:
+        thr = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > thr)
+        ties = np.flatnonzero(scores == thr)[:k - len(above)]
+        cand = np.concatenate([above, ties])
+    else:
+        cand = np.arange(n)
+    return cand[np.lexsort((cand, -scores[cand]))]
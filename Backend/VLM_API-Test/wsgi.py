@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+wsgi.py
+- Entry point production: N worker process (gunicorn) thay cho app.run(debug=True) một process
+- Các worker chia sẻ trạng thái qua STATE_BACKEND (mặc định sqlite trong OUT_DIR khi N > 1)
+
+    python wsgi.py --workers 4 --port 8888
+    # hoặc trực tiếp:
+    STATE_BACKEND=sqlite GEMINI_WORKERS=4 gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:8888 wsgi:app
+
+Cần `pip install gunicorn` (Linux/macOS).
+"""
+import argparse
+import os
+
+
+def _configure(workers: int):
+    # Phải đặt trước khi import server: STATE/GEMINI_SCHED đọc env lúc import
+    if workers > 1:
+        os.environ.setdefault("STATE_BACKEND", "sqlite")
+        os.environ.setdefault("GEMINI_WORKERS", str(workers))
+
+
+_configure(int(os.getenv("WEB_CONCURRENCY", "1")))
+
+if __name__ != "__main__":
+    from server import app  # noqa: E402  (gunicorn wsgi:app)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Chạy HealthScan API với nhiều worker (gunicorn)")
+    ap.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2)))
+    ap.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", "8")))
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=int(os.getenv("PORT", "8888")))
+    ap.add_argument("--timeout", type=int, default=180, help="giây; lời gọi VLM có thể lâu")
+    args = ap.parse_args()
+
+    _configure(args.workers)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("gunicorn chưa được cài: pip install gunicorn")
+
+    class _App(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("timeout", args.timeout)
+
+        def load(self):
+            from server import app as wsgi_app
+            return wsgi_app
+
+    print(f"[INFO] Starting {args.workers} workers x {args.threads} threads on {args.host}:{args.port} "
+          f"(STATE_BACKEND={os.environ.get('STATE_BACKEND', 'memory')})")
+    _App().run()
+
+
+if __name__ == "__main__":
+    main()